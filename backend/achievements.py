@@ -0,0 +1,233 @@
+"""
+成就汇总 - 每个用户一份物化的连续天数/累计统计，随每日记录写入增量维护
+
+用法:
+    python achievements.py rebuild [--user-id ID]   从 daily_records 重建汇总
+    python achievements.py verify [--user-id ID]    校验汇总与 daily_records 是否一致
+"""
+import argparse
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+from database import get_achievement_summaries_collection, get_daily_records_collection
+from schema import user_match, from_storage
+
+SUMMARY_FIELDS = (
+    "current_streak", "longest_streak", "total_completed_days", "total_days", "total_seconds",
+)
+MAX_UPDATE_RETRIES = 3
+
+def calculate_streak(records: List[dict]) -> tuple:
+    """计算连续完成天数"""
+    if not records:
+        return 0, 0
+
+    # 按日期排序（降序，最新的在前）
+    sorted_records = sorted(records, key=lambda x: x["date"], reverse=True)
+
+    current_streak = 0
+    longest_streak = 0
+    temp_streak = 0
+
+    for record in sorted_records:
+        if record.get("completed", False):
+            temp_streak += 1
+            if temp_streak > longest_streak:
+                longest_streak = temp_streak
+        else:
+            if temp_streak > 0 and current_streak == 0:
+                current_streak = temp_streak
+            temp_streak = 0
+
+    # 如果一直都是完成的
+    if current_streak == 0 and temp_streak > 0:
+        current_streak = temp_streak
+
+    if temp_streak > longest_streak:
+        longest_streak = temp_streak
+
+    return current_streak, longest_streak
+
+def summarize_records(records: List[dict]) -> dict:
+    """根据全部每日记录计算汇总（用于重建和校验）"""
+    records = sorted(records, key=lambda x: x["date"])
+    current_streak, longest_streak = calculate_streak(records)
+
+    # 以最新一条记录结尾的连续完成天数，以及以倒数第二条结尾的连续天数
+    tail_run = 0
+    tail_run_before = 0
+    for record in records:
+        tail_run_before = tail_run
+        tail_run = tail_run + 1 if record.get("completed", False) else 0
+
+    return {
+        "current_streak": current_streak,
+        "longest_streak": longest_streak,
+        "total_completed_days": sum(1 for r in records if r.get("completed", False)),
+        "total_days": len(records),
+        "total_seconds": sum(r.get("total_seconds", 0) for r in records),
+        "last_date": records[-1]["date"] if records else None,
+        "last_completed": records[-1].get("completed", False) if records else False,
+        "tail_run": tail_run,
+        "tail_run_before": tail_run_before,
+    }
+
+def advance_summary(
+    summary: dict,
+    date: str,
+    previous: Optional[dict],
+    completed: bool,
+    seconds: int
+) -> Optional[dict]:
+    """
+    将一次每日记录写入应用到汇总上，返回需要更新的字段。
+    previous 为写入前的每日记录（不存在则为None）。
+    无法增量推导时（如修改历史日期的完成状态）返回None，由调用方重建。
+    """
+    was_new = previous is None
+    was_completed = bool(previous and previous.get("completed", False))
+
+    fields = {
+        "total_seconds": summary["total_seconds"] + seconds,
+        "total_days": summary["total_days"] + (1 if was_new else 0),
+        "total_completed_days": summary["total_completed_days"] + int(completed) - int(was_completed),
+    }
+
+    last_date = summary.get("last_date")
+    if last_date is None or date > last_date:
+        # 新的一天追加在最后
+        if not was_new:
+            return None
+        tail_run = summary["tail_run"] + 1 if completed else 0
+        fields.update({
+            "last_date": date,
+            "last_completed": completed,
+            "tail_run": tail_run,
+            "tail_run_before": summary["tail_run"],
+        })
+        if completed:
+            fields["current_streak"] = tail_run
+            fields["longest_streak"] = max(summary["longest_streak"], tail_run)
+    elif date == last_date:
+        # 更新最新的一天
+        if was_new:
+            return None
+        if completed and not was_completed:
+            tail_run = summary["tail_run_before"] + 1
+            fields.update({
+                "last_completed": True,
+                "tail_run": tail_run,
+                "current_streak": tail_run,
+                "longest_streak": max(summary["longest_streak"], tail_run),
+            })
+        elif was_completed and not completed:
+            return None
+    elif was_new or completed != was_completed:
+        # 历史日期的插入或完成状态变化会影响连续天数
+        return None
+
+    return fields
+
+async def load_records(user_id: str) -> List[dict]:
+    """读取用户全部每日记录（日期为字符串形式）"""
+    records = await get_daily_records_collection().find(
+        {"user_id": user_match(user_id)},
+        {"_id": 0, "date": 1, "completed": 1, "total_seconds": 1}
+    ).to_list(length=None)
+    return [from_storage(r) for r in records]
+
+async def rebuild_summary(user_id: str) -> dict:
+    """从 daily_records 重新计算并保存用户汇总"""
+    records = await load_records(user_id)
+    summary = summarize_records(records)
+
+    await get_achievement_summaries_collection().update_one(
+        {"_id": user_id},
+        {
+            "$set": {**summary, "updated_at": datetime.now()},
+            "$inc": {"version": 1}
+        },
+        upsert=True
+    )
+    return summary
+
+async def record_daily_update(
+    user_id: str,
+    date: str,
+    previous: Optional[dict],
+    completed: bool,
+    seconds: int
+):
+    """每日记录写入后增量更新汇总（乐观并发，冲突或无法增量时重建）"""
+    collection = get_achievement_summaries_collection()
+
+    for _ in range(MAX_UPDATE_RETRIES):
+        summary = await collection.find_one({"_id": user_id})
+        if summary is None:
+            break
+
+        fields = advance_summary(summary, date, previous, completed, seconds)
+        if fields is None:
+            break
+
+        result = await collection.update_one(
+            {"_id": user_id, "version": summary.get("version")},
+            {
+                "$set": {**fields, "updated_at": datetime.now()},
+                "$inc": {"version": 1}
+            }
+        )
+        if result.matched_count:
+            return
+
+    await rebuild_summary(user_id)
+
+async def get_summary(user_id: str) -> dict:
+    """读取用户汇总，不存在时从 daily_records 回填"""
+    summary = await get_achievement_summaries_collection().find_one({"_id": user_id})
+    if summary is None:
+        summary = await rebuild_summary(user_id)
+    return summary
+
+async def _user_ids(user_id: Optional[str]) -> List[str]:
+    if user_id:
+        return [user_id]
+    # 迁移期间同一用户可能同时有两种格式的记录
+    return sorted({str(uid) for uid in await get_daily_records_collection().distinct("user_id")})
+
+async def _rebuild(user_id: Optional[str]):
+    count = 0
+    for uid in await _user_ids(user_id):
+        await rebuild_summary(uid)
+        count += 1
+    print(f"已重建 {count} 个用户的成就汇总")
+
+async def _verify(user_id: Optional[str]) -> int:
+    mismatched = 0
+    user_ids = await _user_ids(user_id)
+    for uid in user_ids:
+        records = await load_records(uid)
+        expected = summarize_records(records)
+        stored = await get_achievement_summaries_collection().find_one({"_id": uid}) or {}
+        diff = {k: (stored.get(k), expected[k]) for k in SUMMARY_FIELDS if stored.get(k) != expected[k]}
+        if diff:
+            mismatched += 1
+            print(f"{uid}: {diff}")
+    print(f"校验完成: {len(user_ids)} 个用户, {mismatched} 个不一致")
+    return mismatched
+
+def main():
+    parser = argparse.ArgumentParser(description="成就汇总重建/校验")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("--user-id", default=None, help="只处理指定用户")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        asyncio.run(_rebuild(args.user_id))
+    else:
+        mismatched = asyncio.run(_verify(args.user_id))
+        raise SystemExit(1 if mismatched else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+运维命令行工具 - 查看数据库概况、流式导出和批量导入（连接配置读取 config.py / .env）
+
+用法:
+    python admin.py check                                   各集合文档数和最近一条样例
+    python admin.py export -o backup/                       导出全部集合为 <集合>.ndjson.gz
+    python admin.py export -o out/ --format csv --user-id ID --start-date 2024-01-01
+    python admin.py import -i backup/ [--collections users timer_sessions]
+
+NDJSON 使用 MongoDB 扩展JSON，ObjectId/日期类型可原样导回；CSV 只用于查看和分析，不支持导入。
+导出按 ANALYTICS_READ_PREFERENCE 读取（可分流到从节点），各集合由独立的工作协程并行导出，
+游标按 batch_size 分批读取，压缩写入在线程中进行，内存占用只与批大小有关。
+分桶存储模式（SESSION_STORAGE=bucket）下已结束的会话在 session_buckets 集合中，一并导出。
+已归档的会话（archive.py，session_archive 集合或归档文件）展开后追加到 timer_sessions 的导出中。
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId, json_util
+from bson.json_util import JSONOptions, JSONMode
+from pymongo.errors import BulkWriteError
+
+from config import DATABASE_NAME, EXPORT_BATCH_SIZE, IMPORT_BATCH_SIZE
+from database import get_db, get_analytics_db, close_client
+from archive import iter_archived_sessions
+from schema import RECORD_COLLECTIONS, user_match, day_range_query, from_storage, to_storage
+from session_store import bucket_date
+
+# 集合名 -> (用户字段, 日期字段, CSV 导出字段)；users 按 _id 过滤，不按日期过滤
+COLLECTIONS: Dict[str, Tuple[str, Optional[str], List[str]]] = {
+    "users": ("_id", None, ["_id", "openid", "created_at", "plan.current_set", "plan.total_sets", "plan.target_hours"]),
+    "timer_sessions": ("user_id", "date", ["_id", "user_id", "date", "start_time", "end_time", "duration", "auto_closed"]),
+    "session_buckets": ("u", "d", ["_id", "u", "d", "n", "t"]),
+    "daily_records": ("user_id", "date", ["user_id", "date", "total_seconds", "completed"]),
+}
+FORMATS = ("ndjson", "csv")
+JSON_OPTIONS = JSONOptions(json_mode=JSONMode.CANONICAL)
+
+def build_query(name: str, user_id: Optional[str], start_date: Optional[str], end_date: Optional[str]) -> dict:
+    """按用户和日期范围构造查询条件（users 集合只按用户过滤）"""
+    user_field, date_field, _ = COLLECTIONS[name]
+    query = {}
+    if name in RECORD_COLLECTIONS:
+        # 会话和每日记录按 RECORD_SCHEMA 匹配存储格式
+        if user_id:
+            query[user_field] = user_match(user_id)
+        query.update(day_range_query(start_date, end_date, field=date_field))
+        return query
+    if user_id:
+        query[user_field] = ObjectId(user_id) if user_field == "_id" else user_id
+    if date_field and (start_date or end_date):
+        query[date_field] = {}
+        if start_date:
+            # 会话桶按桶开始日期过滤，包含开始日期所在的桶
+            query[date_field]["$gte"] = bucket_date(start_date) if name == "session_buckets" else start_date
+        if end_date:
+            query[date_field]["$lte"] = end_date
+    return query
+
+def _get_field(doc: dict, path: str):
+    for key in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+def _csv_rows(docs: List[dict], fields: List[str]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for doc in docs:
+        # CSV 中的用户ID和日期始终为字符串形式；NDJSON 按存储格式原样导出
+        from_storage(doc)
+        writer.writerow(["" if (value := _get_field(doc, f)) is None else value for f in fields])
+    return buffer.getvalue()
+
+def _ndjson_rows(docs: List[dict]) -> str:
+    return "".join(json_util.dumps(doc, json_options=JSON_OPTIONS) + "\n" for doc in docs)
+
+def _open_output(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=6)
+    return open(path, "w", encoding="utf-8", newline="")
+
+async def _documents(cursor, extra: Optional[AsyncIterator[dict]]) -> AsyncIterator[dict]:
+    async for doc in cursor:
+        yield doc
+    if extra is not None:
+        async for doc in extra:
+            yield doc
+
+async def export_collection(name: str, output_dir: str, fmt: str, query: dict,
+                            batch_size: int, compress: bool, extra: Optional[AsyncIterator[dict]] = None) -> int:
+    """流式导出单个集合（extra 为追加在集合之后的文档），返回导出文档数"""
+    _, _, fields = COLLECTIONS[name]
+    # CSV 只读取需要的字段；NDJSON 需要完整文档才能导回
+    projection = {f.split(".")[0]: 1 for f in fields} if fmt == "csv" else None
+    path = os.path.join(output_dir, f"{name}.{fmt}" + (".gz" if compress else ""))
+
+    cursor = get_analytics_db()[name].find(query, projection).batch_size(batch_size)
+    count = 0
+    output = _open_output(path)
+    try:
+        if fmt == "csv":
+            await asyncio.to_thread(output.write, ",".join(fields) + "\r\n")
+        batch = []
+        async for doc in _documents(cursor, extra):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                chunk = _csv_rows(batch, fields) if fmt == "csv" else _ndjson_rows(batch)
+                await asyncio.to_thread(output.write, chunk)
+                count += len(batch)
+                batch = []
+        if batch:
+            chunk = _csv_rows(batch, fields) if fmt == "csv" else _ndjson_rows(batch)
+            await asyncio.to_thread(output.write, chunk)
+            count += len(batch)
+    finally:
+        await asyncio.to_thread(output.close)
+
+    print(f"  {name}: {count} 条 -> {path}")
+    return count
+
+async def import_collection(name: str, path: str, batch_size: int) -> Tuple[int, int]:
+    """按批 insert_many(ordered=False) 导入 NDJSON 文件，返回 (写入数, 已存在跳过数)"""
+    collection = get_db()[name]
+    inserted = 0
+    skipped = 0
+
+    async def flush(docs: List[dict]):
+        nonlocal inserted, skipped
+        try:
+            result = await collection.insert_many(docs, ordered=False)
+            inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            # 重复键视为已导入，其他错误直接报告
+            other = [err for err in errors if err.get("code") != 11000]
+            if other:
+                raise
+            inserted += e.details.get("nInserted", 0)
+            skipped += len(errors)
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as source:
+        batch = []
+        for line in source:
+            if not line.strip():
+                continue
+            doc = json_util.loads(line, json_options=JSON_OPTIONS)
+            if name in RECORD_COLLECTIONS:
+                # 导入为当前 RECORD_SCHEMA 的写入格式，两种格式的备份都可导入
+                doc = to_storage(from_storage(doc))
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+
+    print(f"  {name}: 写入 {inserted} 条, 跳过已存在 {skipped} 条 <- {path}")
+    return inserted, skipped
+
+def _find_import_file(input_dir: str, name: str) -> Optional[str]:
+    for filename in (f"{name}.ndjson.gz", f"{name}.ndjson"):
+        path = os.path.join(input_dir, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+async def _check():
+    db = get_db()
+    print(f"数据库: {DATABASE_NAME}")
+    for name in sorted(await db.list_collection_names()):
+        count = await db[name].estimated_document_count()
+        sample = await db[name].find_one(sort=[("_id", -1)])
+        print(f"\n--- {name} ({count} 条) ---")
+        if sample:
+            print(sample)
+
+async def archived_sessions(user_id: Optional[str], start_date: Optional[str],
+                            end_date: Optional[str]) -> AsyncIterator[dict]:
+    """归档中的会话，转换为 timer_sessions 的写入格式"""
+    async for session in iter_archived_sessions(
+        user_id, start_date, end_date, get_analytics_db()["session_archive"]
+    ):
+        yield to_storage(session)
+
+async def _export(args) -> int:
+    os.makedirs(args.output, exist_ok=True)
+    started = time.monotonic()
+    counts = await asyncio.gather(*[
+        export_collection(
+            name, args.output, args.format,
+            build_query(name, args.user_id, args.start_date, args.end_date),
+            args.batch_size, not args.no_compress,
+            # 已归档的会话一并导出到 timer_sessions，导入时回到热数据
+            archived_sessions(args.user_id, args.start_date, args.end_date) if name == "timer_sessions" else None
+        )
+        for name in args.collections
+    ])
+    print(f"导出完成: {sum(counts)} 条, 用时 {time.monotonic() - started:.1f} 秒")
+    return 0
+
+async def _import(args) -> int:
+    paths = {}
+    for name in args.collections:
+        path = _find_import_file(args.input, name)
+        if path is None:
+            print(f"  {name}: 未找到导入文件，跳过")
+        else:
+            paths[name] = path
+
+    started = time.monotonic()
+    results = await asyncio.gather(*[
+        import_collection(name, path, args.batch_size) for name, path in paths.items()
+    ])
+    print(f"导入完成: 写入 {sum(r[0] for r in results)} 条, 用时 {time.monotonic() - started:.1f} 秒")
+    if paths:
+        print("提示: 可运行 python achievements.py rebuild 重建成就汇总")
+    return 0
+
+async def _run(args) -> int:
+    try:
+        if args.command == "check":
+            await _check()
+            return 0
+        if args.command == "export":
+            return await _export(args)
+        return await _import(args)
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库运维工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("check", help="查看各集合文档数和样例")
+
+    export_parser = subparsers.add_parser("export", help="流式导出集合")
+    export_parser.add_argument("-o", "--output", required=True, help="输出目录")
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--no-compress", action="store_true", help="不使用gzip压缩")
+    export_parser.add_argument("--user-id", default=None, help="只导出指定用户")
+    export_parser.add_argument("--start-date", default=None, help="开始日期 YYYY-MM-DD（会话和每日记录）")
+    export_parser.add_argument("--end-date", default=None, help="结束日期 YYYY-MM-DD（会话和每日记录）")
+    export_parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    export_parser.add_argument("--collections", nargs="+", choices=list(COLLECTIONS), default=list(COLLECTIONS))
+
+    import_parser = subparsers.add_parser("import", help="从 NDJSON 文件批量导入")
+    import_parser.add_argument("-i", "--input", required=True, help="导出目录")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    import_parser.add_argument("--collections", nargs="+", choices=list(COLLECTIONS), default=list(COLLECTIONS))
+
+    args = parser.parse_args()
+    if args.command == "export" and args.user_id and not ObjectId.is_valid(args.user_id):
+        parser.error("无效的用户ID")
+
+    raise SystemExit(asyncio.run(_run(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+已结束会话归档 - 把早于 ARCHIVE_AFTER_DAYS 天的已结束会话移出热数据（timer_sessions / session_buckets）。
+
+会话结束时已计入 daily_records，接口只读取进行中的会话和最近几天的会话；归档后热集合及其索引的大小只与归档窗口有关。
+归档目标（ARCHIVE_STORAGE）:
+    collection  session_archive 集合，每个用户每月一个文档，格式与按月分桶的 session_buckets 相同
+    files       ARCHIVE_DIR/<YYYY-MM>/<user_id>.ndjson.gz，每个用户每月一个压缩文件（MongoDB 扩展JSON）
+归档中的用户ID和日期始终为字符串形式，与 RECORD_SCHEMA 无关。
+每批先写入归档再从热数据删除，同一会话重复写入不会重复，中断后重新运行即可。
+导出（admin.py export）和按会话重算的工具通过 iter_archived_sessions / iter_user_sessions 同时读取两层。
+
+离线同步只在热数据中查重，ARCHIVE_AFTER_DAYS 应大于客户端缓存离线事件的最长时间（不小于 MIN_ARCHIVE_DAYS）。
+
+用法:
+    python archive.py run [--days 180] [--batch-size 1000] [--duty-cycle 0.5]   按批归档
+    python archive.py status [--days 180]                                       各层的会话数和大小
+    python archive.py verify [--user-id ID]                                     用两层的全部会话重算每日时长并与 daily_records 对比
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional
+
+from bson import json_util
+from bson.json_util import JSONOptions, JSONMode
+from pymongo import DeleteOne
+
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_STORAGE, ARCHIVE_DIR, ARCHIVE_BATCH_SIZE, ARCHIVE_DUTY_CYCLE
+from database import (
+    get_db, get_timer_sessions_collection, get_session_buckets_collection, get_session_archive_collection,
+    get_daily_records_collection, close_client
+)
+from schema import user_match, day_range_query, from_storage, collection_sizes, print_sizes
+from session_store import append_to_buckets, bucket_date, expand_entry
+
+STORAGES = ("collection", "files")
+if ARCHIVE_STORAGE not in STORAGES:
+    raise ValueError(f"无效的 ARCHIVE_STORAGE: {ARCHIVE_STORAGE}")
+
+MIN_ARCHIVE_DAYS = 30
+ARCHIVE_SPAN = "month"
+FILE_SUFFIX = ".ndjson.gz"
+JSON_OPTIONS = JSONOptions(json_mode=JSONMode.CANONICAL)
+
+def archive_cutoff(days: int = ARCHIVE_AFTER_DAYS, today: Optional[datetime] = None) -> str:
+    """归档截止日期：会话日期早于它的已结束会话可以归档"""
+    return ((today or datetime.now()) - timedelta(days=days)).strftime("%Y-%m-%d")
+
+def _in_range(date: str, start_date: Optional[str], end_date: Optional[str]) -> bool:
+    return (not start_date or date >= start_date) and (not end_date or date <= end_date)
+
+# ---------------- 文件归档 ----------------
+
+def archive_path(month: str, user_id: str, directory: str = ARCHIVE_DIR) -> str:
+    return os.path.join(directory, month, user_id + FILE_SUFFIX)
+
+def read_archive_file(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, "rt", encoding="utf-8") as source:
+        return [json_util.loads(line, json_options=JSON_OPTIONS) for line in source if line.strip()]
+
+def write_archive_file(path: str, sessions: List[dict]):
+    """与文件中已有的会话按ID合并，写入临时文件并落盘后替换，中断时原文件保持完整"""
+    merged = {s["_id"]: s for s in read_archive_file(path)}
+    merged.update((s["_id"], s) for s in sessions)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as output:
+            for session in sorted(merged.values(), key=lambda s: s["start_time"]):
+                output.write((json_util.dumps(session, json_options=JSON_OPTIONS) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, path)
+
+def archive_files(user_id: Optional[str] = None, start_date: Optional[str] = None,
+                  end_date: Optional[str] = None, directory: str = ARCHIVE_DIR) -> List[str]:
+    """按用户和月份列出归档文件"""
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for month in sorted(os.listdir(directory)):
+        if (start_date and month < start_date[:7]) or (end_date and month > end_date[:7]):
+            continue
+        month_dir = os.path.join(directory, month)
+        names = [user_id + FILE_SUFFIX] if user_id else sorted(os.listdir(month_dir))
+        paths.extend(
+            os.path.join(month_dir, name) for name in names
+            if name.endswith(FILE_SUFFIX) and os.path.exists(os.path.join(month_dir, name))
+        )
+    return paths
+
+# ---------------- 读写 ----------------
+
+async def write_archive(sessions: List[dict], storage: str = ARCHIVE_STORAGE):
+    """把一批字符串形式的已结束会话写入归档（可重复写入）"""
+    if storage == "collection":
+        await append_to_buckets(sessions, get_session_archive_collection(), ARCHIVE_SPAN)
+        return
+    groups: Dict[tuple, List[dict]] = defaultdict(list)
+    for session in sessions:
+        groups[(session["date"][:7], session["user_id"])].append(session)
+    for (month, user_id), group in groups.items():
+        await asyncio.to_thread(write_archive_file, archive_path(month, user_id), group)
+
+async def iter_archived_sessions(user_id: Optional[str] = None, start_date: Optional[str] = None,
+                                 end_date: Optional[str] = None, collection=None) -> AsyncIterator[dict]:
+    """
+    读取归档中的会话（timer_sessions 文档格式，字符串形式），按用户和会话日期过滤。
+    两种归档目标都会读取，切换过 ARCHIVE_STORAGE 也不影响；collection 可传入其他读偏好的集合。
+    """
+    collection = collection if collection is not None else get_session_archive_collection()
+    query = {}
+    if user_id:
+        query["u"] = user_id
+    if start_date or end_date:
+        query["d"] = {}
+        if start_date:
+            query["d"]["$gte"] = bucket_date(start_date, ARCHIVE_SPAN)
+        if end_date:
+            query["d"]["$lte"] = end_date
+    async for bucket in collection.find(query).sort([("u", 1), ("d", 1)]):
+        for entry in bucket["s"]:
+            session = expand_entry(bucket["u"], entry)
+            if _in_range(session["date"], start_date, end_date):
+                yield session
+
+    for path in await asyncio.to_thread(archive_files, user_id, start_date, end_date):
+        for session in await asyncio.to_thread(read_archive_file, path):
+            if _in_range(session["date"], start_date, end_date):
+                yield session
+
+async def iter_user_sessions(user_id: str) -> AsyncIterator[dict]:
+    """用户在热数据和归档中的全部会话（归档进行中的一批可能同时出现在两层，调用方按ID去重）"""
+    async for session in get_timer_sessions_collection().find({"user_id": user_match(user_id)}):
+        yield from_storage(session)
+    async for bucket in get_session_buckets_collection().find({"u": user_id}):
+        for entry in bucket["s"]:
+            yield expand_entry(user_id, entry)
+    async for session in iter_archived_sessions(user_id):
+        yield session
+
+# ---------------- 归档任务 ----------------
+
+async def _throttle(started: float, duty_cycle: float):
+    if duty_cycle < 1:
+        await asyncio.sleep((time.perf_counter() - started) * (1 - duty_cycle) / duty_cycle)
+
+async def archive_documents(cutoff: str, batch_size: int, duty_cycle: float, storage: str = ARCHIVE_STORAGE) -> int:
+    """归档 timer_sessions 中早于截止日期的已结束会话，按 _id 顺序分批扫描"""
+    collection = get_timer_sessions_collection()
+    query = {"end_time": {"$ne": None}, **day_range_query(before=cutoff)}
+    archived = 0
+    last_id = None
+    while True:
+        started = time.perf_counter()
+        page = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        sessions = await collection.find(page).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not sessions:
+            break
+        last_id = sessions[-1]["_id"]
+        await write_archive([from_storage(s) for s in sessions], storage)
+        result = await collection.delete_many(
+            {"_id": {"$in": [s["_id"] for s in sessions]}, "end_time": {"$ne": None}}
+        )
+        archived += result.deleted_count
+        print(f"  timer_sessions: 已归档 {archived} 个会话")
+        await _throttle(started, duty_cycle)
+    return archived
+
+async def archive_buckets(cutoff: str, batch_size: int, duty_cycle: float, storage: str = ARCHIVE_STORAGE) -> int:
+    """归档 session_buckets 中整桶早于截止日期的桶，返回归档的桶数（batch_size 为每批的桶数）"""
+    collection = get_session_buckets_collection()
+    query = {"d": {"$lt": bucket_date(cutoff)}}
+    archived = 0
+    last_id = None
+    while True:
+        started = time.perf_counter()
+        page = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        buckets = await collection.find(page).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not buckets:
+            break
+        last_id = buckets[-1]["_id"]
+        await write_archive([expand_entry(b["u"], entry) for b in buckets for entry in b["s"]], storage)
+        # 会话数不变才删除：期间又追加了会话的桶留到下次运行
+        result = await collection.bulk_write(
+            [DeleteOne({"_id": b["_id"], "n": b["n"]}) for b in buckets], ordered=False
+        )
+        archived += result.deleted_count
+        print(f"  session_buckets: 已归档 {archived} 个桶")
+        await _throttle(started, duty_cycle)
+    return archived
+
+async def run_archive(days: int, batch_size: int, duty_cycle: float, storage: str = ARCHIVE_STORAGE) -> Dict[str, int]:
+    cutoff = archive_cutoff(days)
+    print(f"归档 {cutoff} 之前的已结束会话 -> {storage}")
+    # 切换过 SESSION_STORAGE 时两处都可能有旧会话
+    return {
+        "timer_sessions": await archive_documents(cutoff, batch_size, duty_cycle, storage),
+        "session_buckets": await archive_buckets(cutoff, batch_size, duty_cycle, storage),
+    }
+
+async def status(days: int):
+    cutoff = archive_cutoff(days)
+    existing = set(await get_db().list_collection_names())
+    names = [n for n in ("timer_sessions", "session_buckets", "session_archive") if n in existing]
+    print_sizes({name: await collection_sizes(name) for name in names})
+    pending = await get_timer_sessions_collection().count_documents(
+        {"end_time": {"$ne": None}, **day_range_query(before=cutoff)}
+    )
+    print(f"timer_sessions 中 {cutoff} 之前待归档的会话: {pending}")
+    paths = await asyncio.to_thread(archive_files)
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f"归档文件 ({ARCHIVE_DIR}): {len(paths)} 个, {size / 1024:.0f} KB")
+
+async def verify(user_id: Optional[str] = None) -> int:
+    """用热数据和归档中的全部会话重算每日总时长，与 daily_records 对比，返回不一致的用户数"""
+    from achievements import load_records
+
+    if user_id:
+        user_ids = [user_id]
+    else:
+        user_ids = sorted({str(uid) for uid in await get_daily_records_collection().distinct("user_id")})
+    mismatched = 0
+    for uid in user_ids:
+        seen = set()
+        expected: Dict[str, int] = defaultdict(int)
+        async for session in iter_user_sessions(uid):
+            if session["_id"] in seen or session.get("duration") is None:
+                continue
+            seen.add(session["_id"])
+            expected[session["date"]] += session["duration"]
+        stored = {r["date"]: r.get("total_seconds", 0) for r in await load_records(uid)}
+        diff = {
+            date: (stored.get(date, 0), expected.get(date, 0))
+            for date in sorted(set(stored) | set(expected))
+            if stored.get(date, 0) != expected.get(date, 0)
+        }
+        if diff:
+            mismatched += 1
+            print(f"{uid}: {len(diff)} 天不一致 (记录, 会话) {dict(list(diff.items())[:5])}")
+    print(f"校验完成: {len(user_ids)} 个用户, {mismatched} 个不一致")
+    return mismatched
+
+async def _run(args):
+    try:
+        if args.command == "run":
+            counts = await run_archive(args.days, args.batch_size, args.duty_cycle, args.storage)
+            print(f"归档完成: {counts}")
+        elif args.command == "status":
+            await status(args.days)
+        else:
+            await verify(args.user_id)
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="已结束会话归档")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="按批归档早于窗口的已结束会话")
+    run_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="热数据保留的天数")
+    run_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    run_parser.add_argument("--duty-cycle", type=float, default=ARCHIVE_DUTY_CYCLE,
+                            help="工作时间占比，每批之后按比例休眠，1 为不休眠")
+    run_parser.add_argument("--storage", choices=STORAGES, default=ARCHIVE_STORAGE)
+
+    status_parser = subparsers.add_parser("status", help="各层的会话数和大小")
+    status_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+
+    verify_parser = subparsers.add_parser("verify", help="用全部会话重算每日时长并与 daily_records 对比")
+    verify_parser.add_argument("--user-id", default=None, help="只校验指定用户")
+
+    args = parser.parse_args()
+    if getattr(args, "days", MIN_ARCHIVE_DAYS) < MIN_ARCHIVE_DAYS:
+        parser.error(f"--days 不能小于 {MIN_ARCHIVE_DAYS}")
+    if args.command == "run" and not 0 < args.duty_cycle <= 1:
+        parser.error("--duty-cycle 应在 (0, 1] 之间")
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
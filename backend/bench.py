@@ -0,0 +1,173 @@
+"""
+纯计算函数微基准 - 统计和计时中随历史长度增长的热点函数（离线运行，不需要数据库）
+
+用法:
+    python bench.py                                   运行全部基准并输出每次调用耗时
+    python bench.py --save bench_baseline.json        运行并保存为基线
+    python bench.py --compare bench_baseline.json     与基线比较，超过允许回退比例时返回非零退出码
+    python bench.py -k streak --sizes 365 3000        只运行名称包含 streak 的基准
+
+合成历史使用固定随机种子，每个基准取多轮中最快一轮的平均耗时，结果在同一台机器上可重复比较。
+"""
+import argparse
+import json
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from achievements import calculate_streak, summarize_records
+from routers.stats import generate_suggestions, fill_range_buckets
+from routers.timer import validate_session_duration, split_session_by_hour
+from trends import analyze_records, day_numbers, fill_matrix, score_matrix, TREND_WINDOW_DAYS
+
+DEFAULT_SIZES = (30, 365, 1000, 3000)
+SCORE_USERS = 1000  # 批量评分基准的用户数
+TARGET_HOURS = 22.0
+HISTORY_START = datetime(2023, 1, 1)
+
+def make_history(days: int, seed: int = 0) -> List[dict]:
+    """生成连续 days 天的每日记录：多数天接近目标时长，周末略差，偶有漏记"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(days):
+        date = HISTORY_START + timedelta(days=i)
+        if rng.random() < 0.03:
+            continue
+        mean = 21.0 if date.weekday() >= 5 else 22.2
+        seconds = int(max(0.0, min(24.0, rng.gauss(mean, 1.2))) * 3600)
+        records.append({
+            "user_id": "bench",
+            "date": date.strftime("%Y-%m-%d"),
+            "total_seconds": seconds,
+            "completed": seconds >= TARGET_HOURS * 3600,
+        })
+    return records
+
+def make_sessions(count: int, seed: int = 0) -> List[tuple]:
+    """生成 count 个 (开始, 结束) 会话，时长从几分钟到十几小时"""
+    rng = random.Random(seed)
+    sessions = []
+    start = HISTORY_START
+    for _ in range(count):
+        start += timedelta(seconds=rng.randint(600, 4 * 3600))
+        end = start + timedelta(seconds=rng.randint(300, 14 * 3600))
+        sessions.append((start, end))
+        start = end
+    return sessions
+
+def make_population(users: int, days: int, seed: int = 0) -> tuple:
+    """生成 users 个用户最近 days 天的 (行, 天, 秒数) 三元组，用于批量评分基准"""
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(users), days)
+    day_index = np.tile(np.arange(days), users)
+    seconds = np.clip(rng.normal(21.5, 1.5, users * days), 0, 24) * 3600
+    kept = rng.random(users * days) >= 0.03
+    return rows[kept], day_index[kept], seconds[kept]
+
+def build_cases(sizes: List[int]) -> Dict[str, Callable[[], object]]:
+    """基准名 -> 无参调用"""
+    cases = {}
+    for size in sizes:
+        history = make_history(size)
+        shuffled = history[:]
+        random.Random(1).shuffle(shuffled)
+        week_data = [
+            {"date": r["date"], "hours": round(r["total_seconds"] / 3600, 1), "completed": r["completed"]}
+            for r in history
+        ]
+        groups = {r["date"]: {"total_seconds": r["total_seconds"], "completed_days": int(r["completed"])}
+                  for r in history}
+        end = HISTORY_START + timedelta(days=size - 1)
+        sessions = make_sessions(size)
+
+        cases[f"calculate_streak[{size}]"] = lambda records=shuffled: calculate_streak(records)
+        cases[f"summarize_records[{size}]"] = lambda records=shuffled: summarize_records(records)
+        cases[f"generate_suggestions[{size}]"] = lambda data=week_data: generate_suggestions(data, TARGET_HOURS)
+        cases[f"fill_range_buckets.day[{size}]"] = (
+            lambda groups=groups, end=end: fill_range_buckets(groups, HISTORY_START, end, "day")
+        )
+        cases[f"validate_session_duration[{size}]"] = (
+            lambda sessions=sessions: [validate_session_duration(s, e) for s, e in sessions]
+        )
+        cases[f"split_session_by_hour[{size}]"] = (
+            lambda sessions=sessions: [split_session_by_hour(s, e) for s, e in sessions]
+        )
+        plan = {"start_date": HISTORY_START.strftime("%Y-%m-%d"), "current_set": 1,
+                "days_per_set": size, "target_hours": TARGET_HOURS}
+        cases[f"analyze_records[{size}]"] = (
+            lambda records=history, plan=plan, end=end: analyze_records(records, plan, end)
+        )
+
+    # 批量评分：SCORE_USERS 个用户，每次调用的耗时除以用户数即为单个用户的成本
+    rows, day_index, seconds = make_population(SCORE_USERS, TREND_WINDOW_DAYS)
+    targets = np.full(SCORE_USERS, TARGET_HOURS)
+    first_day = int(day_numbers([HISTORY_START.strftime("%Y-%m-%d")])[0])
+    cases[f"score_matrix[{SCORE_USERS}x{TREND_WINDOW_DAYS}]"] = lambda: score_matrix(
+        *fill_matrix(rows, day_index, seconds, SCORE_USERS, TREND_WINDOW_DAYS), targets, first_day
+    )
+    return cases
+
+def measure(func: Callable[[], object], repeat: int, min_time: float) -> float:
+    """返回每次调用的耗时（秒）：先确定单轮次数使其不少于 min_time，再取 repeat 轮中最快的一轮"""
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def _format(seconds: float) -> str:
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:9.3f} ms"
+    return f"{seconds * 1e6:9.1f} us"
+
+def main():
+    parser = argparse.ArgumentParser(description="统计/计时纯函数微基准")
+    parser.add_argument("-k", "--filter", default=None, help="只运行名称包含该字符串的基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="合成历史天数")
+    parser.add_argument("--repeat", type=int, default=5, help="测量轮数")
+    parser.add_argument("--min-time", type=float, default=0.05, help="每轮最短耗时（秒）")
+    parser.add_argument("--save", default=None, help="把结果保存为基线 JSON")
+    parser.add_argument("--compare", default=None, help="与基线 JSON 比较")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的最大回退比例，默认 0.2 即 20%%")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    for name, func in build_cases(args.sizes).items():
+        if args.filter and args.filter not in name:
+            continue
+        seconds = measure(func, args.repeat, args.min_time)
+        results[name] = seconds
+        line = f"{name:<40} {_format(seconds)}"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f"  {change:+7.1%}"
+            if change > args.max_regression:
+                regressions.append(name)
+                line += "  回退"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "results": results,
+            }, f, indent=2)
+        print(f"基线已保存: {args.save}")
+
+    if regressions:
+        print(f"{len(regressions)} 项超过允许回退 {args.max_regression:.0%}: {', '.join(regressions)}")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
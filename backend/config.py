@@ -7,6 +7,27 @@ load_dotenv()
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "dental_align")
 
+# MongoDB连接池配置（超时单位为毫秒，0 表示不限制）
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "0"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "10000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")  # 例如 zstd,snappy,zlib（zstd/snappy 需安装对应的包）
+
+# 会话存储模式：document 每个会话一个文档；bucket 已结束的会话按用户和日期/月份分桶（见 session_store.py）
+SESSION_STORAGE = os.getenv("SESSION_STORAGE", "document")
+SESSION_BUCKET_SPAN = os.getenv("SESSION_BUCKET_SPAN", "day")  # day / month
+
+# 会话和每日记录的存储格式：string 旧格式；compact 用 ObjectId 和天数；mixed 迁移期间兼容两种格式（见 schema.py）
+RECORD_SCHEMA = os.getenv("RECORD_SCHEMA", "string")
+
+# 统计和导出读取的读偏好（副本集部署时分流到从节点，计时读写始终使用主节点）
+ANALYTICS_READ_PREFERENCE = os.getenv("ANALYTICS_READ_PREFERENCE", "secondaryPreferred")
+ANALYTICS_MAX_STALENESS_SECONDS = int(os.getenv("ANALYTICS_MAX_STALENESS_SECONDS", "90"))  # 最小90，-1 表示不限制
+
 # 微信小程序配置
 WECHAT_APPID = os.getenv("WECHAT_APPID", "your_appid_here")
 WECHAT_SECRET = os.getenv("WECHAT_SECRET", "your_secret_here")
@@ -18,3 +39,64 @@ JWT_EXPIRE_HOURS = 24 * 7  # 7天过期
 
 # 服务器配置
 API_PREFIX = "/api"
+ENSURE_INDEXES_ON_STARTUP = os.getenv("ENSURE_INDEXES_ON_STARTUP", "true").lower() == "true"  # serve.py 会为工作进程关闭
+
+# 多进程服务配置 (serve.py)
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0"))  # 0 表示按CPU核数
+SERVE_GRACEFUL_TIMEOUT = int(os.getenv("SERVE_GRACEFUL_TIMEOUT", "30"))  # 重启/退出时等待进行中请求的秒数
+
+# 进程内缓存配置
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+
+# 计时状态推送配置
+PUSH_BROKER_URL = os.getenv("PUSH_BROKER_URL", "")  # 为空使用进程内代理，多进程部署请配置 redis://
+PUSH_CHANNEL = os.getenv("PUSH_CHANNEL", "dental_align:timer")
+PUSH_TICK_SECONDS = int(os.getenv("PUSH_TICK_SECONDS", "30"))
+PUSH_QUEUE_SIZE = int(os.getenv("PUSH_QUEUE_SIZE", "16"))
+
+# 超时会话清理配置
+SWEEPER_ENABLED = os.getenv("SWEEPER_ENABLED", "true").lower() == "true"  # 单独运行 sweeper.py 时可关闭
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "60"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))
+
+# 请求合并配置：相同的并发读取共享一次查询，完成后在窗口内继续复用（0 表示只合并进行中的查询）
+SINGLEFLIGHT_WINDOW_MS = float(os.getenv("SINGLEFLIGHT_WINDOW_MS", "50"))
+
+# 统计接口响应缓存配置
+DATA_VERSION_CACHE_SIZE = int(os.getenv("DATA_VERSION_CACHE_SIZE", "10000"))
+DATA_VERSION_TTL_SECONDS = int(os.getenv("DATA_VERSION_TTL_SECONDS", "5"))  # 多进程部署时其他进程写入的可见延迟
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+
+# 运维导出/导入配置 (admin.py)
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+
+# 微信登录接口客户端配置
+WECHAT_API_URL = os.getenv("WECHAT_API_URL", "https://api.weixin.qq.com")  # 压测时可指向 fake_wechat.py
+WECHAT_CONNECT_TIMEOUT = float(os.getenv("WECHAT_CONNECT_TIMEOUT", "2"))
+WECHAT_READ_TIMEOUT = float(os.getenv("WECHAT_READ_TIMEOUT", "3"))
+WECHAT_MAX_CONNECTIONS = int(os.getenv("WECHAT_MAX_CONNECTIONS", "20"))
+WECHAT_MAX_CONCURRENCY = int(os.getenv("WECHAT_MAX_CONCURRENCY", "50"))
+WECHAT_BREAKER_THRESHOLD = int(os.getenv("WECHAT_BREAKER_THRESHOLD", "5"))
+WECHAT_BREAKER_RESET_SECONDS = float(os.getenv("WECHAT_BREAKER_RESET_SECONDS", "30"))
+
+# 请求指标配置
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", "0"))  # 大于0时记录超过该耗时的请求及其数据库命令明细
+
+# 全体统计快照任务配置 (snapshots.py)
+SNAPSHOT_CHUNK_SIZE = int(os.getenv("SNAPSHOT_CHUNK_SIZE", "500"))
+SNAPSHOT_DUTY_CYCLE = float(os.getenv("SNAPSHOT_DUTY_CYCLE", "0.5"))  # 工作时间占比，每批之后按比例休眠
+
+# 已结束会话归档任务配置 (archive.py)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))  # 早于该天数的已结束会话移出热数据
+ARCHIVE_STORAGE = os.getenv("ARCHIVE_STORAGE", "collection")  # collection: session_archive 集合；files: 按用户按月的压缩文件
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_DUTY_CYCLE = float(os.getenv("ARCHIVE_DUTY_CYCLE", "0.5"))
+
+# 运维接口令牌（请求头 X-Admin-Token），为空时关闭 /admin 接口
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
@@ -1,15 +1,147 @@
-from pymongo import MongoClient
-from config import MONGODB_URL, DATABASE_NAME
+import asyncio
+import os
+from typing import Optional
 
-client = MongoClient(MONGODB_URL)
-db = client[DATABASE_NAME]
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
+from pymongo.read_preferences import ReadPreference, Primary
+
+from config import (
+    MONGODB_URL, DATABASE_NAME,
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_COMPRESSORS, ANALYTICS_READ_PREFERENCE, ANALYTICS_MAX_STALENESS_SECONDS,
+)
+from metrics import command_listener
+
+_client: Optional[AsyncIOMotorClient] = None
+_client_pid: Optional[int] = None  # 创建客户端的进程，fork 出的子进程不能复用父进程的连接池
+
+READ_PREFERENCE_MODES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+def client_options() -> dict:
+    """连接池、超时和网络压缩参数（0 表示不限制）"""
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS or None,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS or None,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS or None,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "event_listeners": [command_listener],
+    }
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return options
+
+def analytics_read_preference():
+    """统计和导出使用的读偏好（从节点读取时限制最大延迟）"""
+    mode = READ_PREFERENCE_MODES.get(ANALYTICS_READ_PREFERENCE)
+    if mode is None:
+        raise ValueError(f"无效的 ANALYTICS_READ_PREFERENCE: {ANALYTICS_READ_PREFERENCE}")
+    if isinstance(mode, Primary):
+        return mode
+    return type(mode)(max_staleness=ANALYTICS_MAX_STALENESS_SECONDS)
+
+def init_client() -> AsyncIOMotorClient:
+    """在当前进程创建客户端（应用 lifespan 启动时调用，每个工作进程一个）"""
+    global _client, _client_pid
+    _client = AsyncIOMotorClient(MONGODB_URL, **client_options())
+    _client_pid = os.getpid()
+    return _client
+
+def get_client() -> AsyncIOMotorClient:
+    """获取异步MongoDB客户端（命令行工具中首次调用时创建）"""
+    if _client is None or _client_pid != os.getpid():
+        return init_client()
+    return _client
+
+def get_db() -> AsyncIOMotorDatabase:
+    """获取数据库（主节点读写）"""
+    return get_client()[DATABASE_NAME]
+
+def get_analytics_db() -> AsyncIOMotorDatabase:
+    """获取统计和导出用的数据库，读取按 ANALYTICS_READ_PREFERENCE 分流到从节点"""
+    return get_client().get_database(DATABASE_NAME, read_preference=analytics_read_preference())
+
+def reads_may_lag() -> bool:
+    """统计读取是否可能落后于主节点"""
+    return ANALYTICS_READ_PREFERENCE != "primary"
 
 # 集合
-users_collection = db["users"]
-timer_sessions_collection = db["timer_sessions"]
-daily_records_collection = db["daily_records"]
-
-# 创建索引
-users_collection.create_index("openid", unique=True)
-timer_sessions_collection.create_index([("user_id", 1), ("date", 1)])
-daily_records_collection.create_index([("user_id", 1), ("date", 1)], unique=True)
+def get_users_collection() -> AsyncIOMotorCollection:
+    return get_db()["users"]
+
+def get_timer_sessions_collection() -> AsyncIOMotorCollection:
+    return get_db()["timer_sessions"]
+
+def get_session_buckets_collection() -> AsyncIOMotorCollection:
+    return get_db()["session_buckets"]
+
+def get_session_archive_collection() -> AsyncIOMotorCollection:
+    return get_db()["session_archive"]
+
+def get_daily_records_collection() -> AsyncIOMotorCollection:
+    return get_db()["daily_records"]
+
+def get_analytics_daily_records_collection() -> AsyncIOMotorCollection:
+    return get_analytics_db()["daily_records"]
+
+def get_achievement_summaries_collection() -> AsyncIOMotorCollection:
+    return get_db()["achievement_summaries"]
+
+def get_user_states_collection() -> AsyncIOMotorCollection:
+    return get_db()["user_states"]
+
+def get_user_trends_collection() -> AsyncIOMotorCollection:
+    return get_db()["user_trends"]
+
+def get_stats_snapshots_collection() -> AsyncIOMotorCollection:
+    return get_db()["stats_snapshots"]
+
+def get_snapshot_jobs_collection() -> AsyncIOMotorCollection:
+    return get_db()["stats_snapshot_jobs"]
+
+async def ensure_indexes():
+    """创建索引（多进程模式下由 serve.py 在启动工作进程前执行一次）"""
+    await asyncio.gather(
+        get_users_collection().create_index("openid", unique=True),
+        get_timer_sessions_collection().create_index([("user_id", 1), ("date", 1)]),
+        # 未结束会话的部分索引，供超时会话清理按开始时间扫描
+        get_timer_sessions_collection().create_index(
+            [("start_time", 1)],
+            name="open_sessions_by_start_time",
+            partialFilterExpression={"end_time": None}
+        ),
+        # 离线同步事件去重
+        get_timer_sessions_collection().create_index(
+            [("user_id", 1), ("client_start_id", 1)],
+            unique=True,
+            partialFilterExpression={"client_start_id": {"$exists": True}}
+        ),
+        get_timer_sessions_collection().create_index(
+            [("user_id", 1), ("client_stop_id", 1)],
+            unique=True,
+            partialFilterExpression={"client_stop_id": {"$exists": True}}
+        ),
+        get_daily_records_collection().create_index([("user_id", 1), ("date", 1)], unique=True),
+        # 分桶存储模式下已结束会话的桶
+        get_session_buckets_collection().create_index([("u", 1), ("d", 1)], unique=True),
+        # 归档的已结束会话（每个用户每月一个文档）
+        get_session_archive_collection().create_index([("u", 1), ("d", 1)], unique=True),
+        get_stats_snapshots_collection().create_index([("kind", 1), ("date", 1)]),
+    )
+
+def close_client():
+    """关闭客户端连接（继承自父进程的客户端只丢弃，不关闭父进程的连接）"""
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        _client.close()
+    _client = None
+    _client_pid = None
@@ -0,0 +1,85 @@
+import hmac
+import time
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException
+from bson import ObjectId
+from jose import jwt
+
+from config import (
+    JWT_SECRET, JWT_ALGORITHM, ADMIN_TOKEN,
+    TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS,
+    USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS,
+)
+from cache import TTLCache
+from database import get_users_collection
+from models import PlanModel
+
+# token -> user_id，缓存时长不超过token本身的过期时间
+_token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL_SECONDS)
+# user_id -> 用户文档（含计划），计划变更时需显式失效
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+def verify_token(token: str) -> str:
+    """验证token并返回用户ID（结果按token缓存）"""
+    user_id = _token_cache.get(token)
+    if user_id is not None:
+        return user_id
+
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except Exception:
+        raise HTTPException(status_code=401, detail="Token无效或已过期")
+
+    user_id = payload.get("user_id")
+    if not user_id or not ObjectId.is_valid(user_id):
+        raise HTTPException(status_code=401, detail="Token无效或已过期")
+
+    ttl = TOKEN_CACHE_TTL_SECONDS
+    if payload.get("exp"):
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        _token_cache.set(token, user_id, ttl=ttl)
+    return user_id
+
+def get_user_id(authorization: str = Header(...)) -> str:
+    """从Header获取用户ID"""
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="无效的Authorization头")
+    token = authorization[7:]
+    return verify_token(token)
+
+async def load_user(user_id: str, refresh: bool = False) -> Optional[dict]:
+    """读取用户文档，优先使用进程内缓存（refresh 时强制从数据库读取）"""
+    user = None if refresh else _user_cache.get(user_id)
+    if user is None:
+        user = await get_users_collection().find_one({"_id": ObjectId(user_id)})
+        if user:
+            _user_cache.set(user_id, user)
+    return user
+
+def invalidate_user_cache(user_id: str):
+    """用户计划变更后使缓存失效"""
+    _user_cache.pop(user_id)
+
+async def load_plan(user_id: str, refresh: bool = False) -> dict:
+    """读取用户计划，用户不存在时使用默认计划"""
+    user = await load_user(user_id, refresh)
+    if user and "plan" in user:
+        return user["plan"]
+    return PlanModel().model_dump()
+
+async def get_current_plan(user_id: str = Depends(get_user_id)) -> dict:
+    """获取当前用户计划"""
+    return await load_plan(user_id)
+
+async def get_fresh_plan(user_id: str = Depends(get_user_id)) -> dict:
+    """从数据库读取当前用户计划（写入路径使用：用户缓存是进程内的，其他工作进程更新计划后本进程的缓存可能过期）"""
+    return await load_plan(user_id, refresh=True)
+
+def require_admin(x_admin_token: str = Header(default="")):
+    """校验运维接口令牌，未配置 ADMIN_TOKEN 时关闭运维接口"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="无效的运维令牌")
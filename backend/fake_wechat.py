@@ -0,0 +1,132 @@
+"""
+本地模拟微信 jscode2session 接口 - 离线测试登录延迟和故障表现
+
+用法:
+    python fake_wechat.py serve --port 9100 --latency-ms 80 --error-rate 0.1
+        启动模拟服务，配合 WECHAT_API_URL=http://127.0.0.1:9100 运行后端
+    python fake_wechat.py bench -n 2000 -c 100 --latency-ms 80 --hang-rate 0.05
+        在进程内启动模拟服务，用 wechat.py 的客户端并发调用，输出延迟分位数和失败/熔断次数
+
+模拟服务按参数注入延迟、微信错误码(errcode=-1 系统繁忙)、HTTP 500 和挂起（不响应直到客户端超时）。
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+from typing import List
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+def openid_for_code(code: str) -> str:
+    """模拟服务返回的 openid：同一个code总是对应同一个openid，便于重复登录和预先生成测试用户"""
+    return "fake_" + hashlib.sha1(code.encode()).hexdigest()[:24]
+
+def create_app(latency_ms: float = 50, jitter_ms: float = 20, error_rate: float = 0.0,
+               http_error_rate: float = 0.0, hang_rate: float = 0.0) -> FastAPI:
+    """构造模拟微信接口应用"""
+    app = FastAPI(title="fake wechat")
+
+    @app.get("/sns/jscode2session")
+    async def jscode2session(appid: str = "", secret: str = "", js_code: str = "", grant_type: str = ""):
+        roll = random.random()
+        if roll < hang_rate:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000)
+        roll -= hang_rate
+        if roll < http_error_rate:
+            return JSONResponse({"message": "internal error"}, status_code=500)
+        roll -= http_error_rate
+        if roll < error_rate:
+            return {"errcode": -1, "errmsg": "system error"}
+        if not js_code:
+            return {"errcode": 40029, "errmsg": "invalid code"}
+        return {"openid": openid_for_code(js_code), "session_key": "fake_session_key"}
+
+    return app
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def _bench(args):
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(args.latency_ms, args.jitter_ms, args.error_rate, args.http_error_rate, args.hang_rate),
+        host="127.0.0.1", port=args.port, log_level="critical"
+    ))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    from wechat import WeChatClient, WeChatUnavailable
+    client = WeChatClient(f"http://127.0.0.1:{args.port}")
+    await client.start()
+
+    latencies: List[float] = []
+    failed_latencies: List[float] = []
+    counts = {"ok": 0, "failed": 0, "rejected": 0}
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(f"code_{i % args.users}")
+
+    async def worker():
+        while not queue.empty():
+            code = queue.get_nowait()
+            breaker_open = client.breaker.state == "open"
+            started = time.perf_counter()
+            try:
+                await client.code2session(code)
+                latencies.append(time.perf_counter() - started)
+                counts["ok"] += 1
+            except WeChatUnavailable:
+                failed_latencies.append(time.perf_counter() - started)
+                counts["rejected" if breaker_open else "failed"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+
+    print(f"请求 {args.requests} 次, 并发 {args.concurrency}, 用时 {elapsed:.2f} 秒, {args.requests / elapsed:.0f} 次/秒")
+    print(f"成功 {counts['ok']}, 失败 {counts['failed']}, 熔断拒绝 {counts['rejected']}")
+    for label, values in (("成功", latencies), ("失败", failed_latencies)):
+        if values:
+            print(f"{label}延迟 p50={_percentile(values, 50) * 1000:.1f}ms "
+                  f"p95={_percentile(values, 95) * 1000:.1f}ms p99={_percentile(values, 99) * 1000:.1f}ms")
+
+    await client.stop()
+    # 挂起的请求不会自己结束，等待片刻后直接取消服务
+    server.should_exit = True
+    try:
+        await asyncio.wait_for(server_task, timeout=1)
+    except asyncio.TimeoutError:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟微信登录接口")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("serve", "启动模拟服务"), ("bench", "进程内压测登录客户端")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--port", type=int, default=9100)
+        sub.add_argument("--latency-ms", type=float, default=50, help="平均响应延迟")
+        sub.add_argument("--jitter-ms", type=float, default=20, help="延迟标准差")
+        sub.add_argument("--error-rate", type=float, default=0.0, help="返回 errcode=-1 的比例")
+        sub.add_argument("--http-error-rate", type=float, default=0.0, help="返回 HTTP 500 的比例")
+        sub.add_argument("--hang-rate", type=float, default=0.0, help="挂起不响应的比例")
+    bench_parser = subparsers.choices["bench"]
+    bench_parser.add_argument("-n", "--requests", type=int, default=1000)
+    bench_parser.add_argument("-c", "--concurrency", type=int, default=50)
+    bench_parser.add_argument("--users", type=int, default=200, help="不同登录code的数量")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        app = create_app(args.latency_ms, args.jitter_ms, args.error_rate, args.http_error_rate, args.hang_rate)
+        uvicorn.run(app, host="127.0.0.1", port=args.port)
+    else:
+        asyncio.run(_bench(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+用户实时状态 - 每个用户一份紧凑文档，记录进行中的会话、当日累计和目标秒数。
+/timer/status 只需按 _id 读取一次该文档；start/stop 通过条件原子更新维护它。
+同一用户并发的状态读取通过 SingleFlight 合并，状态变更后调用 invalidate_live_state 使之后的读取重新查询。
+"""
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import get_user_states_collection, get_timer_sessions_collection, get_daily_records_collection
+from dependencies import load_user
+from models import PlanModel
+from response_cache import DATA_VERSION_INCREMENT, invalidate_data_version
+from schema import user_match, day_match
+from singleflight import SingleFlight
+
+_status_flight = SingleFlight("live_state")
+
+def get_target_seconds(plan: dict) -> int:
+    """获取用户目标秒数"""
+    return int(plan.get("target_hours", 22) * 3600)
+
+async def _bootstrap_live_state(user_id: str, today: str) -> dict:
+    """从原始集合构建实时状态（状态文档不存在时调用一次）"""
+    active_session = await get_timer_sessions_collection().find_one(
+        {"user_id": user_match(user_id), "end_time": None},
+        sort=[("start_time", -1)]
+    )
+    record = await get_daily_records_collection().find_one({"user_id": user_match(user_id), "date": day_match(today)})
+    user = await load_user(user_id)
+    plan = user.get("plan", PlanModel().model_dump()) if user else PlanModel().model_dump()
+
+    state = {
+        "active_session_id": active_session["_id"] if active_session else None,
+        "start_time": active_session["start_time"] if active_session else None,
+        "date": today,
+        "today_total": record["total_seconds"] if record else 0,
+        "target_seconds": get_target_seconds(plan),
+        "data_version": 0,
+        "updated_at": datetime.now(),
+    }
+    try:
+        return await get_user_states_collection().find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": state},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # 并发初始化时另一请求已写入
+        return await get_user_states_collection().find_one({"_id": user_id})
+
+async def load_live_state(user_id: str, today: str) -> dict:
+    """读取用户实时状态，不存在时自动构建"""
+    state = await get_user_states_collection().find_one({"_id": user_id})
+    if state is None:
+        state = await _bootstrap_live_state(user_id, today)
+    return state
+
+async def read_live_state(user_id: str, today: str) -> dict:
+    """只读场景（/timer/status）的状态读取，同一用户的并发读取共享一次查询；返回的文档不可修改"""
+    return await _status_flight.do(user_id, lambda: load_live_state(user_id, today))
+
+def invalidate_live_state(user_id: str):
+    """本进程修改实时状态后调用：丢弃合并中的读取和版本号缓存"""
+    _status_flight.forget(user_id)
+    invalidate_data_version(user_id)
+
+def today_total_of(state: dict, today: str) -> int:
+    """实时状态中的当日累计（跨日后归零）"""
+    return state.get("today_total", 0) if state.get("date") == today else 0
+
+async def claim_session(user_id: str, session_id: ObjectId, start_time: datetime) -> bool:
+    """原子地登记进行中的会话，已有进行中的会话时返回False"""
+    result = await get_user_states_collection().update_one(
+        {"_id": user_id, "active_session_id": None},
+        {"$set": {
+            "active_session_id": session_id,
+            "start_time": start_time,
+            "updated_at": datetime.now()
+        }}
+    )
+    invalidate_live_state(user_id)
+    return result.modified_count == 1
+
+async def release_session(user_id: str, session_id: ObjectId):
+    """撤销登记的会话（会话写入失败时回滚）"""
+    await get_user_states_collection().update_one(
+        {"_id": user_id, "active_session_id": session_id},
+        {"$set": {"active_session_id": None, "start_time": None, "updated_at": datetime.now()}}
+    )
+    invalidate_live_state(user_id)
+
+def session_closed_update(session_id: ObjectId, date: str, total_seconds: int) -> list:
+    """
+    会话结束后的实时状态更新：清除进行中的会话、刷新当日累计并递增数据版本号。
+    较旧日期的累计不会覆盖较新日期；同一天取较大值，避免并发写入乱序。
+    """
+    is_active = {"$eq": ["$active_session_id", session_id]}
+    state_date = {"$ifNull": ["$date", ""]}
+    return [{"$set": {
+        "active_session_id": {"$cond": [is_active, None, "$active_session_id"]},
+        "start_time": {"$cond": [is_active, None, "$start_time"]},
+        "today_total": {"$switch": {
+            "branches": [
+                {"case": {"$gt": [date, state_date]}, "then": total_seconds},
+                {"case": {"$eq": [date, state_date]},
+                 "then": {"$max": ["$today_total", total_seconds]}},
+            ],
+            "default": "$today_total"
+        }},
+        "date": {"$cond": [{"$gt": [date, state_date]}, date, "$date"]},
+        "data_version": DATA_VERSION_INCREMENT,
+        "updated_at": datetime.now()
+    }}]
+
+async def record_session_closed(user_id: str, session_id: ObjectId, date: str, total_seconds: int):
+    """会话结束后在一次原子更新中刷新实时状态"""
+    await get_user_states_collection().update_one(
+        {"_id": user_id},
+        session_closed_update(session_id, date, total_seconds)
+    )
+    invalidate_live_state(user_id)
+
+async def set_target_seconds(user_id: str, target_seconds: int):
+    """计划变更后同步目标秒数并递增数据版本号"""
+    await get_user_states_collection().update_one(
+        {"_id": user_id},
+        {
+            "$set": {"target_seconds": target_seconds, "updated_at": datetime.now()},
+            "$inc": {"data_version": 1}
+        }
+    )
+    invalidate_live_state(user_id)
+
+async def bump_data_version(user_id: str):
+    """用户数据变更后递增数据版本号，使统计接口的缓存失效"""
+    await get_user_states_collection().update_one(
+        {"_id": user_id},
+        {"$inc": {"data_version": 1}, "$set": {"updated_at": datetime.now()}}
+    )
+    invalidate_live_state(user_id)
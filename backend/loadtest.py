@@ -0,0 +1,427 @@
+"""
+离线压测工具 - 生成模拟用户数据，并按小程序的请求比例回放流量
+
+整套环境只需要本机：mongod、fake_wechat.py 模拟的微信登录接口和后端服务。
+请为压测使用单独的数据库（DATABASE_NAME），populate --drop 会清空其中的集合。
+
+用法:
+    DATABASE_NAME=dental_align_load python loadtest.py populate --users 2000 --months 6 --drop
+    python fake_wechat.py serve --port 9100 &
+    DATABASE_NAME=dental_align_load WECHAT_API_URL=http://127.0.0.1:9100 SWEEPER_ENABLED=false python main.py &
+    python loadtest.py run --users 200 --duration 120 --output results.jsonl --label "2000u-6m"
+
+populate 为每个用户生成计划和 months 个月的佩戴历史：夜间连续佩戴，三餐和偶尔加餐时摘下，
+依从性较差的用户会有长时间未佩戴和漏记，按批 insert_many 写入会话、每日记录（含每小时分布）和成就汇总；
+SESSION_STORAGE=bucket 时会话直接写为桶文档。
+用户的 openid 与 fake_wechat.py 对登录code "load_<序号>" 返回的一致，run 可以直接登录这些用户。
+
+run 启动 --users 个虚拟用户，每个用户登录后按权重随机发起请求（状态轮询、计划、各统计页、开始/停止计时），
+请求之间有指数分布的思考时间。压测进行到 1/3 时模拟 night_start_time 前后的高峰：所有用户在 --burst-window
+秒内开始计时并轮询状态，到 2/3 时集中停止计时。结束后输出每个接口的吞吐和 p50/p95/p99，
+--output 追加一行 JSON，方便比较不同用户数和历史长度下的结果。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from achievements import summarize_records
+from database import get_db, ensure_indexes, close_client
+from fake_wechat import openid_for_code
+from models import PlanModel
+from routers.timer import split_session_hours, add_hourly
+from schema import to_storage
+from session_store import buckets_enabled, bucket_documents
+
+LOAD_CODE_PREFIX = "load_"
+POPULATED_COLLECTIONS = (
+    "users", "timer_sessions", "session_buckets", "daily_records", "achievement_summaries", "user_states"
+)
+
+# 日常请求比例（开始/停止计时按当前状态切换）
+TRAFFIC_MIX = {
+    "status": 45,
+    "plan": 8,
+    "achievements": 10,
+    "weekly": 10,
+    "range": 5,
+    "hourly": 5,
+    "records": 5,
+    "toggle": 7,
+    "login": 5,
+}
+
+def login_code(index: int) -> str:
+    return f"{LOAD_CODE_PREFIX}{index}"
+
+def _minutes(rng: random.Random, mean: float, spread: float) -> float:
+    return rng.gauss(mean, spread)
+
+def wear_removals(rng: random.Random, day: datetime, adherence: float) -> List[Tuple[datetime, datetime]]:
+    """某一天摘下牙套的时间段（起止时间），依从性越低长时间未佩戴的概率越大"""
+    weekend = day.weekday() >= 5
+    wake = _minutes(rng, 7 * 60 + (60 if weekend else 0), 30)
+    removals = [
+        (wake + 15, rng.uniform(15, 25)),                         # 早餐
+        (_minutes(rng, 12 * 60, 30), rng.uniform(20, 35)),        # 午餐
+        (_minutes(rng, 18 * 60 + 30, 30), rng.uniform(20, 40)),   # 晚餐
+    ]
+    if rng.random() < 0.3:
+        removals.append((_minutes(rng, 15 * 60 + 30, 40), rng.uniform(15, 25)))
+    if rng.random() < (1 - adherence) * 1.5:
+        removals.append((rng.uniform(9 * 60, 20 * 60), rng.uniform(60, 300)))
+
+    periods = []
+    for start, length in sorted(removals):
+        begin = day + timedelta(seconds=int(start * 60))
+        periods.append((begin, begin + timedelta(seconds=int(length * 60))))
+    return periods
+
+def generate_history(rng: random.Random, user_id: str, start: datetime, end: datetime,
+                     adherence: float, target_seconds: int) -> Tuple[List[dict], List[dict]]:
+    """生成 [start, end) 内的已结束会话和对应的每日记录"""
+    removals = []
+    day = start
+    while day < end:
+        removals.extend(wear_removals(rng, day, adherence))
+        day += timedelta(days=1)
+
+    sessions = []
+    totals: Dict[str, int] = defaultdict(int)
+    hourly: Dict[str, List[int]] = {}
+    next_day_hourly: Dict[str, List[int]] = {}
+    for (_, wear_start), (wear_end, _) in zip(removals, removals[1:]):
+        if wear_end <= wear_start or wear_end > end:
+            continue
+        # 偶尔忘记开始计时
+        if rng.random() < (1 - adherence) * 0.1:
+            continue
+        date = wear_start.strftime("%Y-%m-%d")
+        duration = int((wear_end - wear_start).total_seconds())
+        sessions.append({
+            "_id": ObjectId(),
+            "user_id": user_id,
+            "start_time": wear_start,
+            "end_time": wear_end,
+            "duration": duration,
+            "date": date
+        })
+        totals[date] += duration
+        same_day, next_day = split_session_hours(wear_start, wear_end)
+        hourly[date] = add_hourly(hourly.get(date, [0] * 24), same_day)
+        if next_day is not None:
+            next_day_hourly[date] = add_hourly(next_day_hourly.get(date, [0] * 24), next_day)
+
+    records = []
+    for date in sorted(totals):
+        record = {
+            "user_id": user_id,
+            "date": date,
+            "total_seconds": totals[date],
+            "completed": totals[date] >= target_seconds,
+            "hourly_seconds": hourly[date]
+        }
+        if date in next_day_hourly:
+            record["next_day_hourly_seconds"] = next_day_hourly[date]
+        records.append(record)
+    return sessions, records
+
+class BatchWriter:
+    """按集合缓冲文档，满一批时 insert_many(ordered=False) 写入"""
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.buffers: Dict[str, List[dict]] = defaultdict(list)
+        self.counts: Counter = Counter()
+
+    async def add(self, name: str, docs: List[dict]):
+        buffer = self.buffers[name]
+        buffer.extend(docs)
+        while len(buffer) >= self.batch_size:
+            await self._write(name, buffer[:self.batch_size])
+            del buffer[:self.batch_size]
+
+    async def flush(self):
+        for name, buffer in self.buffers.items():
+            if buffer:
+                await self._write(name, buffer)
+                buffer.clear()
+
+    async def _write(self, name: str, docs: List[dict]):
+        await get_db()[name].insert_many(docs, ordered=False)
+        self.counts[name] += len(docs)
+
+async def _populate_chunk(indexes: List[int], args, end: datetime) -> Counter:
+    writer = BatchWriter(args.batch_size)
+    for index in indexes:
+        rng = random.Random(args.seed * 1_000_003 + index)
+        adherence = min(1.0, max(0.4, rng.betavariate(8, 2)))
+        history_days = int(args.months * 30 * rng.uniform(0.5, 1.0))
+        start = end - timedelta(days=history_days)
+
+        plan = PlanModel(
+            target_hours=rng.choice([20.0, 22.0, 22.0, 22.0]),
+            days_per_set=rng.choice([7, 10, 14]),
+            start_date=start.strftime("%Y-%m-%d")
+        )
+        plan.current_set = min(plan.total_sets, history_days // plan.days_per_set + 1)
+        user_id = ObjectId()
+        target_seconds = int(plan.target_hours * 3600)
+        sessions, records = generate_history(rng, str(user_id), start, end, adherence, target_seconds)
+
+        await writer.add("users", [{
+            "_id": user_id,
+            "openid": openid_for_code(login_code(index)),
+            "created_at": start,
+            "plan": plan.model_dump()
+        }])
+        if buckets_enabled():
+            await writer.add("session_buckets", bucket_documents(sessions))
+        else:
+            await writer.add("timer_sessions", [to_storage(s) for s in sessions])
+        await writer.add("daily_records", [to_storage(r) for r in records])
+        await writer.add("achievement_summaries", [{
+            "_id": str(user_id),
+            **summarize_records(records),
+            "updated_at": datetime.now(),
+            "version": 1
+        }])
+    await writer.flush()
+    return writer.counts
+
+async def _populate(args):
+    db = get_db()
+    if args.drop:
+        for name in POPULATED_COLLECTIONS:
+            await db[name].drop()
+        print(f"已清空数据库 {db.name} 中的压测相关集合")
+    await ensure_indexes()
+
+    # 历史截止到今天零点，今天的数据由压测请求产生
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    started = time.monotonic()
+    chunks = [list(range(i, min(i + args.chunk_size, args.users))) for i in range(0, args.users, args.chunk_size)]
+    semaphore = asyncio.Semaphore(args.workers)
+
+    async def run_chunk(indexes):
+        async with semaphore:
+            return await _populate_chunk(indexes, args, end)
+
+    totals = Counter()
+    for counts in await asyncio.gather(*[run_chunk(chunk) for chunk in chunks]):
+        totals.update(counts)
+    elapsed = time.monotonic() - started
+    print(", ".join(f"{name} {count} 条" for name, count in sorted(totals.items())))
+    print(f"生成完成: {args.users} 个用户, 用时 {elapsed:.1f} 秒")
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class LoadStats:
+    """按接口记录延迟和状态码"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, name: str, seconds: float, status: str):
+        self.latencies[name].append(seconds)
+        self.statuses[name][status] += 1
+
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        result = {}
+        for name in sorted(self.latencies):
+            values = self.latencies[name]
+            result[name] = {
+                "count": len(values),
+                "rps": round(len(values) / elapsed, 1),
+                "p50_ms": round(_percentile(values, 50) * 1000, 1),
+                "p95_ms": round(_percentile(values, 95) * 1000, 1),
+                "p99_ms": round(_percentile(values, 99) * 1000, 1),
+                "errors": sum(c for s, c in self.statuses[name].items() if not s.startswith("2") and s != "304"),
+                "statuses": dict(self.statuses[name]),
+            }
+        return result
+
+class VirtualUser:
+    """一个小程序用户：持有token和当前计时会话，按权重发起请求"""
+
+    def __init__(self, index: int, client, stats: LoadStats, rng: random.Random):
+        self.code = login_code(index)
+        self.client = client
+        self.stats = stats
+        self.rng = rng
+        self.headers: Dict[str, str] = {}
+        self.session_id: Optional[str] = None
+
+    async def request(self, name: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except Exception as e:
+            self.stats.record(name, time.perf_counter() - started, type(e).__name__)
+            return None
+        self.stats.record(name, time.perf_counter() - started, str(response.status_code))
+        return response
+
+    async def login(self):
+        response = await self.request("login", "POST", "/api/auth/login", json={"code": self.code})
+        if response is not None and response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+    async def status(self):
+        response = await self.request("status", "GET", "/api/timer/status")
+        if response is not None and response.status_code == 200:
+            data = response.json()
+            self.session_id = data["session_id"] if data["is_wearing"] else None
+
+    async def start(self):
+        response = await self.request("start", "POST", "/api/timer/start", json={})
+        if response is not None and response.status_code == 200:
+            self.session_id = response.json()["session_id"]
+        elif response is not None and response.status_code == 400:
+            await self.status()
+
+    async def stop(self):
+        if self.session_id is None:
+            return
+        response = await self.request("stop", "POST", "/api/timer/stop", json={"session_id": self.session_id})
+        if response is not None and response.status_code in (200, 400, 404):
+            self.session_id = None
+
+    async def action(self, name: str):
+        if name == "status":
+            await self.status()
+        elif name == "toggle":
+            await (self.stop() if self.session_id else self.start())
+        elif name == "login":
+            await self.login()
+        elif name == "plan":
+            await self.request("plan", "GET", "/api/plan")
+        elif name == "achievements":
+            await self.request("achievements", "GET", "/api/stats/achievements")
+        elif name == "weekly":
+            await self.request("weekly", "GET", "/api/stats/weekly",
+                               params={"week_offset": -self.rng.randint(0, 3)})
+        elif name == "range":
+            await self.request("range", "GET", "/api/stats/range",
+                               params={"granularity": self.rng.choice(["day", "week", "month"])})
+        elif name == "hourly":
+            await self.request("hourly", "GET", "/api/stats/hourly", params={"days": self.rng.choice([7, 28, 90])})
+        elif name == "records":
+            await self.request("records", "GET", "/api/stats/records", params={"limit": 30})
+
+async def _drive(user: VirtualUser, deadline: float, night_at: float, morning_at: float, args):
+    names = list(TRAFFIC_MIX)
+    weights = list(TRAFFIC_MIX.values())
+    # 小程序打开时登录并同步计时状态
+    await asyncio.sleep(user.rng.uniform(0, args.ramp_up))
+    await user.login()
+    await user.status()
+
+    night_done = morning_done = False
+    while time.monotonic() < deadline:
+        now = time.monotonic()
+        if not night_done and now >= night_at:
+            night_done = True
+            await asyncio.sleep(user.rng.uniform(0, args.burst_window))
+            if user.session_id is None:
+                await user.start()
+            await user.status()
+        elif not morning_done and now >= morning_at:
+            morning_done = True
+            await asyncio.sleep(user.rng.uniform(0, args.burst_window))
+            await user.stop()
+            await user.status()
+        else:
+            await user.action(user.rng.choices(names, weights)[0])
+        await asyncio.sleep(user.rng.expovariate(1 / args.think_time) if args.think_time > 0 else 0)
+
+async def _run(args):
+    import httpx
+
+    stats = LoadStats()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        started = time.monotonic()
+        deadline = started + args.duration
+        users = [
+            VirtualUser(args.first_user + i, client, stats, random.Random(args.seed * 7919 + i))
+            for i in range(args.users)
+        ]
+        await asyncio.gather(*[
+            _drive(user, deadline, started + args.duration / 3, started + args.duration * 2 / 3, args)
+            for user in users
+        ])
+        elapsed = time.monotonic() - started
+
+    summary = stats.summary(elapsed)
+    total = sum(item["count"] for item in summary.values())
+    print(f"{'接口':<14}{'请求数':>8}{'次/秒':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'错误':>7}")
+    for name, item in summary.items():
+        print(f"{name:<14}{item['count']:>8}{item['rps']:>9}{item['p50_ms']:>10}"
+              f"{item['p95_ms']:>10}{item['p99_ms']:>10}{item['errors']:>7}")
+    print(f"合计 {total} 次请求, 用时 {elapsed:.1f} 秒, {total / elapsed:.1f} 次/秒")
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "label": args.label,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "users": args.users,
+                "duration": round(elapsed, 1),
+                "throughput": round(total / elapsed, 1),
+                "endpoints": summary,
+            }, ensure_ascii=False) + "\n")
+        print(f"结果已追加到 {args.output}")
+
+async def _run_populate(args):
+    try:
+        await _populate(args)
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="离线压测：生成数据并回放小程序流量")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    populate_parser = subparsers.add_parser("populate", help="生成模拟用户和佩戴历史")
+    populate_parser.add_argument("--users", type=int, default=1000)
+    populate_parser.add_argument("--months", type=float, default=6, help="最长历史月数（每个用户为其50%%~100%%）")
+    populate_parser.add_argument("--seed", type=int, default=1)
+    populate_parser.add_argument("--batch-size", type=int, default=2000, help="每批 insert_many 文档数")
+    populate_parser.add_argument("--chunk-size", type=int, default=50, help="每个写入协程处理的用户数")
+    populate_parser.add_argument("--workers", type=int, default=8, help="并行写入协程数")
+    populate_parser.add_argument("--drop", action="store_true", help="先清空压测相关集合")
+
+    run_parser = subparsers.add_parser("run", help="回放小程序流量")
+    run_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    run_parser.add_argument("--users", type=int, default=100, help="虚拟用户数（使用 populate 生成的前 N 个用户）")
+    run_parser.add_argument("--first-user", type=int, default=0, help="从第几个生成用户开始")
+    run_parser.add_argument("--duration", type=float, default=60, help="压测时长（秒）")
+    run_parser.add_argument("--think-time", type=float, default=1.0, help="请求间平均思考时间（秒）")
+    run_parser.add_argument("--ramp-up", type=float, default=5, help="虚拟用户逐步上线的时间（秒）")
+    run_parser.add_argument("--burst-window", type=float, default=5, help="夜间开始/早晨停止高峰的集中时间（秒）")
+    run_parser.add_argument("--connections", type=int, default=100, help="HTTP 连接池大小")
+    run_parser.add_argument("--timeout", type=float, default=10)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--output", default=None, help="追加结果的 JSONL 文件")
+    run_parser.add_argument("--label", default="", help="结果标签，如用户数和历史长度")
+
+    args = parser.parse_args()
+    if args.command == "populate":
+        asyncio.run(_run_populate(args))
+    else:
+        asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,42 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from config import API_PREFIX
-from routers import auth_router, timer_router, plan_router, stats_router
+from config import API_PREFIX, SWEEPER_ENABLED, ENSURE_INDEXES_ON_STARTUP
+from database import init_client, ensure_indexes, close_client
+from metrics import MetricsMiddleware, render_metrics
+from push import hub
+from sweeper import run_sweeper
+from wechat import wechat_client
+from routers import auth_router, timer_router, plan_router, stats_router, admin_router
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """每个工作进程启动时创建数据库客户端和后台任务，退出时依次关闭"""
+    init_client()
+    if ENSURE_INDEXES_ON_STARTUP:
+        await ensure_indexes()
+    await hub.start()
+    await wechat_client.start()
+    sweeper = asyncio.create_task(run_sweeper()) if SWEEPER_ENABLED else None
+    try:
+        yield
+    finally:
+        if sweeper:
+            sweeper.cancel()
+            with suppress(asyncio.CancelledError):
+                await sweeper
+        await hub.stop()
+        await wechat_client.stop()
+        close_client()
 
 app = FastAPI(
     title="牙套佩戴记录 API",
     description="用于记录和管理牙套佩戴时间的后端服务",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置CORS
@@ -17,13 +46,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # 注册路由
 app.include_router(auth_router, prefix=API_PREFIX)
 app.include_router(timer_router, prefix=API_PREFIX)
 app.include_router(plan_router, prefix=API_PREFIX)
 app.include_router(stats_router, prefix=API_PREFIX)
+app.include_router(admin_router, prefix=API_PREFIX)
 
 @app.get("/")
 async def root():
@@ -33,6 +65,12 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 格式的请求和数据库指标"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
+    # 开发用单进程；生产环境使用 python serve.py run 启动多个工作进程
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
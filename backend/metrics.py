@@ -0,0 +1,235 @@
+"""
+请求指标 - 按路由记录延迟直方图和状态码，并把 MongoDB 命令归属到当前请求。
+
+MetricsMiddleware 为每个 HTTP 请求创建 RequestStats 并放入 contextvar；
+Motor 在线程池中执行 pymongo 操作时会复制调用方的 context，
+因此 MongoCommandListener 能在命令完成时找到发起它的请求，统计命令数、耗时和返回文档数。
+/metrics 以 Prometheus 文本格式输出；配置 SLOW_REQUEST_MS 后，超时请求会记录逐条命令明细。
+singleflight_calls_total 中 (shared + window) / 全部 即为请求合并的命中率。
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from config import SLOW_REQUEST_MS
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+UNMATCHED_ROUTE = "unmatched"
+BACKGROUND_ROUTE = "background"  # 请求之外的命令（清理任务、推送校时等）
+
+Labels = Tuple[str, ...]
+
+class Histogram:
+    """按标签分组的累计直方图"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, labels: Labels, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            # [各区间计数..., +Inf 计数, 总和]
+            series = self._series.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            base = _label_text(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{base}{"," if base else ""}le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{base}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{base}}} {cumulative}")
+        return lines
+
+class Counter:
+    """按标签分组的计数器"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, labels: Labels, value: float = 1):
+        self._values[labels] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{{{_label_text(self.label_names, labels)}}} {value}")
+        return lines
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(names: Tuple[str, ...], values: Labels) -> str:
+    return ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+# 命令监听器在 Motor 的线程池中回调，指标更新统一加锁
+_lock = threading.Lock()
+
+http_requests = Counter("http_requests_total", "HTTP 请求数", ("method", "route", "status"))
+http_latency = Histogram(
+    "http_request_duration_seconds", "HTTP 请求耗时（直到响应体发送完毕）", ("method", "route"), LATENCY_BUCKETS
+)
+http_request_commands = Histogram(
+    "http_request_mongo_commands", "每个请求执行的 MongoDB 命令数", ("method", "route"), COMMAND_COUNT_BUCKETS
+)
+mongo_commands = Counter("mongo_commands_total", "MongoDB 命令数", ("route", "command", "status"))
+mongo_latency = Histogram(
+    "mongo_command_duration_seconds", "MongoDB 命令耗时", ("route", "command"), LATENCY_BUCKETS
+)
+mongo_documents = Counter(
+    "mongo_documents_returned_total", "MongoDB 命令返回（写命令为影响）的文档数", ("route", "command")
+)
+
+singleflight_calls = Counter(
+    "singleflight_calls_total",
+    "合并读取的调用数（leader 实际执行，shared 等待进行中的执行，window 复用刚完成的结果）",
+    ("flight", "result")
+)
+
+ALL_METRICS = (
+    http_requests, http_latency, http_request_commands, mongo_commands, mongo_latency, mongo_documents,
+    singleflight_calls,
+)
+
+class RequestStats:
+    """单个请求内的 MongoDB 命令明细"""
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.route = UNMATCHED_ROUTE
+        # (命令名, 集合, 耗时秒, 文档数, 是否成功)
+        self.commands: List[Tuple[str, str, float, int, bool]] = []
+
+    @property
+    def command_seconds(self) -> float:
+        return sum(c[2] for c in self.commands)
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+def _reply_documents(command: str, reply: dict) -> int:
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    if command == "findAndModify":
+        return 1 if reply.get("value") is not None else 0
+    return int(reply.get("n", 0))
+
+class MongoCommandListener(monitoring.CommandListener):
+    """统计 MongoDB 命令并归属到发起命令的请求"""
+
+    def __init__(self):
+        # request_id -> (请求统计, 集合名)，started 与 succeeded/failed 可能在不同线程回调
+        self._pending: Dict[int, Tuple[Optional[RequestStats], str]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        self._pending[event.request_id] = (
+            _current.get(), collection if isinstance(collection, str) else ""
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event, _reply_documents(event.command_name, event.reply), True)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finish(event, 0, False)
+
+    def _finish(self, event, documents: int, ok: bool):
+        stats, collection = self._pending.pop(event.request_id, (None, ""))
+        command = (event.command_name, collection, event.duration_micros / 1e6, documents, ok)
+        if stats is not None:
+            # 请求结束时路由已确定，再统一计入指标
+            stats.commands.append(command)
+        else:
+            with _lock:
+                _record_command(BACKGROUND_ROUTE, command)
+
+def _record_command(route: str, command: tuple):
+    name, _, seconds, documents, ok = command
+    mongo_commands.inc((route, name, "ok" if ok else "error"))
+    mongo_latency.observe((route, name), seconds)
+    mongo_documents.inc((route, name), documents)
+
+command_listener = MongoCommandListener()
+
+class MetricsMiddleware:
+    """ASGI 中间件：记录每个 HTTP 请求的路由、状态码、耗时和数据库命令"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope["method"], scope["path"])
+        token = _current.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            if route is not None:
+                stats.route = route.path
+            self._record(stats, str(status), elapsed)
+
+    def _record(self, stats: RequestStats, status: str, elapsed: float):
+        with _lock:
+            http_requests.inc((stats.method, stats.route, status))
+            http_latency.observe((stats.method, stats.route), elapsed)
+            http_request_commands.observe((stats.method, stats.route), len(stats.commands))
+            for command in stats.commands:
+                _record_command(stats.route, command)
+
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            breakdown = "; ".join(
+                f"{name} {collection} {seconds * 1000:.1f}ms docs={documents}{'' if ok else ' 失败'}"
+                for name, collection, seconds, documents, ok in stats.commands
+            )
+            logger.warning(
+                "慢请求 %s %s -> %s 用时 %.1fms, 数据库命令 %d 次共 %.1fms: %s",
+                stats.method, stats.path, status, elapsed * 1000,
+                len(stats.commands), stats.command_seconds * 1000, breakdown or "无"
+            )
+
+def record_singleflight(flight: str, result: str):
+    with _lock:
+        singleflight_calls.inc((flight, result))
+
+def render_metrics() -> str:
+    """Prometheus 文本格式的全部指标"""
+    with _lock:
+        lines = [line for metric in ALL_METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,7 @@
 # Models package
 from .user import UserModel, UserInDB, PlanModel
-from .timer import TimerSession, TimerStartRequest, TimerStopRequest, TimerStatusResponse
-from .record import DailyRecord, WeeklyStats
+from .timer import (
+    TimerSession, TimerStartRequest, TimerStopRequest, TimerStatusResponse,
+    TimerSyncEvent, TimerSyncRequest
+)
+from .record import DailyRecord, WeeklyStats, HourlyStats, RangeBucket, RangeStats, SetCompliance, TrendStats
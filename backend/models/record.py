@@ -7,6 +7,8 @@ class DailyRecord(BaseModel):
     date: str  # YYYY-MM-DD
     total_seconds: int = 0
     completed: bool = False
+    hourly_seconds: Optional[List[int]] = None  # 0-23点每小时佩戴秒数（按实际日历日期切分）
+    next_day_hourly_seconds: Optional[List[int]] = None  # 跨零点会话延续到次日的每小时佩戴秒数（不单独创建次日记录）
 
 class WeeklyStats(BaseModel):
     week_data: List[dict]  # [{date, hours, completed}, ...]
@@ -16,3 +18,53 @@ class WeeklyStats(BaseModel):
     longest_streak: int  # 历史最长连续天数
     total_completed_days: int
     suggestions: List[str]  # 智能建议
+
+class HourlyStats(BaseModel):
+    start_date: str
+    end_date: str
+    days: int
+    hourly_rate: List[float]  # 0-23点每小时平均佩戴比例百分比
+    weekday_hourly_rate: List[List[float]]  # [周一..周日][0-23点] 平均佩戴比例百分比
+    night_start_time: str
+    night_end_time: str
+    night_rate: float  # 夜间理想时段佩戴比例百分比
+    removal_hours: List[int]  # 佩戴比例最低（最常摘下）的小时
+
+class RangeBucket(BaseModel):
+    start_date: str  # 区间开始日期（已按查询范围截断）
+    end_date: str
+    days: int  # 区间内的天数
+    hours: float  # 区间内累计佩戴小时数
+    avg_hours: float
+    completed_days: int
+    completion_rate: float  # 完成率百分比
+
+class RangeStats(BaseModel):
+    granularity: str  # day / week / month
+    start_date: str
+    end_date: str
+    days: int
+    avg_hours: float
+    completion_rate: float
+    total_completed_days: int
+    buckets: List[RangeBucket]
+
+class SetCompliance(BaseModel):
+    set_number: int  # 第几副牙套
+    days: int  # 分析范围内的有效天数
+    avg_hours: float
+    completion_rate: float  # 完成率百分比
+
+class TrendStats(BaseModel):
+    start_date: str  # 分析范围：截至昨天的最近90天，或更早开始的当前这副牙套
+    end_date: str
+    days: int
+    observed_days: int  # 第一条记录之后的天数（之后没有记录的天按0小时计）
+    target_hours: float
+    avg_hours: float
+    completion_rate: float  # 完成率百分比
+    rolling_avg_hours: List[float]  # 每天的最近7天滚动平均（只含有效天）
+    trend_hours_per_week: float  # 线性趋势：每周增减的小时数
+    weekday_avg_hours: List[Optional[float]]  # [周一..周日] 平均佩戴小时数，没有数据时为null
+    sets: List[SetCompliance]  # 范围内每副牙套的达标情况
+    risk: Optional[float] = None  # 0~1 的未达标风险分数，没有数据时为null
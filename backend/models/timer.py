@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Literal, Optional
 from datetime import datetime
 
 class TimerSession(BaseModel):
@@ -23,3 +23,11 @@ class TimerStatusResponse(BaseModel):
     today_total: int = 0  # 今日累计秒数
     target_seconds: int = 79200  # 目标秒数 (22小时)
     server_time: Optional[datetime] = None  # 服务器时间，用于前端校准
+
+class TimerSyncEvent(BaseModel):
+    client_id: str = Field(..., min_length=1, max_length=64)  # 客户端生成的事件ID，用于去重
+    type: Literal["start", "stop"]
+    time: datetime  # 客户端记录的事件时间
+
+class TimerSyncRequest(BaseModel):
+    events: List[TimerSyncEvent] = Field(..., max_length=500)  # 按发生顺序排列
@@ -0,0 +1,178 @@
+"""
+计时状态推送 - 向小程序的 WebSocket 连接推送状态快照、变更和校时心跳。
+
+每个工作进程维护本进程的连接表，并通过代理(broker)订阅所有进程发布的事件：
+未配置 PUSH_BROKER_URL 时使用进程内代理（单进程部署/本地测试），
+配置 redis:// 地址时通过 Redis 发布订阅在多个工作进程间广播。
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+
+from config import PUSH_BROKER_URL, PUSH_CHANNEL, PUSH_TICK_SECONDS, PUSH_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[str, dict], None]
+
+class LocalBroker:
+    """进程内代理，发布的消息直接交给本进程处理"""
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+
+    async def publish(self, user_id: str, message: dict):
+        self._handler(user_id, message)
+
+    async def close(self):
+        pass
+
+class RedisBroker:
+    """Redis 发布订阅代理，用于多工作进程间广播（订阅连接断开后按指数退避重新订阅）"""
+
+    RECONNECT_MIN_SECONDS = 0.5
+    RECONNECT_MAX_SECONDS = 30.0
+
+    def __init__(self, url: str, channel: str):
+        self.url = url
+        self.channel = channel
+        self._redis = None
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Handler):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("使用 Redis 推送代理需要安装 redis 包: pip install redis")
+
+        self._redis = redis.from_url(self.url)
+        await self._subscribe()
+        self._reader = asyncio.create_task(self._read(handler))
+
+    async def _subscribe(self):
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.close()
+            except Exception:
+                pass
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self.channel)
+
+    async def _read(self, handler: Handler):
+        delay = self.RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                async for item in self._pubsub.listen():
+                    delay = self.RECONNECT_MIN_SECONDS
+                    try:
+                        payload = json.loads(item["data"])
+                        handler(payload["user_id"], payload["message"])
+                    except Exception:
+                        logger.exception("推送消息处理失败")
+                logger.warning("推送订阅已结束，%.1f 秒后重新订阅", delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("推送订阅连接断开，%.1f 秒后重新订阅", delay)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_SECONDS)
+            try:
+                await self._subscribe()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("重新订阅推送频道失败")
+
+    async def publish(self, user_id: str, message: dict):
+        await self._redis.publish(self.channel, json.dumps({"user_id": user_id, "message": message}))
+
+    async def close(self):
+        if self._reader:
+            self._reader.cancel()
+        if self._pubsub:
+            await self._pubsub.unsubscribe(self.channel)
+            await self._pubsub.close()
+        if self._redis:
+            await self._redis.close()
+
+def create_broker():
+    if PUSH_BROKER_URL.startswith("redis://") or PUSH_BROKER_URL.startswith("rediss://"):
+        return RedisBroker(PUSH_BROKER_URL, PUSH_CHANNEL)
+    return LocalBroker()
+
+class PushHub:
+    """本进程的推送连接表：每个连接一个有界队列，事件和心跳投递到队列中"""
+
+    def __init__(self):
+        self._connections: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._broker = None
+        self._ticker: Optional[asyncio.Task] = None
+
+    async def start(self, broker=None):
+        self._broker = broker or create_broker()
+        await self._broker.start(self._dispatch)
+        self._ticker = asyncio.create_task(self._tick_loop())
+
+    async def stop(self):
+        if self._ticker:
+            self._ticker.cancel()
+            self._ticker = None
+        if self._broker:
+            await self._broker.close()
+            self._broker = None
+
+    def connect(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=PUSH_QUEUE_SIZE)
+        self._connections[user_id].add(queue)
+        return queue
+
+    def disconnect(self, user_id: str, queue: asyncio.Queue):
+        queues = self._connections.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._connections[user_id]
+
+    @property
+    def connection_count(self) -> int:
+        return sum(len(queues) for queues in self._connections.values())
+
+    async def publish(self, user_id: str, message: dict):
+        """发布用户状态变更（推送失败不影响业务请求）"""
+        if self._broker is None:
+            return
+        try:
+            await self._broker.publish(user_id, jsonable_encoder(message))
+        except Exception:
+            logger.exception("推送消息发布失败")
+
+    def _dispatch(self, user_id: str, message: dict):
+        for queue in self._connections.get(user_id, ()):
+            self._offer(queue, message)
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, message: dict):
+        # 慢连接丢弃最旧的消息，避免无限堆积
+        if queue.full():
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+        queue.put_nowait(message)
+
+    async def _tick_loop(self):
+        while True:
+            await asyncio.sleep(PUSH_TICK_SECONDS)
+            message = {"type": "tick", "server_time": datetime.now().isoformat()}
+            for queues in list(self._connections.values()):
+                for queue in queues:
+                    self._offer(queue, message)
+
+hub = PushHub()
@@ -0,0 +1,96 @@
+"""
+版本化响应缓存 - 每个用户在 user_states 上有一个数据版本号(data_version)，
+计时结束、自动关闭、计划变更时递增。统计类接口按 (用户, 接口, 参数, 版本, 日期)
+生成 ETag 并缓存渲染好的响应体，客户端携带 If-None-Match 时直接返回304。
+
+从从节点读取的统计可能比版本号落后（最多 ANALYTICS_MAX_STALENESS_SECONDS），
+这类响应的缓存键再加上按该时长划分的时间片，使刚写入后读到的旧结果最多保留约两个时间片。
+同一用户并发读取版本号、以及缓存键相同的并发构建，通过 SingleFlight 合并为一次查询。
+"""
+import hashlib
+import json
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from cache import TTLCache
+from config import (
+    DATA_VERSION_CACHE_SIZE, DATA_VERSION_TTL_SECONDS,
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS, ANALYTICS_MAX_STALENESS_SECONDS,
+)
+from database import get_user_states_collection, reads_may_lag
+from singleflight import SingleFlight
+
+_version_cache = TTLCache(maxsize=DATA_VERSION_CACHE_SIZE, ttl=DATA_VERSION_TTL_SECONDS)
+_response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS)
+_version_flight = SingleFlight("data_version")
+# 响应体构建完成后即写入响应缓存，无需在窗口内复用
+_build_flight = SingleFlight("response", window_ms=0)
+
+# 不限制从节点延迟时按默认的最大延迟划分时间片
+DEFAULT_LAG_WINDOW_SECONDS = 90
+
+# 在更新管道中递增数据版本号的表达式
+DATA_VERSION_INCREMENT = {"$add": [{"$ifNull": ["$data_version", 0]}, 1]}
+
+async def get_data_version(user_id: str) -> int:
+    """获取用户数据版本号（进程内短期缓存）"""
+    version = _version_cache.get(user_id)
+    if version is None:
+        version = await _version_flight.do(user_id, lambda: _load_data_version(user_id))
+    return version
+
+async def _load_data_version(user_id: str) -> int:
+    state = await get_user_states_collection().find_one({"_id": user_id}, {"data_version": 1})
+    version = (state or {}).get("data_version", 0)
+    _version_cache.set(user_id, version)
+    return version
+
+def invalidate_data_version(user_id: str):
+    """本进程写入后立即使版本号缓存失效"""
+    _version_cache.pop(user_id)
+    _version_flight.forget(user_id)
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+async def versioned_response(
+    request: Request,
+    user_id: str,
+    endpoint: str,
+    build: Callable[[], Awaitable[Any]],
+    lagging_reads: bool = False
+) -> Response:
+    """
+    返回带 ETag 的响应：版本未变时返回304，否则优先使用缓存的响应体。
+    lagging_reads 表示 build 从可能落后的从节点读取。
+    """
+    params = tuple(sorted(request.query_params.items()))
+    today = datetime.now().strftime("%Y-%m-%d")
+    version = await get_data_version(user_id)
+    key = (user_id, endpoint, params, version, today)
+    if lagging_reads and reads_may_lag():
+        window = ANALYTICS_MAX_STALENESS_SECONDS if ANALYTICS_MAX_STALENESS_SECONDS > 0 else DEFAULT_LAG_WINDOW_SECONDS
+        key += (int(time.time() // window),)
+
+    etag = 'W/"%s"' % hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    body = _response_cache.get(key)
+    if body is None:
+        body = await _build_flight.do(key, lambda: _build_body(key, build))
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def _build_body(key: tuple, build: Callable[[], Awaitable[Any]]) -> bytes:
+    content = jsonable_encoder(await build())
+    body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    _response_cache.set(key, body)
+    return body
@@ -3,3 +3,4 @@ from .auth import router as auth_router
 from .timer import router as timer_router
 from .plan import router as plan_router
 from .stats import router as stats_router
+from .admin import router as admin_router
@@ -0,0 +1,54 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from datetime import datetime
+from typing import Optional
+
+from database import get_analytics_db, get_snapshot_jobs_collection
+from dependencies import require_admin
+
+router = APIRouter(prefix="/admin", tags=["运维"], dependencies=[Depends(require_admin)])
+
+SNAPSHOT_KINDS = ("day", "set", "summary")
+MAX_SNAPSHOTS = 400
+
+@router.get("/snapshots")
+async def get_snapshots(
+    kind: str = Query(default="day", description="快照类型: day / set / summary"),
+    start_date: Optional[str] = Query(default=None, description="开始日期 YYYY-MM-DD"),
+    end_date: Optional[str] = Query(default=None, description="结束日期 YYYY-MM-DD"),
+    days: Optional[int] = Query(default=None, description="set / summary 快照的统计窗口天数"),
+    limit: int = Query(default=31, ge=1, le=MAX_SNAPSHOTS)
+):
+    """读取 snapshots.py 物化的全体用户统计快照（只读，按日期倒序）"""
+    if kind not in SNAPSHOT_KINDS:
+        raise HTTPException(status_code=400, detail="无效的快照类型")
+    query = {"kind": kind}
+    try:
+        for value in (start_date, end_date):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日期格式应为YYYY-MM-DD")
+    if start_date or end_date:
+        query["date"] = {}
+        if start_date:
+            query["date"]["$gte"] = start_date
+        if end_date:
+            query["date"]["$lte"] = end_date
+    if days is not None and kind != "day":
+        query["window_days"] = days
+    
+    snapshots = await get_analytics_db()["stats_snapshots"].find(query).sort(
+        [("date", -1), ("_id", 1)]
+    ).limit(limit).to_list(length=None)
+    return {"snapshots": snapshots}
+
+@router.get("/snapshots/jobs")
+async def get_snapshot_jobs(limit: int = Query(default=10, ge=1, le=100)):
+    """最近的快照任务进度"""
+    jobs = await get_snapshot_jobs_collection().find({}, {"state": 0}).sort(
+        "updated_at", -1
+    ).limit(limit).to_list(length=None)
+    for job in jobs:
+        if job.get("last_user_id") is not None:
+            job["last_user_id"] = str(job["last_user_id"])
+    return {"jobs": jobs}
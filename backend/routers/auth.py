@@ -1,12 +1,14 @@
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from datetime import datetime, timedelta
+from bson import ObjectId
 from jose import jwt
-import httpx
+from pymongo import ReturnDocument
 
-from config import WECHAT_APPID, WECHAT_SECRET, JWT_SECRET, JWT_ALGORITHM, JWT_EXPIRE_HOURS
-from database import users_collection
-from models import UserModel, PlanModel
+from config import JWT_SECRET, JWT_ALGORITHM, JWT_EXPIRE_HOURS
+from database import get_users_collection
+from models import PlanModel
+from wechat import wechat_client, WeChatUnavailable
 
 router = APIRouter(prefix="/auth", tags=["认证"])
 
@@ -26,28 +28,14 @@ def create_token(user_id: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def verify_token(token: str) -> str:
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload.get("user_id")
-    except Exception:
-        raise HTTPException(status_code=401, detail="Token无效或已过期")
-
 @router.post("/login", response_model=LoginResponse)
 async def login(request: LoginRequest):
     """微信登录"""
     # 调用微信接口获取openid
-    url = "https://api.weixin.qq.com/sns/jscode2session"
-    params = {
-        "appid": WECHAT_APPID,
-        "secret": WECHAT_SECRET,
-        "js_code": request.code,
-        "grant_type": "authorization_code"
-    }
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params)
-        data = response.json()
+    try:
+        data = await wechat_client.code2session(request.code)
+    except WeChatUnavailable:
+        raise HTTPException(status_code=503, detail="微信服务暂时不可用，请稍后重试")
     
     if "errcode" in data and data["errcode"] != 0:
         # 开发环境：微信接口调用失败时，使用code作为模拟openid
@@ -56,22 +44,21 @@ async def login(request: LoginRequest):
     else:
         openid = data["openid"]
     
-    # 查找或创建用户
-    user = users_collection.find_one({"openid": openid})
-    is_new_user = False
-    
-    if not user:
-        # 创建新用户
-        new_user = {
-            "openid": openid,
+    # 查找或创建用户：按openid原子upsert，预先生成的_id被写入即为新用户
+    new_id = ObjectId()
+    user = await get_users_collection().find_one_and_update(
+        {"openid": openid},
+        {"$setOnInsert": {
+            "_id": new_id,
             "created_at": datetime.utcnow(),
             "plan": PlanModel().model_dump()
-        }
-        result = users_collection.insert_one(new_user)
-        user_id = str(result.inserted_id)
-        is_new_user = True
-    else:
-        user_id = str(user["_id"])
+        }},
+        projection={"_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    user_id = str(user["_id"])
+    is_new_user = user["_id"] == new_id
     
     # 生成token
     token = create_token(user_id)
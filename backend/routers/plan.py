@@ -1,26 +1,24 @@
-from fastapi import APIRouter, HTTPException, Header
+from fastapi import APIRouter, HTTPException, Depends, Request
 from bson import ObjectId
 from datetime import datetime
+from pymongo import ReturnDocument
 
-from database import users_collection
+from database import get_users_collection
+from dependencies import get_user_id, invalidate_user_cache, load_user
+from live_state import get_target_seconds, set_target_seconds, bump_data_version, load_live_state
 from models import PlanModel
-from routers.auth import verify_token
+from response_cache import versioned_response
 
 router = APIRouter(prefix="/plan", tags=["计划"])
 
-def get_user_id(authorization: str = Header(...)) -> str:
-    """从Header获取用户ID"""
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="无效的Authorization头")
-    token = authorization[7:]
-    return verify_token(token)
-
 @router.get("")
-async def get_plan(authorization: str = Header(...)):
-    """获取用户计划"""
-    user_id = get_user_id(authorization)
-    
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+async def get_plan(request: Request, user_id: str = Depends(get_user_id)):
+    """获取用户计划（支持 If-None-Match）"""
+    return await versioned_response(request, user_id, "plan", lambda: build_plan(user_id))
+
+async def build_plan(user_id: str) -> dict:
+    # 版本变化后重新读取，避免使用其他进程修改前缓存的计划
+    user = await load_user(user_id, refresh=True)
     if not user:
         raise HTTPException(status_code=404, detail="用户不存在")
     
@@ -47,41 +45,42 @@ async def get_plan(authorization: str = Header(...)):
 @router.put("")
 async def update_plan(
     plan: PlanModel,
-    authorization: str = Header(...)
+    user_id: str = Depends(get_user_id)
 ):
     """更新用户计划"""
-    user_id = get_user_id(authorization)
-    
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        raise HTTPException(status_code=404, detail="用户不存在")
-    
-    users_collection.update_one(
+    result = await get_users_collection().update_one(
         {"_id": ObjectId(user_id)},
         {"$set": {"plan": plan.model_dump()}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    invalidate_user_cache(user_id)
+    await load_live_state(user_id, datetime.now().strftime("%Y-%m-%d"))
+    await set_target_seconds(user_id, get_target_seconds(plan.model_dump()))
     
     return {"success": True, "message": "计划已更新"}
 
 @router.post("/next-set")
-async def advance_to_next_set(authorization: str = Header(...)):
-    """切换到下一副牙套"""
-    user_id = get_user_id(authorization)
-    
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        raise HTTPException(status_code=404, detail="用户不存在")
-    
-    plan = user.get("plan", {})
-    current_set = plan.get("current_set", 1)
-    total_sets = plan.get("total_sets", 30)
-    
-    if current_set >= total_sets:
+async def advance_to_next_set(user_id: str = Depends(get_user_id)):
+    """切换到下一副牙套 - 在数据库中原子递增，不依赖进程内可能过期的用户缓存"""
+    defaults = PlanModel()
+    current_set = {"$ifNull": ["$plan.current_set", defaults.current_set]}
+    user = await get_users_collection().find_one_and_update(
+        {
+            "_id": ObjectId(user_id),
+            "$expr": {"$lt": [current_set, {"$ifNull": ["$plan.total_sets", defaults.total_sets]}]}
+        },
+        [{"$set": {"plan.current_set": {"$add": [current_set, 1]}}}],
+        projection={"plan.current_set": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        if not await get_users_collection().find_one({"_id": ObjectId(user_id)}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="用户不存在")
         raise HTTPException(status_code=400, detail="已经是最后一副牙套")
     
-    users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"plan.current_set": current_set + 1}}
-    )
+    invalidate_user_cache(user_id)
+    await load_live_state(user_id, datetime.now().strftime("%Y-%m-%d"))
+    await bump_data_version(user_id)
     
-    return {"success": True, "current_set": current_set + 1}
+    return {"success": True, "current_set": user["plan"]["current_set"]}
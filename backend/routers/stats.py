@@ -1,51 +1,25 @@
-from fastapi import APIRouter, HTTPException, Header, Query
-from bson import ObjectId
+import asyncio
+import base64
+import csv
+import io
+import json
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
-from database import daily_records_collection, users_collection
-from models import WeeklyStats
-from routers.auth import verify_token
+from achievements import get_summary
+from database import get_analytics_daily_records_collection
+from dependencies import get_user_id, load_plan
+from models import WeeklyStats, HourlyStats, RangeBucket, RangeStats, TrendStats
+from response_cache import versioned_response
+from schema import user_match, day_range_query, date_string_expression, find_sorted_by_date, from_storage
+from trends import load_trend, trend_suggestions
 
 router = APIRouter(prefix="/stats", tags=["统计"])
 
-def get_user_id(authorization: str = Header(...)) -> str:
-    """从Header获取用户ID"""
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="无效的Authorization头")
-    token = authorization[7:]
-    return verify_token(token)
-
-def calculate_streak(records: List[dict]) -> tuple:
-    """计算连续完成天数"""
-    if not records:
-        return 0, 0
-    
-    # 按日期排序（降序，最新的在前）
-    sorted_records = sorted(records, key=lambda x: x["date"], reverse=True)
-    
-    current_streak = 0
-    longest_streak = 0
-    temp_streak = 0
-    
-    for record in sorted_records:
-        if record.get("completed", False):
-            temp_streak += 1
-            if temp_streak > longest_streak:
-                longest_streak = temp_streak
-        else:
-            if temp_streak > 0 and current_streak == 0:
-                current_streak = temp_streak
-            temp_streak = 0
-    
-    # 如果一直都是完成的
-    if current_streak == 0 and temp_streak > 0:
-        current_streak = temp_streak
-    
-    if temp_streak > longest_streak:
-        longest_streak = temp_streak
-    
-    return current_streak, longest_streak
+DEFAULT_SUGGESTION = "继续保持，你做得很好！"
 
 def generate_suggestions(week_data: List[dict], target_hours: float) -> List[str]:
     """生成智能建议"""
@@ -90,23 +64,181 @@ def generate_suggestions(week_data: List[dict], target_hours: float) -> List[str
         suggestions.append("太棒了！本周完美达成目标！")
     
     if not suggestions:
-        suggestions.append("继续保持，你做得很好！")
+        suggestions.append(DEFAULT_SUGGESTION)
     
     return suggestions
 
+def night_hour_weights(night_start_time: str, night_end_time: str) -> List[float]:
+    """夜间理想时段在每个整点小时内所占的比例"""
+    def to_minutes(value: str) -> int:
+        hour, minute = value.split(":")
+        return int(hour) * 60 + int(minute)
+    
+    start = to_minutes(night_start_time)
+    end = to_minutes(night_end_time)
+    weights = []
+    for hour in range(24):
+        covered = 0
+        for minute in range(hour * 60, hour * 60 + 60):
+            if start <= end:
+                covered += start <= minute < end
+            else:
+                # 跨零点的时段
+                covered += minute >= start or minute < end
+        weights.append(covered / 60)
+    return weights
+
+GRANULARITIES = ("day", "week", "month")
+MAX_RANGE_DAYS = 3660  # 单次统计最长范围
+
+def bucket_start(date: datetime, granularity: str) -> datetime:
+    """日期所属统计区间的开始日期（周从周一开始）"""
+    if granularity == "week":
+        return date - timedelta(days=date.weekday())
+    if granularity == "month":
+        return date.replace(day=1)
+    return date
+
+def next_bucket_start(start: datetime, granularity: str) -> datetime:
+    if granularity == "week":
+        return start + timedelta(days=7)
+    if granularity == "month":
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+def bucket_key_expression(granularity: str) -> dict:
+    """聚合管道中计算记录所属区间开始日期（YYYY-MM-DD）的表达式"""
+    date_string = date_string_expression()
+    if granularity == "month":
+        return {"$concat": [{"$substrBytes": [date_string, 0, 7]}, "-01"]}
+    if granularity == "week":
+        date = {"$dateFromString": {"dateString": date_string, "format": "%Y-%m-%d"}}
+        monday = {"$subtract": [
+            date,
+            {"$multiply": [{"$subtract": [{"$isoDayOfWeek": date}, 1]}, 24 * 3600 * 1000]}
+        ]}
+        return {"$dateToString": {"format": "%Y-%m-%d", "date": monday}}
+    return date_string
+
+async def compute_range_stats(
+    user_id: str,
+    start: datetime,
+    end: datetime,
+    granularity: str,
+    target_hours: float
+) -> RangeStats:
+    """使用聚合管道按日/周/月统计任意日期范围，并补齐没有记录的区间"""
+    start_date = start.strftime("%Y-%m-%d")
+    end_date = end.strftime("%Y-%m-%d")
+    target_seconds = target_hours * 3600
+    
+    groups = await get_analytics_daily_records_collection().aggregate([
+        {"$match": {"user_id": user_match(user_id), **day_range_query(start_date, end_date)}},
+        {"$group": {
+            "_id": bucket_key_expression(granularity),
+            "total_seconds": {"$sum": "$total_seconds"},
+            "completed_days": {"$sum": {"$cond": [
+                {"$ifNull": ["$completed", {"$gte": ["$total_seconds", target_seconds]}]}, 1, 0
+            ]}}
+        }}
+    ]).to_list(length=None)
+    return fill_range_buckets({g["_id"]: g for g in groups}, start, end, granularity)
+
+def fill_range_buckets(groups: dict, start: datetime, end: datetime, granularity: str) -> RangeStats:
+    """把按区间开始日期分组的聚合结果展开为连续的区间列表（没有记录的区间补零）"""
+    start_date = start.strftime("%Y-%m-%d")
+    end_date = end.strftime("%Y-%m-%d")
+    
+    buckets = []
+    total_seconds = 0
+    total_completed = 0
+    current = bucket_start(start, granularity)
+    while current <= end:
+        following = next_bucket_start(current, granularity)
+        bucket_first = max(current, start)
+        bucket_last = min(following - timedelta(days=1), end)
+        days = (bucket_last - bucket_first).days + 1
+        group = groups.get(current.strftime("%Y-%m-%d"), {})
+        seconds = group.get("total_seconds", 0)
+        completed_days = group.get("completed_days", 0)
+        
+        buckets.append(RangeBucket(
+            start_date=bucket_first.strftime("%Y-%m-%d"),
+            end_date=bucket_last.strftime("%Y-%m-%d"),
+            days=days,
+            hours=round(seconds / 3600, 1),
+            avg_hours=round(seconds / 3600 / days, 1),
+            completed_days=completed_days,
+            completion_rate=round(completed_days / days * 100, 1)
+        ))
+        total_seconds += seconds
+        total_completed += completed_days
+        current = following
+    
+    days = (end - start).days + 1
+    return RangeStats(
+        granularity=granularity,
+        start_date=start_date,
+        end_date=end_date,
+        days=days,
+        avg_hours=round(total_seconds / 3600 / days, 1),
+        completion_rate=round(total_completed / days * 100, 1),
+        total_completed_days=total_completed,
+        buckets=buckets
+    )
+
+@router.get("/range", response_model=RangeStats)
+async def get_range_stats(
+    request: Request,
+    user_id: str = Depends(get_user_id),
+    granularity: str = Query(default="day", description="统计粒度: day / week / month"),
+    start_date: Optional[str] = Query(default=None, description="开始日期 YYYY-MM-DD，默认按粒度取最近一段"),
+    end_date: Optional[str] = Query(default=None, description="结束日期 YYYY-MM-DD，默认今天")
+):
+    """获取任意日期范围的按日/周/月统计（支持 If-None-Match）"""
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail="无效的统计粒度")
+    
+    try:
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        end = datetime.strptime(end_date, "%Y-%m-%d") if end_date else today
+        if start_date:
+            start = datetime.strptime(start_date, "%Y-%m-%d")
+        elif granularity == "day":
+            start = end - timedelta(days=29)
+        elif granularity == "week":
+            start = bucket_start(end, "week") - timedelta(weeks=11)
+        else:
+            start = bucket_start(bucket_start(end, "month") - timedelta(days=330), "month")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日期格式应为YYYY-MM-DD")
+    
+    if start > end:
+        raise HTTPException(status_code=400, detail="开始日期不能晚于结束日期")
+    if (end - start).days + 1 > MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"统计范围不能超过{MAX_RANGE_DAYS}天")
+    
+    async def build():
+        plan = await load_plan(user_id, refresh=True)
+        return await compute_range_stats(user_id, start, end, granularity, plan.get("target_hours", 22.0))
+    
+    return await versioned_response(request, user_id, "range", build, lagging_reads=True)
+
 @router.get("/weekly", response_model=WeeklyStats)
 async def get_weekly_stats(
-    authorization: str = Header(...),
+    request: Request,
+    user_id: str = Depends(get_user_id),
     week_offset: int = Query(default=0, description="周偏移量，0表示本周，-1表示上周")
 ):
-    """获取周统计数据"""
-    user_id = get_user_id(authorization)
-    
-    # 获取用户目标
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
-    target_hours = 22.0
-    if user and "plan" in user:
-        target_hours = user["plan"].get("target_hours", 22.0)
+    """获取周统计数据（支持 If-None-Match）"""
+    return await versioned_response(
+        request, user_id, "weekly", lambda: build_weekly_stats(user_id, week_offset), lagging_reads=True
+    )
+
+async def build_weekly_stats(user_id: str, week_offset: int) -> WeeklyStats:
+    # 版本变化后重新读取计划，避免使用其他进程修改前缓存的目标
+    plan = await load_plan(user_id, refresh=True)
+    target_hours = plan.get("target_hours", 22.0)
     
     # 计算本周的日期范围
     today = datetime.now()
@@ -118,109 +250,241 @@ async def get_weekly_stats(
     monday = monday + timedelta(weeks=week_offset)
     sunday = monday + timedelta(days=6)
     
-    start_date = monday.strftime("%Y-%m-%d")
-    end_date = sunday.strftime("%Y-%m-%d")
+    # 并发按日统计这一周、查询成就汇总，本周同时分析长期趋势（往周不分析，趋势为None）
+    tasks = [
+        compute_range_stats(user_id, monday, sunday, "day", target_hours),
+        get_summary(user_id),
+    ]
+    if week_offset == 0:
+        tasks.append(load_trend(user_id, plan))
+    week, summary, *rest = await asyncio.gather(*tasks)
+    trend = rest[0] if rest else None
     
-    # 查询这一周的记录
-    records = list(daily_records_collection.find({
-        "user_id": user_id,
-        "date": {"$gte": start_date, "$lte": end_date}
-    }))
+    # 周数据（7天都有数据）
+    week_data = [
+        {
+            "date": bucket.start_date,
+            "hours": bucket.hours,
+            "completed": bucket.completed_days > 0
+        }
+        for bucket in week.buckets
+    ]
     
-    # 构建周数据（确保7天都有数据）
-    week_data = []
-    current_date = monday
-    total_hours = 0
-    completed_count = 0
-    
-    for i in range(7):
-        date_str = current_date.strftime("%Y-%m-%d")
-        record = next((r for r in records if r["date"] == date_str), None)
-        
-        if record:
-            hours = record["total_seconds"] / 3600
-            completed = record.get("completed", hours >= target_hours)
-        else:
-            hours = 0
-            completed = False
-        
-        week_data.append({
-            "date": date_str,
-            "hours": round(hours, 1),
-            "completed": completed
-        })
-        
-        total_hours += hours
-        if completed:
-            completed_count += 1
-        
-        current_date += timedelta(days=1)
-    
-    # 计算平均和完成率
-    avg_hours = round(total_hours / 7, 1) if week_data else 0
-    completion_rate = round(completed_count / 7 * 100, 1)
-    
-    # 获取所有记录计算连续天数
-    all_records = list(daily_records_collection.find({"user_id": user_id}))
-    current_streak, longest_streak = calculate_streak(all_records)
-    total_completed_days = sum(1 for r in all_records if r.get("completed", False))
-    
-    # 生成建议
+    # 生成建议：本周数据的建议在前，长期趋势的建议在后（有趋势建议时去掉默认的鼓励语）
     suggestions = generate_suggestions(week_data, target_hours)
+    if trend is not None:
+        extra = [s for s in trend_suggestions(trend) if s not in suggestions]
+        if extra and suggestions == [DEFAULT_SUGGESTION]:
+            suggestions = []
+        suggestions += extra
     
     return WeeklyStats(
         week_data=week_data,
-        avg_hours=avg_hours,
-        completion_rate=completion_rate,
-        current_streak=current_streak,
-        longest_streak=longest_streak,
-        total_completed_days=total_completed_days,
+        avg_hours=week.avg_hours,
+        completion_rate=week.completion_rate,
+        current_streak=summary["current_streak"],
+        longest_streak=summary["longest_streak"],
+        total_completed_days=summary["total_completed_days"],
         suggestions=suggestions
     )
 
+RECORD_FORMATS = ("json", "ndjson", "csv")
+RECORD_STREAM_BATCH_SIZE = 500
+RECORD_CSV_FIELDS = ("date", "total_seconds", "completed", "hourly_seconds")
+
+def encode_records_cursor(date: str) -> str:
+    """生成不透明的翻页游标（记录按日期降序，游标为本页最后一条的日期）"""
+    return base64.urlsafe_b64encode(json.dumps({"d": date}).encode()).decode().rstrip("=")
+
+def decode_records_cursor(cursor: str) -> str:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        date = json.loads(base64.urlsafe_b64decode(padded))["d"]
+        datetime.strptime(date, "%Y-%m-%d")
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的翻页游标")
+    return date
+
+def _csv_line(record: dict) -> str:
+    buffer = io.StringIO()
+    hourly = record.get("hourly_seconds")
+    csv.writer(buffer).writerow([
+        record["date"],
+        record.get("total_seconds", 0),
+        int(record.get("completed", False)),
+        " ".join(str(s) for s in hourly) if hourly else "",
+    ])
+    return buffer.getvalue()
+
+async def stream_records(
+    query: dict,
+    fmt: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    before: Optional[str] = None
+) -> AsyncIterator[str]:
+    """按批次遍历游标逐条输出，内存占用与历史长度无关"""
+    cursor = find_sorted_by_date(
+        get_analytics_daily_records_collection(), query, {"_id": 0},
+        start_date, end_date, before, descending=True, batch_size=RECORD_STREAM_BATCH_SIZE
+    )
+    
+    if fmt == "csv":
+        yield ",".join(RECORD_CSV_FIELDS) + "\r\n"
+    async for record in cursor:
+        if fmt == "csv":
+            yield _csv_line(record)
+        else:
+            yield json.dumps(jsonable_encoder(record), ensure_ascii=False) + "\n"
+
 @router.get("/records")
 async def get_records(
-    authorization: str = Header(...),
+    response: Response,
+    user_id: str = Depends(get_user_id),
     start_date: Optional[str] = Query(default=None),
     end_date: Optional[str] = Query(default=None),
-    limit: int = Query(default=30, le=100)
+    limit: int = Query(default=30, ge=1, le=100),
+    cursor: Optional[str] = Query(default=None, description="上一页返回的 X-Next-Cursor"),
+    format: str = Query(default="json", description="json 分页返回；ndjson/csv 流式导出全部历史")
 ):
-    """获取佩戴记录"""
-    user_id = get_user_id(authorization)
+    """
+    获取佩戴记录（按日期降序）。
+    json 格式按 (user_id, date) 键集分页，下一页游标通过 X-Next-Cursor 响应头返回；
+    ndjson/csv 格式忽略 limit，流式返回从游标开始的全部记录。
+    """
+    if format not in RECORD_FORMATS:
+        raise HTTPException(status_code=400, detail="无效的导出格式")
     
-    query = {"user_id": user_id}
+    query = {"user_id": user_match(user_id)}
     
-    if start_date or end_date:
-        query["date"] = {}
-        if start_date:
-            query["date"]["$gte"] = start_date
-        if end_date:
-            query["date"]["$lte"] = end_date
+    before = None
+    if cursor:
+        after = decode_records_cursor(cursor)
+        if end_date is None or after <= end_date:
+            end_date, before = None, after
+    
+    if format != "json":
+        media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+        filename = f"records.{format}"
+        return StreamingResponse(
+            stream_records(query, format, start_date, end_date, before),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    
+    # 多取一条判断是否还有下一页
+    records = [record async for record in find_sorted_by_date(
+        get_analytics_daily_records_collection(), query, {"_id": 0},
+        start_date, end_date, before, descending=True, limit=limit + 1
+    )]
     
-    records = list(daily_records_collection.find(
-        query,
-        {"_id": 0}
-    ).sort("date", -1).limit(limit))
+    if len(records) > limit:
+        records = records[:limit]
+        response.headers["X-Next-Cursor"] = encode_records_cursor(records[-1]["date"])
     
     return records
 
 @router.get("/achievements")
-async def get_achievements(authorization: str = Header(...)):
-    """获取成就数据"""
-    user_id = get_user_id(authorization)
-    
-    all_records = list(daily_records_collection.find({"user_id": user_id}))
-    current_streak, longest_streak = calculate_streak(all_records)
-    total_completed_days = sum(1 for r in all_records if r.get("completed", False))
-    total_days = len(all_records)
-    total_seconds = sum(r.get("total_seconds", 0) for r in all_records)
+async def get_achievements(request: Request, user_id: str = Depends(get_user_id)):
+    """获取成就数据（支持 If-None-Match）"""
+    return await versioned_response(request, user_id, "achievements", lambda: build_achievements(user_id))
+
+async def build_achievements(user_id: str) -> dict:
+    summary = await get_summary(user_id)
+    total_completed_days = summary["total_completed_days"]
+    total_days = summary["total_days"]
     completion_rate = round(total_completed_days / total_days * 100) if total_days > 0 else 0
     
     return {
-        "current_streak": current_streak,
-        "longest_streak": longest_streak,
+        "current_streak": summary["current_streak"],
+        "longest_streak": summary["longest_streak"],
         "total_completed_days": total_completed_days,
         "total_days": total_days,
-        "total_seconds": total_seconds,
+        "total_seconds": summary["total_seconds"],
         "completion_rate": completion_rate
     }
+
+@router.get("/trends", response_model=TrendStats)
+async def get_trend_stats(request: Request, user_id: str = Depends(get_user_id)):
+    """获取长期趋势：最近90天或整副牙套的滚动平均、星期分布、趋势斜率和每副达标率（支持 If-None-Match）"""
+    async def build():
+        plan = await load_plan(user_id, refresh=True)
+        return await load_trend(user_id, plan)
+    
+    return await versioned_response(request, user_id, "trends", build, lagging_reads=True)
+
+@router.get("/hourly", response_model=HourlyStats)
+async def get_hourly_stats(
+    request: Request,
+    user_id: str = Depends(get_user_id),
+    days: int = Query(default=28, ge=1, le=366, description="统计最近多少天")
+):
+    """获取每小时佩戴分布（时段热力图，支持 If-None-Match）"""
+    return await versioned_response(
+        request, user_id, "hourly", lambda: build_hourly_stats(user_id, days), lagging_reads=True
+    )
+
+async def build_hourly_stats(user_id: str, days: int) -> HourlyStats:
+    plan = await load_plan(user_id, refresh=True)
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=days - 1)
+    start_date = start.strftime("%Y-%m-%d")
+    end_date = end.strftime("%Y-%m-%d")
+    
+    # 跨零点会话的次日部分记在开始当天的记录上，所以多查前一天
+    query_start_date = (start - timedelta(days=1)).strftime("%Y-%m-%d")
+    records = await get_analytics_daily_records_collection().find(
+        {"user_id": user_match(user_id), **day_range_query(query_start_date, end_date)},
+        {"_id": 0, "date": 1, "hourly_seconds": 1, "next_day_hourly_seconds": 1}
+    ).to_list(length=None)
+    records = [from_storage(r) for r in records]
+    
+    # 按实际日历日期的小时和星期几汇总
+    hourly_total = [0] * 24
+    weekday_total = [[0] * 24 for _ in range(7)]
+    for record in records:
+        day = datetime.strptime(record["date"], "%Y-%m-%d")
+        next_day = day + timedelta(days=1)
+        for hours, actual_day in (
+            (record.get("hourly_seconds"), day),
+            (record.get("next_day_hourly_seconds"), next_day),
+        ):
+            if not hours or not start <= actual_day <= end:
+                continue
+            for hour, seconds in enumerate(hours):
+                hourly_total[hour] += seconds
+                weekday_total[actual_day.weekday()][hour] += seconds
+    
+    # 统计范围内每个星期几出现的天数
+    weekday_days = [0] * 7
+    for i in range(days):
+        weekday_days[(start + timedelta(days=i)).weekday()] += 1
+    
+    hourly_rate = [round(seconds / (days * 3600) * 100, 1) for seconds in hourly_total]
+    weekday_hourly_rate = [
+        [round(seconds / (weekday_days[weekday] * 3600) * 100, 1) if weekday_days[weekday] else 0
+         for seconds in weekday_total[weekday]]
+        for weekday in range(7)
+    ]
+    
+    # 夜间理想时段的佩戴比例
+    night_start_time = plan.get("night_start_time", "22:00")
+    night_end_time = plan.get("night_end_time", "07:00")
+    weights = night_hour_weights(night_start_time, night_end_time)
+    night_capacity = sum(weights) * 3600 * days
+    night_worn = sum(seconds * weight for seconds, weight in zip(hourly_total, weights))
+    night_rate = round(night_worn / night_capacity * 100, 1) if night_capacity else 0
+    
+    removal_hours = sorted(sorted(range(24), key=lambda hour: hourly_rate[hour])[:3])
+    
+    return HourlyStats(
+        start_date=start_date,
+        end_date=end_date,
+        days=days,
+        hourly_rate=hourly_rate,
+        weekday_hourly_rate=weekday_hourly_rate,
+        night_start_time=night_start_time,
+        night_end_time=night_end_time,
+        night_rate=night_rate,
+        removal_hours=removal_hours
+    )
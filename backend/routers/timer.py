@@ -1,47 +1,36 @@
-from fastapi import APIRouter, HTTPException, Header
+import asyncio
+import logging
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, WebSocket
 from datetime import datetime, timedelta
 from bson import ObjectId
-from typing import Optional
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from typing import Dict, List, Optional, Tuple
 
-from database import timer_sessions_collection, daily_records_collection, users_collection
-from models import TimerStartRequest, TimerStopRequest, TimerStatusResponse
-from routers.auth import verify_token
+from achievements import record_daily_update
+from database import get_timer_sessions_collection, get_daily_records_collection
+from dependencies import get_user_id, get_fresh_plan, verify_token
+from live_state import (
+    get_target_seconds, load_live_state, read_live_state, today_total_of,
+    claim_session, release_session, record_session_closed
+)
+from models import TimerStartRequest, TimerStopRequest, TimerStatusResponse, TimerSyncRequest
+from push import hub
+from schema import user_key, day_key, user_match, day_match, days_match, from_storage, to_storage
+from session_store import find_closed_session, find_synced_client_ids, move_closed_sessions, buckets_enabled
 
 router = APIRouter(prefix="/timer", tags=["计时"])
+logger = logging.getLogger(__name__)
 
 # 验证常量
 MAX_SESSION_HOURS = 24  # 单次计时最大时长（小时）
 MAX_SESSION_SECONDS = MAX_SESSION_HOURS * 3600
-
-def get_user_id(authorization: str = Header(...)) -> str:
-    """从Header获取用户ID"""
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="无效的Authorization头")
-    token = authorization[7:]
-    return verify_token(token)
+MAX_CLIENT_CLOCK_SKEW = timedelta(minutes=5)  # 离线事件允许的客户端时钟超前量
 
 def get_today_date() -> str:
     """获取今天的日期字符串"""
     return datetime.now().strftime("%Y-%m-%d")
 
-def get_today_total(user_id: str, date: str) -> int:
-    """获取用户今日累计佩戴秒数"""
-    record = daily_records_collection.find_one({"user_id": user_id, "date": date})
-    return record["total_seconds"] if record else 0
-
-def get_target_seconds(user_id: str) -> int:
-    """获取用户目标秒数"""
-    try:
-        if ObjectId.is_valid(user_id):
-            user = users_collection.find_one({"_id": ObjectId(user_id)})
-        else:
-            user = None
-        if user and "plan" in user:
-            return int(user["plan"].get("target_hours", 22) * 3600)
-    except Exception:
-        pass
-    return 22 * 3600
-
 def validate_session_duration(start_time: datetime, end_time: datetime) -> int:
     """验证并计算会话时长，防止异常数据"""
     # 移除时区信息
@@ -65,74 +54,114 @@ def validate_session_duration(start_time: datetime, end_time: datetime) -> int:
     
     return duration
 
-def auto_close_expired_sessions(user_id: str):
-    """自动关闭超时的会话"""
-    # 查找所有未结束且超过24小时的会话
-    cutoff_time = datetime.now() - timedelta(hours=MAX_SESSION_HOURS)
-    
-    expired_sessions = timer_sessions_collection.find({
-        "user_id": user_id,
-        "end_time": None,
-        "start_time": {"$lt": cutoff_time}
-    })
+def split_session_by_hour(start_time: datetime, end_time: datetime) -> Dict[str, List[int]]:
+    """把会话按整点和零点切分，返回 {日期: 24个小时各自的佩戴秒数}"""
+    if start_time.tzinfo is not None:
+        start_time = start_time.replace(tzinfo=None)
+    if end_time.tzinfo is not None:
+        end_time = end_time.replace(tzinfo=None)
     
-    for session in expired_sessions:
-        # 将超时会话按最大时长结算
-        start_time = session["start_time"]
-        if hasattr(start_time, 'tzinfo') and start_time.tzinfo is not None:
-            start_time = start_time.replace(tzinfo=None)
-        
-        end_time = start_time + timedelta(hours=MAX_SESSION_HOURS)
-        duration = MAX_SESSION_SECONDS
-        
-        timer_sessions_collection.update_one(
-            {"_id": session["_id"]},
-            {"$set": {
-                "end_time": end_time,
-                "duration": duration,
-                "auto_closed": True  # 标记为自动关闭
-            }}
-        )
-        
-        # 更新每日记录
-        daily_records_collection.update_one(
-            {"user_id": user_id, "date": session["date"]},
-            {
-                "$inc": {"total_seconds": duration},
-                "$setOnInsert": {"user_id": user_id, "date": session["date"]}
-            },
-            upsert=True
-        )
+    buckets = {}
+    current = start_time
+    elapsed = 0
+    while current < end_time:
+        slice_end = min(current.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1), end_time)
+        # 按累计秒数取整，保证各段之和等于会话时长
+        slice_elapsed = int((slice_end - start_time).total_seconds())
+        hours = buckets.setdefault(current.strftime("%Y-%m-%d"), [0] * 24)
+        hours[current.hour] += slice_elapsed - elapsed
+        elapsed = slice_elapsed
+        current = slice_end
+    return buckets
 
-@router.get("/status", response_model=TimerStatusResponse)
-async def get_timer_status(authorization: str = Header(...)):
-    """获取当前计时状态"""
-    user_id = get_user_id(authorization)
+def add_hourly(total: List[int], hourly: List[int]) -> List[int]:
+    """合并两个24小时分布"""
+    return [a + b for a, b in zip(total, hourly)]
+
+def split_session_hours(start_time: datetime, end_time: datetime) -> Tuple[List[int], Optional[List[int]]]:
+    """
+    会话开始当天的每小时分布，以及跨零点延续到次日的每小时分布（不跨零点时为None）。
+    次日部分记在开始当天的记录上（next_day_hourly_seconds），不为次日单独创建时长为0的记录。
+    """
+    buckets = split_session_by_hour(start_time, end_time)
+    start_date = start_time.strftime("%Y-%m-%d")
+    next_day = None
+    for date in sorted(buckets):
+        if date != start_date:
+            next_day = add_hourly(next_day or [0] * 24, buckets[date])
+    return buckets.get(start_date, [0] * 24), next_day
+
+def _hourly_expression(field: str, hourly: List[int]) -> dict:
+    """更新管道中把24小时分布累加到数组字段的表达式"""
+    return {"$map": {
+        "input": {"$range": [0, 24]},
+        "as": "hour",
+        "in": {"$add": [
+            {"$ifNull": [{"$arrayElemAt": ["$" + field, "$$hour"]}, 0]},
+            {"$arrayElemAt": [{"$literal": hourly}, "$$hour"]}
+        ]}
+    }}
+
+def daily_credit_pipeline(
+    user_id: str,
+    date: str,
+    seconds: int,
+    target_seconds: Optional[int] = None,
+    hourly: Optional[List[int]] = None,
+    next_day_hourly: Optional[List[int]] = None
+) -> list:
+    """累加每日时长（及每小时分布、跨零点延续到次日的分布）的更新管道；给出目标秒数时同时重新计算是否达标"""
+    fields = {
+        "user_id": user_key(user_id),
+        "date": day_key(date),
+        "total_seconds": {"$add": [{"$ifNull": ["$total_seconds", 0]}, seconds]}
+    }
+    if hourly is not None:
+        fields["hourly_seconds"] = _hourly_expression("hourly_seconds", hourly)
+    if next_day_hourly is not None:
+        fields["next_day_hourly_seconds"] = _hourly_expression("next_day_hourly_seconds", next_day_hourly)
+    pipeline = [{"$set": fields}]
+    if target_seconds is not None:
+        pipeline.append({"$set": {"completed": {"$gte": ["$total_seconds", target_seconds]}}})
+    return pipeline
+
+async def credit_daily_record(
+    user_id: str,
+    date: str,
+    seconds: int,
+    target_seconds: Optional[int] = None,
+    hourly: Optional[List[int]] = None,
+    next_day_hourly: Optional[List[int]] = None
+) -> Optional[dict]:
+    """在一次原子更新中累加每日时长，返回更新前的记录（不存在时为None）"""
+    return await get_daily_records_collection().find_one_and_update(
+        {"user_id": user_match(user_id), "date": day_match(date)},
+        daily_credit_pipeline(user_id, date, seconds, target_seconds, hourly, next_day_hourly),
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+
+async def build_timer_status(user_id: str) -> TimerStatusResponse:
+    """根据实时状态构建计时状态"""
     today = get_today_date()
     
-    # 自动关闭超时会话
-    auto_close_expired_sessions(user_id)
-    
-    # 查找进行中的计时会话
-    active_session = timer_sessions_collection.find_one({
-        "user_id": user_id,
-        "end_time": None
-    })
+    # 一次读取实时状态（超时会话由后台清理任务关闭，同一用户的并发读取合并为一次）
+    state = await read_live_state(user_id, today)
     
-    today_total = get_today_total(user_id, today)
-    target_seconds = get_target_seconds(user_id)
+    today_total = today_total_of(state, today)
+    target_seconds = state["target_seconds"]
     
     # 返回服务器时间，用于前端校准
     server_time = datetime.now()
     
-    if active_session:
-        start_time = active_session["start_time"]
+    if state.get("active_session_id"):
+        start_time = state["start_time"]
         if hasattr(start_time, 'tzinfo') and start_time.tzinfo is not None:
             start_time = start_time.replace(tzinfo=None)
         
         return TimerStatusResponse(
             is_wearing=True,
-            session_id=str(active_session["_id"]),
+            session_id=str(state["active_session_id"]),
             start_time=start_time,
             today_total=today_total,
             target_seconds=target_seconds,
@@ -146,42 +175,98 @@ async def get_timer_status(authorization: str = Header(...)):
         server_time=server_time
     )
 
+@router.get("/status", response_model=TimerStatusResponse)
+async def get_timer_status(user_id: str = Depends(get_user_id)):
+    """获取当前计时状态"""
+    return await build_timer_status(user_id)
+
+@router.websocket("/ws")
+async def timer_push(websocket: WebSocket, token: Optional[str] = Query(default=None)):
+    """计时状态推送：连接时发送快照，之后推送状态变更和校时心跳"""
+    authorization = websocket.headers.get("authorization", "")
+    if token is None and authorization.startswith("Bearer "):
+        token = authorization[7:]
+    try:
+        user_id = verify_token(token or "")
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    
+    await websocket.accept()
+    queue = hub.connect(user_id)
+    
+    async def send_messages():
+        status = await build_timer_status(user_id)
+        await websocket.send_json({"type": "snapshot", **status.model_dump(mode="json")})
+        while True:
+            await websocket.send_json(await queue.get())
+    
+    async def receive_messages():
+        # 客户端消息无需处理，仅用于及时发现断开
+        while True:
+            await websocket.receive_text()
+    
+    tasks = [asyncio.create_task(send_messages()), asyncio.create_task(receive_messages())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        hub.disconnect(user_id, queue)
+
 @router.post("/start")
 async def start_timer(
     request: TimerStartRequest = None,
-    authorization: str = Header(...)
+    user_id: str = Depends(get_user_id)
 ):
     """开始计时 - 时间由服务器决定，忽略客户端传入的时间"""
-    user_id = get_user_id(authorization)
     today = get_today_date()
     
-    # 自动关闭超时会话
-    auto_close_expired_sessions(user_id)
-    
-    # 检查是否已有进行中的会话
-    active_session = timer_sessions_collection.find_one({
-        "user_id": user_id,
-        "end_time": None
-    })
-    
-    if active_session:
-        raise HTTPException(status_code=400, detail="已有进行中的计时会话")
-    
     # 使用服务器时间作为开始时间（忽略客户端传入的时间）
     start_time = datetime.now()
+    session_id = ObjectId()
+    timer_sessions_collection = get_timer_sessions_collection()
     
     session = {
+        "_id": session_id,
         "user_id": user_id,
         "start_time": start_time,
         "end_time": None,
         "duration": None,
         "date": today
     }
+    await timer_sessions_collection.insert_one(to_storage(session))
+    
+    # 在实时状态上原子登记会话，防止并发重复开始
+    claimed = await claim_session(user_id, session_id, start_time)
+    if not claimed:
+        # 首次使用时实时状态由原始集合构建，会直接登记刚写入的会话；
+        # 登记的会话也可能已被其他途径结束，清理后重试一次
+        active_id = (await load_live_state(user_id, today)).get("active_session_id")
+        if active_id == session_id:
+            claimed = True
+        elif active_id is not None and not await timer_sessions_collection.find_one(
+            {"_id": active_id, "end_time": None}
+        ):
+            await release_session(user_id, active_id)
+            claimed = await claim_session(user_id, session_id, start_time)
     
-    result = timer_sessions_collection.insert_one(session)
+    if not claimed:
+        await timer_sessions_collection.delete_one({"_id": session_id})
+        raise HTTPException(status_code=400, detail="已有进行中的计时会话")
+    
+    await hub.publish(user_id, {
+        "type": "delta",
+        "event": "started",
+        "is_wearing": True,
+        "session_id": str(session_id),
+        "start_time": start_time,
+        "server_time": start_time
+    })
     
     return {
-        "session_id": str(result.inserted_id),
+        "session_id": str(session_id),
         "start_time": start_time,
         "server_time": start_time,  # 返回服务器时间供前端同步
         "status": "started"
@@ -190,78 +275,348 @@ async def start_timer(
 @router.post("/stop")
 async def stop_timer(
     request: TimerStopRequest,
-    authorization: str = Header(...)
+    user_id: str = Depends(get_user_id),
+    plan: dict = Depends(get_fresh_plan),
+    idempotency_key: Optional[str] = Header(default=None)
 ):
-    """停止计时 - 时间由服务器决定"""
+    """停止计时 - 时间由服务器决定；携带相同 Idempotency-Key 的重试返回同一结果"""
     try:
-        user_id = get_user_id(authorization)
-        
         # 验证 session_id 格式
         if not ObjectId.is_valid(request.session_id):
             raise HTTPException(status_code=400, detail="无效的会话ID格式")
         
-        # 查找会话
-        session = timer_sessions_collection.find_one({
-            "_id": ObjectId(request.session_id),
-            "user_id": user_id
-        })
-        
-        if not session:
-            raise HTTPException(status_code=404, detail="计时会话不存在")
-        
-        if session["end_time"] is not None:
-            raise HTTPException(status_code=400, detail="计时会话已结束")
+        session_id = ObjectId(request.session_id)
+        timer_sessions_collection = get_timer_sessions_collection()
         
-        # 使用服务器时间作为结束时间
+        # 使用服务器时间作为结束时间，仅结束未结束且未超时的会话（原子操作）
         end_time = datetime.now()
-        start_time = session["start_time"]
-        
-        # 验证并计算时长
-        duration = validate_session_duration(start_time, end_time)
-        
-        # 更新会话
-        timer_sessions_collection.update_one(
-            {"_id": ObjectId(request.session_id)},
-            {"$set": {
-                "end_time": end_time,
-                "duration": duration
-            }}
-        )
-        
-        # 更新今日记录
-        today = session["date"]
-        daily_records_collection.update_one(
-            {"user_id": user_id, "date": today},
+        session = await timer_sessions_collection.find_one_and_update(
             {
-                "$inc": {"total_seconds": duration},
-                "$setOnInsert": {"user_id": user_id, "date": today}
+                "_id": session_id,
+                "user_id": user_match(user_id),
+                "end_time": None,
+                "start_time": {
+                    "$gte": end_time - timedelta(seconds=MAX_SESSION_SECONDS),
+                    "$lte": end_time
+                }
             },
-            upsert=True
+            [{"$set": {
+                "end_time": end_time,
+                "duration": {"$toInt": {"$floor": {
+                    "$divide": [{"$subtract": [end_time, "$start_time"]}, 1000]
+                }}},
+                "stop_key": idempotency_key
+            }}],
+            return_document=ReturnDocument.AFTER
         )
         
-        # 获取更新后的今日总时长
-        today_total = get_today_total(user_id, today)
-        target_seconds = get_target_seconds(user_id)
+        if session is None:
+            return await _stop_rejected(user_id, session_id, end_time, idempotency_key)
+        from_storage(session)
+        
+        # 一次更新累加今日时长并重新计算是否达标
+        today = session["date"]
+        duration = session["duration"]
+        target_seconds = get_target_seconds(plan)
+        hourly, next_day_hourly = split_session_hours(session["start_time"], session["end_time"])
+        previous = await credit_daily_record(user_id, today, duration, target_seconds, hourly, next_day_hourly)
         
-        # 检查是否达标并更新
+        today_total = (previous["total_seconds"] if previous else 0) + duration
         completed = today_total >= target_seconds
-        daily_records_collection.update_one(
-            {"user_id": user_id, "date": today},
-            {"$set": {"completed": completed}}
+        
+        # 增量更新成就汇总，清除实时状态中的会话，分桶模式下把会话移入桶
+        await asyncio.gather(
+            record_daily_update(user_id, today, previous, completed, duration),
+            record_session_closed(user_id, session_id, today, today_total),
+            move_closed_sessions([session])
         )
         
+        server_time = datetime.now()
+        await hub.publish(user_id, {
+            "type": "delta",
+            "event": "stopped",
+            "is_wearing": False,
+            "session_id": request.session_id,
+            "date": today,
+            "today_total": today_total,
+            "completed": completed,
+            "server_time": server_time
+        })
+        
         return {
             "session_id": request.session_id,
             "duration": duration,
             "today_total": today_total,
             "completed": completed,
             "status": "stopped",
-            "server_time": datetime.now()  # 返回服务器时间
+            "server_time": server_time  # 返回服务器时间
         }
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        print(f"stop_timer error: {e}")
-        traceback.print_exc()
+        logger.exception("停止计时失败: session_id=%s", request.session_id)
         raise HTTPException(status_code=500, detail=str(e))
+
+async def _stop_rejected(
+    user_id: str,
+    session_id: ObjectId,
+    end_time: datetime,
+    idempotency_key: Optional[str]
+) -> dict:
+    """会话未能结束时确定原因：重复请求返回原结果，否则返回对应错误"""
+    session = await get_timer_sessions_collection().find_one({"_id": session_id, "user_id": user_match(user_id)})
+    if session:
+        from_storage(session)
+    elif buckets_enabled():
+        # 已结束的会话可能已移入桶；能结束的会话最多开始于 MAX_SESSION_HOURS 之前
+        session = await find_closed_session(user_id, session_id, end_time - timedelta(seconds=MAX_SESSION_SECONDS))
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="计时会话不存在")
+    
+    if session["end_time"] is not None:
+        if idempotency_key and session.get("stop_key") == idempotency_key:
+            record = await get_daily_records_collection().find_one(
+                {"user_id": user_match(user_id), "date": day_match(session["date"])}
+            ) or {}
+            return {
+                "session_id": str(session_id),
+                "duration": session["duration"],
+                "today_total": record.get("total_seconds", 0),
+                "completed": record.get("completed", False),
+                "status": "stopped",
+                "server_time": datetime.now()
+            }
+        raise HTTPException(status_code=400, detail="计时会话已结束")
+    
+    # 时长异常时抛出对应错误
+    validate_session_duration(session["start_time"], end_time)
+    raise HTTPException(status_code=409, detail="计时会话状态已变化，请重试")
+
+def to_server_time(value: datetime) -> datetime:
+    """客户端时间转换为服务器本地时间（不带时区，与服务器记录一致）"""
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+@router.post("/sync")
+async def sync_offline_events(
+    request: TimerSyncRequest,
+    user_id: str = Depends(get_user_id),
+    plan: dict = Depends(get_fresh_plan)
+):
+    """批量同步离线期间记录的开始/停止事件（按 client_id 去重）"""
+    now = datetime.now()
+    today = get_today_date()
+    target_seconds = get_target_seconds(plan)
+    timer_sessions_collection = get_timer_sessions_collection()
+    daily_records_collection = get_daily_records_collection()
+    client_ids = [event.client_id for event in request.events]
+    
+    # 并发读取实时状态和已同步过的事件
+    state, synced_sessions = await asyncio.gather(
+        load_live_state(user_id, today),
+        timer_sessions_collection.find(
+            {"user_id": user_match(user_id), "$or": [
+                {"client_start_id": {"$in": client_ids}},
+                {"client_stop_id": {"$in": client_ids}}
+            ]},
+            {"client_start_id": 1, "client_stop_id": 1}
+        ).to_list(length=None)
+    )
+    seen = {s.get(key) for s in synced_sessions for key in ("client_start_id", "client_stop_id")}
+    if buckets_enabled():
+        seen |= await find_synced_client_ids(
+            user_id, client_ids, [to_server_time(event.time) for event in request.events]
+        )
+    
+    # 服务器上进行中的会话
+    server_session = None
+    if state.get("active_session_id"):
+        start_time = state["start_time"]
+        server_session = {
+            "_id": state["active_session_id"],
+            "user_id": user_id,
+            "start_time": start_time,
+            "date": start_time.strftime("%Y-%m-%d")
+        }
+    
+    # 按顺序回放事件
+    results = []
+    new_sessions = []
+    session_events = {}  # 会话ID -> 对应事件结果的下标
+    open_session = server_session
+    server_session_closed = False
+    
+    def reject(event, detail):
+        results.append({"client_id": event.client_id, "status": "rejected", "detail": detail})
+    
+    for event in request.events:
+        if event.client_id in seen:
+            results.append({"client_id": event.client_id, "status": "duplicate"})
+            continue
+        seen.add(event.client_id)
+        
+        event_time = to_server_time(event.time)
+        if event_time > now + MAX_CLIENT_CLOCK_SKEW:
+            reject(event, "事件时间晚于服务器时间")
+            continue
+        event_time = min(event_time, now)
+        
+        if event.type == "start":
+            if open_session is not None:
+                reject(event, "已有进行中的计时会话")
+                continue
+            open_session = {
+                "_id": ObjectId(),
+                "user_id": user_id,
+                "start_time": event_time,
+                "end_time": None,
+                "duration": None,
+                "date": event_time.strftime("%Y-%m-%d"),
+                "client_start_id": event.client_id
+            }
+            new_sessions.append(open_session)
+        else:
+            if open_session is None:
+                reject(event, "没有进行中的计时会话")
+                continue
+            try:
+                duration = validate_session_duration(open_session["start_time"], event_time)
+            except HTTPException as e:
+                reject(event, e.detail)
+                continue
+            open_session.update({
+                "end_time": event_time,
+                "duration": duration,
+                "client_stop_id": event.client_id
+            })
+            if open_session is server_session:
+                server_session_closed = True
+        
+        session_events.setdefault(open_session["_id"], []).append(len(results))
+        results.append({
+            "client_id": event.client_id,
+            "status": "applied",
+            "session_id": str(open_session["_id"])
+        })
+        if event.type == "stop":
+            open_session = None
+    
+    # 一次批量写入会话
+    operations = [InsertOne(to_storage(session)) for session in new_sessions]
+    if server_session_closed:
+        operations.append(UpdateOne(
+            {"_id": server_session["_id"], "end_time": None},
+            {"$set": {
+                "end_time": server_session["end_time"],
+                "duration": server_session["duration"],
+                "client_stop_id": server_session["client_stop_id"]
+            }}
+        ))
+    
+    failed = {}
+    modified_count = 0
+    if operations:
+        try:
+            result = await timer_sessions_collection.bulk_write(operations, ordered=False)
+            modified_count = result.modified_count
+        except BulkWriteError as e:
+            modified_count = e.details.get("nModified", 0)
+            for error in e.details.get("writeErrors", []):
+                # 11000: 并发同步已写入相同的 client_id
+                failed[error["index"]] = "duplicate" if error.get("code") == 11000 else "rejected"
+    if server_session_closed and modified_count == 0:
+        failed[len(operations) - 1] = "rejected"
+    
+    written = []
+    for index, session in enumerate(new_sessions + ([server_session] if server_session_closed else [])):
+        if index in failed:
+            for i in session_events[session["_id"]]:
+                results[i] = {"client_id": results[i]["client_id"], "status": failed[index]}
+                if failed[index] == "rejected":
+                    results[i]["detail"] = "计时会话状态已变化，请重试"
+        else:
+            written.append(session)
+    
+    # 按日期汇总已结束会话的时长和每小时分布，一次批量写入每日记录
+    credited = {}
+    hourly = {}
+    next_day_hourly = {}
+    for session in written:
+        if session["end_time"] is not None:
+            date = session["date"]
+            credited[date] = credited.get(date, 0) + session["duration"]
+            same_day, next_day = split_session_hours(session["start_time"], session["end_time"])
+            hourly[date] = add_hourly(hourly.get(date, [0] * 24), same_day)
+            if next_day is not None:
+                next_day_hourly[date] = add_hourly(next_day_hourly.get(date, [0] * 24), next_day)
+    
+    totals = {}
+    if credited:
+        previous_records = {
+            from_storage(r)["date"]: r
+            async for r in daily_records_collection.find(
+                {"user_id": user_match(user_id), "date": days_match(list(credited))},
+                {"_id": 0, "date": 1, "total_seconds": 1, "completed": 1}
+            )
+        }
+        await daily_records_collection.bulk_write([
+            UpdateOne(
+                {"user_id": user_match(user_id), "date": day_match(date)},
+                daily_credit_pipeline(
+                    user_id, date, seconds, target_seconds, hourly.get(date), next_day_hourly.get(date)
+                ),
+                upsert=True
+            )
+            for date, seconds in credited.items()
+        ], ordered=False)
+        
+        for date in sorted(credited):
+            previous = previous_records.get(date)
+            totals[date] = (previous["total_seconds"] if previous else 0) + credited[date]
+            completed = totals[date] >= target_seconds
+            await record_daily_update(user_id, date, previous, completed, credited[date])
+    
+    # 刷新实时状态：结束服务器上的会话、更新最新日期累计、登记新的进行中会话
+    if totals:
+        latest_date = max(totals)
+        await record_session_closed(
+            user_id,
+            server_session["_id"] if server_session_closed else None,
+            latest_date,
+            totals[latest_date]
+        )
+    
+    is_wearing = bool(state.get("active_session_id")) and not (
+        server_session_closed and server_session in written
+    )
+    active_session_id = state.get("active_session_id") if is_wearing else None
+    
+    if open_session is not None and open_session is not server_session and open_session in written:
+        if await claim_session(user_id, open_session["_id"], open_session["start_time"]):
+            is_wearing = True
+            active_session_id = open_session["_id"]
+        else:
+            # 期间已在线开始了其他会话
+            await timer_sessions_collection.delete_one({"_id": open_session["_id"]})
+            for i in session_events[open_session["_id"]]:
+                results[i] = {
+                    "client_id": results[i]["client_id"],
+                    "status": "rejected",
+                    "detail": "已有进行中的计时会话"
+                }
+    
+    await move_closed_sessions(written)
+    
+    server_time = datetime.now()
+    if written:
+        await hub.publish(user_id, {"type": "delta", "event": "synced", "server_time": server_time})
+    
+    return {
+        "results": results,
+        "is_wearing": is_wearing,
+        "session_id": str(active_session_id) if active_session_id else None,
+        "today_total": totals.get(today, today_total_of(state, today)),
+        "server_time": server_time
+    }
@@ -0,0 +1,398 @@
+"""
+记录存储格式 - timer_sessions 和 daily_records 中 user_id / date 字段的存储形式（RECORD_SCHEMA）。
+
+    string   旧格式：user_id 为24位十六进制字符串，date 为 "YYYY-MM-DD"
+    compact  紧凑格式：user_id 为 ObjectId，date 为自1970-01-01起的天数（整数）
+    mixed    迁移期间：写入紧凑格式（更新时顺带转换旧文档），读取同时匹配两种格式
+
+应用内部始终使用字符串形式的用户ID和日期：写入前用 user_key / day_key 转换，
+查询条件用 user_match / day_match / day_range_query 生成，读出的文档用 from_storage 还原，接口返回值不变。
+
+在线迁移步骤：所有进程改为 RECORD_SCHEMA=mixed 并重启 -> python schema.py migrate -> 全部改为 compact。
+
+用法:
+    python schema.py migrate [--batch-size 1000]     按批把旧格式文档转换为紧凑格式（可中断后重复运行）
+    python schema.py rollback [--batch-size 1000]    按批转换回旧格式（回退到 string 前运行，需 mixed）
+    python schema.py sizes                           当前集合的文档数、平均大小、存储和各索引大小
+    python schema.py compare --users 200 --days 365  在临时集合上对比两种格式的存储和索引大小
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from config import RECORD_SCHEMA
+from database import get_db, close_client
+
+SCHEMAS = ("string", "mixed", "compact")
+if RECORD_SCHEMA not in SCHEMAS:
+    raise ValueError(f"无效的 RECORD_SCHEMA: {RECORD_SCHEMA}")
+
+EPOCH = date(1970, 1, 1)
+MS_PER_DAY = 24 * 3600 * 1000
+DUPLICATE_KEY = 11000
+RECORD_COLLECTIONS = ("timer_sessions", "daily_records")
+
+def compact_writes() -> bool:
+    return RECORD_SCHEMA != "string"
+
+def day_number(value: str) -> int:
+    """YYYY-MM-DD -> 自1970-01-01起的天数"""
+    return (date.fromisoformat(value) - EPOCH).days
+
+def day_string(day: int) -> str:
+    return (EPOCH + timedelta(days=day)).isoformat()
+
+def user_key(user_id: str):
+    """写入时的用户ID"""
+    return ObjectId(user_id) if compact_writes() else user_id
+
+def day_key(value: str):
+    """写入时的日期"""
+    return day_number(value) if compact_writes() else value
+
+def user_match(user_id: str):
+    """按用户查询的条件值"""
+    if RECORD_SCHEMA == "mixed":
+        return {"$in": [ObjectId(user_id), user_id]}
+    return user_key(user_id)
+
+def users_match(user_ids: List[str]) -> dict:
+    values = []
+    for user_id in user_ids:
+        if RECORD_SCHEMA != "string":
+            values.append(ObjectId(user_id))
+        if RECORD_SCHEMA != "compact":
+            values.append(user_id)
+    return {"$in": values}
+
+def day_match(value: str):
+    """按单个日期查询的条件值"""
+    if RECORD_SCHEMA == "mixed":
+        return {"$in": [day_number(value), value]}
+    return day_key(value)
+
+def days_match(values: List[str]) -> dict:
+    forms = []
+    for value in values:
+        if RECORD_SCHEMA != "string":
+            forms.append(day_number(value))
+        if RECORD_SCHEMA != "compact":
+            forms.append(value)
+    return {"$in": forms}
+
+def day_conditions(start: Optional[str] = None, end: Optional[str] = None,
+                   before: Optional[str] = None) -> List[Optional[dict]]:
+    """
+    日期范围在每种可读格式下的条件（start <= date <= end，date < before），None 表示不限制。
+    mixed 下返回两项，分别只匹配整数和字符串（比较运算只匹配同类型的值）。
+    """
+    conditions = []
+    if RECORD_SCHEMA != "string":
+        condition = {}
+        if start:
+            condition["$gte"] = day_number(start)
+        if end:
+            condition["$lte"] = day_number(end)
+        if before:
+            condition["$lt"] = day_number(before)
+        conditions.append(condition or ({"$type": "number"} if RECORD_SCHEMA == "mixed" else None))
+    if RECORD_SCHEMA != "compact":
+        condition = {}
+        if start:
+            condition["$gte"] = start
+        if end:
+            condition["$lte"] = end
+        if before:
+            condition["$lt"] = before
+        conditions.append(condition or ({"$type": "string"} if RECORD_SCHEMA == "mixed" else None))
+    return conditions
+
+def day_range_query(start: Optional[str] = None, end: Optional[str] = None, before: Optional[str] = None,
+                    field: str = "date") -> dict:
+    """合并到查询中的日期范围条件（mixed 下为 $or）"""
+    conditions = [c for c in day_conditions(start, end, before) if c is not None]
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return {field: conditions[0]}
+    return {"$or": [{field: c} for c in conditions]}
+
+def from_storage(doc: dict) -> dict:
+    """读出的文档还原为字符串形式的 user_id / date（原地修改并返回）"""
+    if isinstance(doc.get("user_id"), ObjectId):
+        doc["user_id"] = str(doc["user_id"])
+    if isinstance(doc.get("date"), int):
+        doc["date"] = day_string(doc["date"])
+    return doc
+
+def to_storage(doc: dict, compact: Optional[bool] = None) -> dict:
+    """字符串形式的文档转换为写入格式（返回新文档）"""
+    compact = compact_writes() if compact is None else compact
+    doc = dict(doc)
+    if compact:
+        if isinstance(doc.get("user_id"), str):
+            doc["user_id"] = ObjectId(doc["user_id"])
+        if isinstance(doc.get("date"), str):
+            doc["date"] = day_number(doc["date"])
+    return doc
+
+def user_expression(field: str, string_id, object_id) -> dict:
+    """聚合表达式中按用户匹配（$lookup 中分别传入字符串和 ObjectId 形式的用户ID变量）"""
+    if RECORD_SCHEMA == "string":
+        return {"$eq": [field, string_id]}
+    if RECORD_SCHEMA == "compact":
+        return {"$eq": [field, object_id]}
+    return {"$in": [field, [object_id, string_id]]}
+
+def date_string_expression(field: str = "$date") -> dict:
+    """聚合管道中把日期字段转换为 YYYY-MM-DD 字符串的表达式"""
+    converted = {"$dateToString": {"format": "%Y-%m-%d", "date": {"$toDate": {"$multiply": [field, MS_PER_DAY]}}}}
+    if RECORD_SCHEMA == "string":
+        return field
+    if RECORD_SCHEMA == "compact":
+        return converted
+    return {"$cond": [{"$isNumber": field}, converted, field]}
+
+def day_number_expression(field: str = "$date") -> dict:
+    """聚合管道中把日期字段转换为天数的表达式"""
+    parsed = {"$floor": {"$divide": [
+        {"$toLong": {"$dateFromString": {"dateString": field, "format": "%Y-%m-%d"}}}, MS_PER_DAY
+    ]}}
+    if RECORD_SCHEMA == "compact":
+        return field
+    if RECORD_SCHEMA == "string":
+        return parsed
+    return {"$cond": [{"$isNumber": field}, field, parsed]}
+
+async def merge_sorted(iterators: List[AsyncIterator[dict]], key: Callable[[dict], str],
+                       reverse: bool = False) -> AsyncIterator[dict]:
+    """合并各自已排序的异步游标（mixed 下两种格式分别排序后合并）"""
+    heads = []
+    for iterator in iterators:
+        doc = await anext(iterator, None)
+        if doc is not None:
+            heads.append([doc, iterator])
+    while heads:
+        pick = (max if reverse else min)(heads, key=lambda head: key(head[0]))
+        yield pick[0]
+        doc = await anext(pick[1], None)
+        if doc is None:
+            heads.remove(pick)
+        else:
+            pick[0] = doc
+
+async def find_sorted_by_date(collection, query: dict, projection: Optional[dict], start: Optional[str] = None,
+                              end: Optional[str] = None, before: Optional[str] = None, descending: bool = False,
+                              limit: int = 0, batch_size: int = 0) -> AsyncIterator[dict]:
+    """按日期排序读取（每种格式一个游标再合并），返回的文档已还原为字符串形式"""
+    direction = -1 if descending else 1
+    cursors = []
+    for condition in day_conditions(start, end, before):
+        form_query = dict(query)
+        if condition is not None:
+            form_query["date"] = condition
+        cursor = collection.find(form_query, projection).sort("date", direction)
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        cursors.append(cursor)
+
+    async def normalized(cursor):
+        async for doc in cursor:
+            yield from_storage(doc)
+
+    count = 0
+    async for doc in merge_sorted([normalized(c) for c in cursors], key=lambda d: d["date"], reverse=descending):
+        yield doc
+        count += 1
+        if limit and count >= limit:
+            return
+
+# ---------------- 迁移 ----------------
+
+def _converted_fields(doc: dict, compact: bool) -> dict:
+    normalized = from_storage({"user_id": doc["user_id"], "date": doc["date"]})
+    return to_storage(normalized, True) if compact else normalized
+
+async def _merge_daily_record(collection, legacy: dict, compact: bool) -> Optional[str]:
+    """转换后与已存在的同日记录冲突（迁移期间另一格式已写入）：把旧文档合并进去后删除，返回用户ID"""
+    fields = _converted_fields(legacy, compact)
+    existing = await collection.find_one(fields)
+    if existing is None:
+        return None
+    merged = {
+        "total_seconds": existing.get("total_seconds", 0) + legacy.get("total_seconds", 0),
+        "completed": bool(existing.get("completed") or legacy.get("completed")),
+    }
+    for field in ("hourly_seconds", "next_day_hourly_seconds"):
+        hourly = existing.get(field)
+        if legacy.get(field):
+            hourly = [a + b for a, b in zip(hourly or [0] * 24, legacy[field])]
+        if hourly is not None:
+            merged[field] = hourly
+    await collection.bulk_write([
+        UpdateOne({"_id": existing["_id"]}, {"$set": merged}),
+        DeleteOne({"_id": legacy["_id"]}),
+    ], ordered=True)
+    return str(fields["user_id"])
+
+async def convert_collection(name: str, compact: bool, batch_size: int, duty_cycle: float) -> Dict[str, int]:
+    """按批转换一个集合中另一格式的文档；只更新仍是旧值的文档，并发写入已转换的会被跳过"""
+    collection = get_db()[name]
+    source_type = "string" if compact else "objectId"
+    counts = {"converted": 0, "merged": 0, "skipped": 0}
+    merged_users = set()
+    while True:
+        started = time.perf_counter()
+        # 已标记冲突的文档留给人工处理，不再重复选中
+        docs = await collection.find(
+            {"user_id": {"$type": source_type}, "schema_conflict": {"$ne": True}}
+        ).limit(batch_size).to_list(length=None)
+        if not docs:
+            break
+        operations = [
+            UpdateOne({"_id": doc["_id"], "user_id": doc["user_id"]}, {"$set": _converted_fields(doc, compact)})
+            for doc in docs
+        ]
+        try:
+            result = await collection.bulk_write(operations, ordered=False)
+            counts["converted"] += result.modified_count
+        except BulkWriteError as e:
+            counts["converted"] += e.details.get("nModified", 0)
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") != DUPLICATE_KEY:
+                    raise
+                doc = docs[error["index"]]
+                user_id = await _merge_daily_record(collection, doc, compact) if name == "daily_records" else None
+                if user_id:
+                    counts["merged"] += 1
+                    merged_users.add(user_id)
+                else:
+                    # 会话的离线事件ID冲突：两种格式下各有一份，保留已转换的那份
+                    counts["skipped"] += 1
+                    await collection.update_one({"_id": doc["_id"]}, {"$set": {"schema_conflict": True}})
+        print(f"  {name}: 已转换 {counts['converted']}, 合并 {counts['merged']}, 冲突 {counts['skipped']}")
+
+        if duty_cycle < 1:
+            await asyncio.sleep((time.perf_counter() - started) * (1 - duty_cycle) / duty_cycle)
+
+    if counts["skipped"]:
+        print(f"  {name}: {counts['skipped']} 个文档带 schema_conflict 标记，需人工处理")
+    if merged_users:
+        from achievements import rebuild_summary
+        for user_id in merged_users:
+            await rebuild_summary(user_id)
+    return counts
+
+async def collection_sizes(name: str) -> dict:
+    stats = await get_db().command("collStats", name)
+    return {
+        "count": stats["count"],
+        "avg": stats.get("avgObjSize", 0),
+        "size": stats["size"],
+        "storage": stats.get("storageSize", 0),
+        "indexes": stats.get("totalIndexSize", 0),
+        "index_sizes": stats.get("indexSizes", {}),
+    }
+
+def print_sizes(rows: Dict[str, dict]):
+    print(f"{'集合':<34}{'文档数':>10}{'平均(B)':>9}{'数据(KB)':>11}{'存储(KB)':>11}{'索引(KB)':>11}")
+    for name, stats in rows.items():
+        print(f"{name:<34}{stats['count']:>10}{stats['avg']:>9.0f}{stats['size'] / 1024:>11.0f}"
+              f"{stats['storage'] / 1024:>11.0f}{stats['indexes'] / 1024:>11.0f}")
+        for index, size in stats["index_sizes"].items():
+            print(f"    {index:<30}{size / 1024:>52.0f}")
+
+async def compare(users: int, days: int, keep: bool):
+    """在临时集合中写入相同的会话和每日记录，对比两种格式的大小（索引与正式集合相同）"""
+    from loadtest import generate_history
+
+    db = get_db()
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=days)
+    collections = {}
+    for schema in ("string", "compact"):
+        for name in RECORD_COLLECTIONS:
+            collection = db[f"bench_{name}_{schema}"]
+            await collection.drop()
+            unique = name == "daily_records"
+            await collection.create_index([("user_id", 1), ("date", 1)], unique=unique)
+            collections[(schema, name)] = collection
+
+    for index in range(users):
+        sessions, records = generate_history(random.Random(index), str(ObjectId()), start, end, 0.9, 22 * 3600)
+        for schema in ("string", "compact"):
+            compact = schema == "compact"
+            if sessions:
+                await collections[(schema, "timer_sessions")].insert_many(
+                    [to_storage(s, compact) for s in sessions], ordered=False
+                )
+            if records:
+                await collections[(schema, "daily_records")].insert_many(
+                    [to_storage(r, compact) for r in records], ordered=False
+                )
+
+    print(f"{users} 个用户 x {days} 天")
+    print_sizes({c.name: await collection_sizes(c.name) for c in collections.values()})
+    if not keep:
+        for collection in collections.values():
+            await collection.drop()
+
+async def _convert(args, compact: bool):
+    if RECORD_SCHEMA != "mixed" and not args.force:
+        print("请先把所有应用进程的 RECORD_SCHEMA 改为 mixed 并重启（或使用 --force）")
+        return
+    before = {name: await collection_sizes(name) for name in RECORD_COLLECTIONS}
+    for name in RECORD_COLLECTIONS:
+        counts = await convert_collection(name, compact, args.batch_size, args.duty_cycle)
+        print(f"{name}: {counts}")
+    after = {name: await collection_sizes(name) for name in RECORD_COLLECTIONS}
+    print("转换前:")
+    print_sizes(before)
+    print("转换后（存储空间在 WiredTiger 复用或 compact 后才会缩小，索引随页面重写逐步变小）:")
+    print_sizes(after)
+    print(f"完成，可以把 RECORD_SCHEMA 改为 {'compact' if compact else 'string'}")
+
+async def _run(args):
+    try:
+        if args.command == "migrate":
+            await _convert(args, True)
+        elif args.command == "rollback":
+            await _convert(args, False)
+        elif args.command == "sizes":
+            print_sizes({name: await collection_sizes(name) for name in RECORD_COLLECTIONS})
+        else:
+            await compare(args.users, args.days, args.keep)
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="记录存储格式迁移和大小对比")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (("migrate", "转换为紧凑格式"), ("rollback", "转换回旧格式")):
+        convert_parser = subparsers.add_parser(command, help=help_text)
+        convert_parser.add_argument("--batch-size", type=int, default=1000)
+        convert_parser.add_argument("--duty-cycle", type=float, default=0.5,
+                                    help="工作时间占比，每批之后按比例休眠，1 为不休眠")
+        convert_parser.add_argument("--force", action="store_true", help="RECORD_SCHEMA 不是 mixed 时也执行")
+    subparsers.add_parser("sizes", help="当前集合大小")
+    compare_parser = subparsers.add_parser("compare", help="在临时集合上对比两种格式")
+    compare_parser.add_argument("--users", type=int, default=200)
+    compare_parser.add_argument("--days", type=int, default=365)
+    compare_parser.add_argument("--keep", action="store_true", help="保留临时集合")
+
+    args = parser.parse_args()
+    if getattr(args, "duty_cycle", 1) <= 0 or getattr(args, "duty_cycle", 1) > 1:
+        parser.error("--duty-cycle 应在 (0, 1] 之间")
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
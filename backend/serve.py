@@ -0,0 +1,313 @@
+"""
+多进程服务 - 主进程绑定端口并管理 N 个 uvicorn 工作进程，支持逐个平滑重启。
+
+工作进程以 spawn 方式启动（不继承主进程的任何连接），各自在 lifespan 中创建数据库客户端并在退出时关闭。
+索引由主进程在启动工作进程前创建一次，工作进程不再重复创建；超时会话清理只在第0号工作进程中运行。
+计时推送和数据版本需要跨进程可见，多进程部署时请配置 PUSH_BROKER_URL。
+用户缓存是每个进程各自的：某个进程更新计划后，其他进程的缓存最多在 USER_CACHE_TTL_SECONDS 内仍是旧计划；
+计算是否达标的写入路径（/timer/stop、/timer/sync）和统计接口因此总是从数据库读取计划。
+
+信号:
+    SIGHUP            逐个重启工作进程：新进程就绪后旧进程才开始退出，旧进程处理完进行中的请求后结束
+    SIGTERM / SIGINT  所有工作进程处理完进行中的请求（最多 SERVE_GRACEFUL_TIMEOUT 秒）后退出
+
+用法:
+    python serve.py run                         按CPU核数启动工作进程，监听 0.0.0.0:8000
+    python serve.py run --workers 4 --port 8080
+    python serve.py bench                       对比 1..N 个工作进程的吞吐（默认请求 /health）
+    python serve.py bench --path /api/stats/weekly --header "Authorization: Bearer <token>"
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import httpx
+import uvicorn
+
+from config import SERVE_WORKERS, SERVE_GRACEFUL_TIMEOUT, PUSH_BROKER_URL
+from database import ensure_indexes, close_client
+
+logger = logging.getLogger("serve")
+
+multiprocessing.allow_connection_pickling()
+spawn = multiprocessing.get_context("spawn")
+
+RESPAWN_DELAY_SECONDS = 1.0
+READY_TIMEOUT_SECONDS = 60
+
+def default_workers() -> int:
+    return SERVE_WORKERS or os.cpu_count() or 1
+
+@contextmanager
+def _environ(overrides: Dict[str, str]):
+    """临时设置环境变量（spawn 的子进程在启动时复制当前环境，config.py 在子进程中重新读取）"""
+    saved = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+class _WorkerServer(uvicorn.Server):
+    """启动完成后通知主进程的 uvicorn 服务"""
+
+    def __init__(self, config: uvicorn.Config, ready):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            self.ready.set()
+
+def _worker(sock: socket.socket, ready, log_level: str):
+    config = uvicorn.Config(
+        "main:app",
+        log_level=log_level,
+        timeout_graceful_shutdown=SERVE_GRACEFUL_TIMEOUT,
+    )
+    config.configure_logging()
+    _WorkerServer(config, ready).run(sockets=[sock])
+
+class Supervisor:
+    """管理工作进程：按槽位启动、异常退出时重新启动、收到 SIGHUP 时逐个替换"""
+
+    def __init__(self, sock: socket.socket, workers: int, log_level: str):
+        self.sock = sock
+        self.workers = workers
+        self.log_level = log_level
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        # 就绪事件需保留到子进程读取启动参数之后
+        self.ready_events: Dict[int, object] = {}
+        self.should_exit = False
+        self.restart_requested = False
+
+    def spawn(self, slot: int):
+        ready = spawn.Event()
+        # 清理任务只在第0号工作进程中运行，索引已由主进程创建
+        overrides = {"ENSURE_INDEXES_ON_STARTUP": "false"}
+        if slot != 0:
+            overrides["SWEEPER_ENABLED"] = "false"
+        with _environ(overrides):
+            process = spawn.Process(target=_worker, args=(self.sock, ready, self.log_level), name=f"worker-{slot}")
+            process.start()
+        self.ready_events[slot] = ready
+        return process, ready
+
+    def stop_process(self, process: multiprocessing.Process):
+        """SIGTERM 让 uvicorn 停止接受新连接并等待进行中的请求，超时后强制结束"""
+        if process.is_alive():
+            process.terminate()
+        process.join(SERVE_GRACEFUL_TIMEOUT + 5)
+        if process.is_alive():
+            logger.warning("工作进程 %s 未按时退出，强制结束", process.pid)
+            process.kill()
+            process.join()
+
+    def rolling_restart(self):
+        logger.info("逐个重启 %d 个工作进程", len(self.processes))
+        for slot in sorted(self.processes):
+            if self.should_exit:
+                return
+            process, ready = self.spawn(slot)
+            if not ready.wait(READY_TIMEOUT_SECONDS):
+                # 新进程没有就绪（例如代码有错误），保留旧进程并停止本轮重启
+                logger.error("工作进程 %d 启动失败，停止重启", slot)
+                self.stop_process(process)
+                return
+            old = self.processes[slot]
+            self.processes[slot] = process
+            self.stop_process(old)
+            logger.info("工作进程 %d: %s -> %s", slot, old.pid, process.pid)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, "restart_requested", True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, "should_exit", True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, "should_exit", True))
+
+        for slot in range(self.workers):
+            self.processes[slot], _ = self.spawn(slot)
+        logger.info("主进程 %s 启动 %d 个工作进程", os.getpid(), self.workers)
+
+        while not self.should_exit:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            for slot, process in list(self.processes.items()):
+                if not process.is_alive() and not self.should_exit:
+                    logger.warning("工作进程 %d (%s) 退出，退出码 %s，重新启动", slot, process.pid, process.exitcode)
+                    time.sleep(RESPAWN_DELAY_SECONDS)
+                    self.processes[slot], _ = self.spawn(slot)
+            time.sleep(0.5)
+
+        logger.info("正在停止工作进程")
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            self.stop_process(process)
+
+async def _prepare():
+    try:
+        await ensure_indexes()
+    finally:
+        close_client()
+
+def run(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(message)s")
+    if args.workers > 1 and not PUSH_BROKER_URL:
+        logger.warning("未配置 PUSH_BROKER_URL，计时推送只能送达同一工作进程的连接")
+    if not args.skip_indexes:
+        asyncio.run(_prepare())
+
+    config = uvicorn.Config("main:app", host=args.host, port=args.port)
+    sock = config.bind_socket()
+    try:
+        Supervisor(sock, args.workers, args.log_level).run()
+    finally:
+        sock.close()
+
+# ---------------- 吞吐基准 ----------------
+
+def _load_client(url: str, headers: dict, concurrency: int, duration: float, queue):
+    """单个压测进程：concurrency 个协程循环请求 duration 秒，返回 (成功数, 失败数, 延迟列表)"""
+    async def main():
+        ok = errors = 0
+        latencies: List[float] = []
+        deadline = time.perf_counter() + duration
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=10) as client:
+            async def loop():
+                nonlocal ok, errors
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.get(url)
+                        if response.status_code < 500:
+                            ok += 1
+                        else:
+                            errors += 1
+                    except httpx.HTTPError:
+                        errors += 1
+                    latencies.append(time.perf_counter() - started)
+            await asyncio.gather(*(loop() for _ in range(concurrency)))
+        return ok, errors, latencies
+
+    queue.put(asyncio.run(main()))
+
+def _wait_ready(base_url: str, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def _measure(url: str, headers: dict, clients: int, concurrency: int, duration: float) -> dict:
+    queue = spawn.Queue()
+    processes = [
+        spawn.Process(target=_load_client, args=(url, headers, max(1, concurrency // clients), duration, queue))
+        for _ in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    latencies = sorted(latency for _, _, client_latencies in results for latency in client_latencies)
+    ok = sum(r[0] for r in results)
+    return {
+        "ok": ok,
+        "errors": sum(r[1] for r in results),
+        "rps": ok / duration,
+        "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+    }
+
+def bench(args):
+    worker_counts = []
+    count = 1
+    while count < args.max_workers:
+        worker_counts.append(count)
+        count *= 2
+    worker_counts.append(args.max_workers)
+
+    headers = dict(h.split(":", 1) for h in args.header)
+    headers = {key.strip(): value.strip() for key, value in headers.items()}
+    base_url = f"http://127.0.0.1:{args.port}"
+    if args.max_workers + args.clients > (os.cpu_count() or 1):
+        print(f"注意: 工作进程和压测进程共享 {os.cpu_count()} 个CPU核，扩展比例会偏低")
+
+    print(f"{'工作进程':>8} {'请求/秒':>10} {'加速比':>8} {'效率':>7} {'p50':>9} {'p99':>9} {'失败':>6}")
+    baseline = None
+    for workers in worker_counts:
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "run", "--workers", str(workers), "--port", str(args.port),
+             "--log-level", "warning", "--skip-indexes"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None
+        )
+        try:
+            if not _wait_ready(base_url, READY_TIMEOUT_SECONDS):
+                print(f"{workers} 个工作进程未能启动")
+                break
+            _measure(base_url + args.path, headers, args.clients, args.concurrency, min(1.0, args.duration))  # 预热
+            result = _measure(base_url + args.path, headers, args.clients, args.concurrency, args.duration)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+        baseline = baseline or result["rps"]
+        speedup = result["rps"] / baseline if baseline else 0.0
+        print(f"{workers:>8} {result['rps']:>10.0f} {speedup:>7.2f}x {speedup / workers:>6.0%} "
+              f"{result['p50'] * 1000:>7.1f}ms {result['p99'] * 1000:>7.1f}ms {result['errors']:>6}")
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程服务")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="启动主进程和工作进程")
+    run_parser.add_argument("--workers", type=int, default=default_workers(), help="工作进程数，默认 CPU 核数")
+    run_parser.add_argument("--host", default="0.0.0.0")
+    run_parser.add_argument("--port", type=int, default=8000)
+    run_parser.add_argument("--log-level", default="info")
+    run_parser.add_argument("--skip-indexes", action="store_true", help="不创建索引（数据库不可用的基准测试等）")
+
+    bench_parser = subparsers.add_parser("bench", help="对比 1..N 个工作进程的吞吐")
+    bench_parser.add_argument("--max-workers", type=int, default=default_workers())
+    bench_parser.add_argument("--port", type=int, default=8099)
+    bench_parser.add_argument("--path", default="/health", help="压测的请求路径")
+    bench_parser.add_argument("--header", action="append", default=[], help="请求头，如 'Authorization: Bearer xxx'")
+    bench_parser.add_argument("--duration", type=float, default=10, help="每组测量秒数")
+    bench_parser.add_argument("--concurrency", type=int, default=64, help="总并发请求数")
+    bench_parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="压测进程数")
+    bench_parser.add_argument("--verbose", action="store_true", help="显示服务日志")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if args.workers < 1:
+            parser.error("--workers 至少为 1")
+        run(args)
+    else:
+        if any(":" not in h for h in args.header):
+            parser.error("请求头格式应为 'Name: value'")
+        bench(args)
+
+if __name__ == "__main__":
+    main()
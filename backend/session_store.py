@@ -0,0 +1,292 @@
+"""
+会话分桶存储 - 可选的 timer_sessions 紧凑存储模式（SESSION_STORAGE=bucket）
+
+进行中的会话仍是 timer_sessions 中的独立文档，开始/停止计时的原子性和去重索引不变；
+会话结束后被追加到 session_buckets 中该用户当天（或当月，SESSION_BUCKET_SPAN）的桶文档，并从 timer_sessions 删除。
+桶文档只有一个 (u, d) 唯一索引，每个会话只保存 ID、起止时间和必要的去重字段:
+
+    {"u": 用户ID, "d": 桶开始日期, "n": 会话数, "t": 总秒数,
+     "s": [{"i": 会话ID, "b": 开始时间, "e": 结束时间, "k": 停止幂等键, "cs"/"ce": 离线事件ID, "a": 自动关闭}]}
+
+用法:
+    python session_store.py migrate [--batch-size 1000] [--user-id ID]   把已结束的会话转换为桶
+    python session_store.py restore [--batch-size 200] [--user-id ID]    把桶展开回 timer_sessions
+    python session_store.py compare --users 200 --days 365               在临时集合上比较两种存储的大小和查询开销
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config import SESSION_STORAGE, SESSION_BUCKET_SPAN
+from database import get_db, get_timer_sessions_collection, get_session_buckets_collection, close_client
+from schema import user_match, from_storage, to_storage
+
+DUPLICATE_KEY = 11000
+# 会话文档字段 -> 桶内紧凑字段（起止时间和ID单独处理）
+OPTIONAL_FIELDS = {"stop_key": "k", "client_start_id": "cs", "client_stop_id": "ce", "auto_closed": "a"}
+
+def buckets_enabled() -> bool:
+    return SESSION_STORAGE == "bucket"
+
+def bucket_date(date: str, span: str = SESSION_BUCKET_SPAN) -> str:
+    """会话日期所属桶的开始日期"""
+    return date[:8] + "01" if span == "month" else date
+
+def bucket_entry(session: dict) -> dict:
+    """已结束会话在桶中的紧凑表示"""
+    entry = {"i": session["_id"], "b": session["start_time"], "e": session["end_time"]}
+    for field, short in OPTIONAL_FIELDS.items():
+        if session.get(field) is not None:
+            entry[short] = session[field]
+    return entry
+
+def expand_entry(user_id: str, entry: dict) -> dict:
+    """桶中的会话还原为 timer_sessions 文档格式"""
+    session = {
+        "_id": entry["i"],
+        "user_id": user_id,
+        "start_time": entry["b"],
+        "end_time": entry["e"],
+        "duration": int((entry["e"] - entry["b"]).total_seconds()),
+        "date": entry["b"].strftime("%Y-%m-%d"),
+    }
+    for field, short in OPTIONAL_FIELDS.items():
+        if short in entry:
+            session[field] = entry[short]
+    return session
+
+def _push_operation(session: dict, span: str = SESSION_BUCKET_SPAN) -> UpdateOne:
+    # 过滤条件排除已追加过的会话：重复追加时 upsert 与唯一索引冲突，而不会写入两次
+    return UpdateOne(
+        {"u": session["user_id"], "d": bucket_date(session["date"], span), "s.i": {"$ne": session["_id"]}},
+        {
+            "$push": {"s": bucket_entry(session)},
+            "$inc": {"n": 1, "t": session["duration"]}
+        },
+        upsert=True
+    )
+
+async def append_to_buckets(sessions: List[dict], collection=None, span: str = SESSION_BUCKET_SPAN) -> List[dict]:
+    """把已结束的会话追加到桶中，返回已在桶中的会话（含之前已追加过的）"""
+    if not sessions:
+        return []
+    collection = collection if collection is not None else get_session_buckets_collection()
+    pending = list(sessions)
+    # 第一次的冲突可能来自并发创建同一个桶，重试一次；再次冲突说明会话已在桶中
+    for _ in range(2):
+        try:
+            await collection.bulk_write([_push_operation(s, span) for s in pending], ordered=False)
+            return sessions
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != DUPLICATE_KEY for err in errors):
+                raise
+            pending = [pending[err["index"]] for err in errors]
+    return sessions
+
+async def move_closed_sessions(sessions: List[dict]):
+    """分桶模式下把刚结束的会话移入桶（非分桶模式不做任何事）"""
+    closed = [s for s in sessions if s.get("end_time") is not None]
+    if not buckets_enabled() or not closed:
+        return
+    moved = await append_to_buckets(closed)
+    await get_timer_sessions_collection().delete_many(
+        {"_id": {"$in": [s["_id"] for s in moved]}, "end_time": {"$ne": None}}
+    )
+
+async def find_closed_session(user_id: str, session_id: ObjectId, since: datetime) -> Optional[dict]:
+    """在 since 之后开始的桶中查找已结束的会话"""
+    bucket = await get_session_buckets_collection().find_one(
+        {"u": user_id, "d": {"$gte": bucket_date(since.strftime("%Y-%m-%d"))}, "s.i": session_id},
+        {"s": {"$elemMatch": {"i": session_id}}}
+    )
+    if not bucket:
+        return None
+    return expand_entry(user_id, bucket["s"][0])
+
+async def find_synced_client_ids(user_id: str, client_ids: List[str], event_times: List[datetime]) -> Set[str]:
+    """
+    查找已移入桶的会话中出现过的离线事件ID。
+    会话按开始日期分桶，停止事件最多晚于开始一天，所以只需查事件日期及前一天所在的桶。
+    """
+    dates = set()
+    for event_time in event_times:
+        for day in (event_time, event_time - timedelta(days=1)):
+            dates.add(bucket_date(day.strftime("%Y-%m-%d")))
+    wanted = set(client_ids)
+    seen = set()
+    async for bucket in get_session_buckets_collection().find(
+        {"u": user_id, "d": {"$in": sorted(dates)}, "$or": [
+            {"s.cs": {"$in": client_ids}}, {"s.ce": {"$in": client_ids}}
+        ]},
+        {"s.cs": 1, "s.ce": 1}
+    ):
+        for entry in bucket["s"]:
+            seen.update(value for value in (entry.get("cs"), entry.get("ce")) if value in wanted)
+    return seen
+
+def bucket_documents(sessions: List[dict], span: str = SESSION_BUCKET_SPAN) -> List[dict]:
+    """把一批已结束的会话直接组装为桶文档（用于批量生成数据）"""
+    buckets: Dict[tuple, dict] = {}
+    for session in sorted(sessions, key=lambda s: s["start_time"]):
+        key = (session["user_id"], bucket_date(session["date"], span))
+        bucket = buckets.setdefault(key, {"u": key[0], "d": key[1], "n": 0, "t": 0, "s": []})
+        bucket["n"] += 1
+        bucket["t"] += session["duration"]
+        bucket["s"].append(bucket_entry(session))
+    return list(buckets.values())
+
+async def migrate(batch_size: int, user_id: Optional[str] = None) -> int:
+    """按批把已结束的会话移入桶，可重复运行（已移入的会话不会重复追加）"""
+    query = {"end_time": {"$ne": None}}
+    if user_id:
+        query["user_id"] = user_match(user_id)
+    collection = get_timer_sessions_collection()
+    moved = 0
+    while True:
+        sessions = await collection.find(query).sort([("user_id", 1), ("date", 1)]).limit(batch_size).to_list(length=None)
+        if not sessions:
+            break
+        # 桶中的用户ID和日期始终为字符串
+        done = await append_to_buckets([from_storage(s) for s in sessions])
+        await collection.delete_many({"_id": {"$in": [s["_id"] for s in done]}})
+        moved += len(done)
+        print(f"  已转换 {moved} 个会话")
+    return moved
+
+async def restore(batch_size: int, user_id: Optional[str] = None) -> int:
+    """按批把桶展开回 timer_sessions（切回 document 模式前运行）"""
+    buckets_collection = get_session_buckets_collection()
+    sessions_collection = get_timer_sessions_collection()
+    restored = 0
+    while True:
+        buckets = await buckets_collection.find({"u": user_id} if user_id else {}).limit(batch_size).to_list(length=None)
+        if not buckets:
+            break
+        sessions = [expand_entry(b["u"], entry) for b in buckets for entry in b["s"]]
+        try:
+            await sessions_collection.bulk_write([InsertOne(to_storage(s)) for s in sessions], ordered=False)
+        except BulkWriteError as e:
+            # 上次中断时已写回的会话
+            if any(err.get("code") != DUPLICATE_KEY for err in e.details.get("writeErrors", [])):
+                raise
+        await buckets_collection.delete_many({"_id": {"$in": [b["_id"] for b in buckets]}})
+        restored += len(sessions)
+        print(f"  已展开 {restored} 个会话")
+    return restored
+
+async def _collection_stats(name: str) -> dict:
+    stats = await get_db().command("collStats", name)
+    return {
+        "count": stats["count"],
+        "size": stats["size"],
+        "storage": stats.get("storageSize", 0),
+        "indexes": stats.get("totalIndexSize", 0),
+    }
+
+async def _query_cost(collection, queries: List[dict], projection: Optional[dict]) -> dict:
+    started = time.perf_counter()
+    for query in queries:
+        await collection.find(query, projection).to_list(length=None)
+    elapsed = time.perf_counter() - started
+    explain = await collection.find(queries[0], projection).explain()
+    stats = explain["executionStats"]
+    return {
+        "ms": elapsed / len(queries) * 1000,
+        "keys": stats["totalKeysExamined"],
+        "docs": stats["totalDocsExamined"],
+    }
+
+async def compare(users: int, days: int, span: str, query_days: int, queries: int, keep: bool):
+    """在临时集合中生成相同的会话，比较逐会话文档与分桶两种存储的大小和查询开销"""
+    from loadtest import generate_history
+
+    db = get_db()
+    doc_collection = db["bench_sessions_document"]
+    bucket_collection = db["bench_sessions_bucket"]
+    await doc_collection.drop()
+    await bucket_collection.drop()
+    await doc_collection.create_index([("user_id", 1), ("date", 1)])
+    await bucket_collection.create_index([("u", 1), ("d", 1)], unique=True)
+
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=days)
+    user_ids = [str(ObjectId()) for _ in range(users)]
+    for index, user_id in enumerate(user_ids):
+        sessions, _ = generate_history(random.Random(index), user_id, start, end, 0.9, 22 * 3600)
+        if sessions:
+            await doc_collection.insert_many(sessions, ordered=False)
+            await bucket_collection.insert_many(bucket_documents(sessions, span), ordered=False)
+
+    rng = random.Random(0)
+    since = (end - timedelta(days=query_days)).strftime("%Y-%m-%d")
+    picks = [rng.choice(user_ids) for _ in range(queries)]
+    results = {
+        "document": (
+            await _collection_stats(doc_collection.name),
+            await _query_cost(doc_collection, [{"user_id": u, "date": {"$gte": since}} for u in picks], None),
+        ),
+        "bucket": (
+            await _collection_stats(bucket_collection.name),
+            await _query_cost(
+                bucket_collection, [{"u": u, "d": {"$gte": bucket_date(since, span)}} for u in picks], None
+            ),
+        ),
+    }
+
+    print(f"{users} 个用户 x {days} 天, 桶跨度 {span}, 查询最近 {query_days} 天的会话 {queries} 次")
+    print(f"{'存储':<10}{'文档数':>10}{'数据(KB)':>12}{'存储(KB)':>12}{'索引(KB)':>12}"
+          f"{'查询(ms)':>10}{'扫描键':>8}{'扫描文档':>10}")
+    for name, (stats, cost) in results.items():
+        print(f"{name:<10}{stats['count']:>10}{stats['size'] / 1024:>12.0f}{stats['storage'] / 1024:>12.0f}"
+              f"{stats['indexes'] / 1024:>12.0f}{cost['ms']:>10.2f}{cost['keys']:>8}{cost['docs']:>10}")
+
+    if not keep:
+        await doc_collection.drop()
+        await bucket_collection.drop()
+
+async def _run(args):
+    try:
+        if args.command == "migrate":
+            moved = await migrate(args.batch_size, args.user_id)
+            print(f"转换完成: {moved} 个会话")
+        elif args.command == "restore":
+            restored = await restore(args.batch_size, args.user_id)
+            print(f"展开完成: {restored} 个会话")
+        else:
+            await compare(args.users, args.days, args.span, args.query_days, args.queries, args.keep)
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="会话分桶存储迁移和对比")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="把已结束的会话转换为桶")
+    migrate_parser.add_argument("--batch-size", type=int, default=1000)
+    migrate_parser.add_argument("--user-id", default=None, help="只处理指定用户")
+
+    restore_parser = subparsers.add_parser("restore", help="把桶展开回 timer_sessions")
+    restore_parser.add_argument("--batch-size", type=int, default=200, help="每批处理的桶数")
+    restore_parser.add_argument("--user-id", default=None, help="只处理指定用户")
+
+    compare_parser = subparsers.add_parser("compare", help="比较两种存储的大小和查询开销")
+    compare_parser.add_argument("--users", type=int, default=200)
+    compare_parser.add_argument("--days", type=int, default=365)
+    compare_parser.add_argument("--span", choices=["day", "month"], default=SESSION_BUCKET_SPAN)
+    compare_parser.add_argument("--query-days", type=int, default=30, help="每次查询的最近天数")
+    compare_parser.add_argument("--queries", type=int, default=200)
+    compare_parser.add_argument("--keep", action="store_true", help="保留临时集合")
+
+    args = parser.parse_args()
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
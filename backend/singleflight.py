@@ -0,0 +1,61 @@
+"""
+请求合并 - 同一进程内键相同的并发读取共享一次执行。
+
+小程序 onShow 时会同时请求 /timer/status、/stats/achievements、/plan，弱网重试又会叠加相同的请求；
+第一个调用者执行查询，执行期间到达的相同调用等待同一结果，完成后 SINGLEFLIGHT_WINDOW_MS 内到达的调用也直接复用。
+执行在独立任务中进行，发起者断开不影响其他等待者；出错时所有等待者收到同一异常，且不保留结果。
+写入方在修改数据后调用 forget()，之后的调用重新读取。
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from config import SINGLEFLIGHT_WINDOW_MS
+from metrics import record_singleflight
+
+class SingleFlight:
+    """按键合并并发调用"""
+
+    def __init__(self, name: str, window_ms: float = SINGLEFLIGHT_WINDOW_MS):
+        self.name = name
+        self.window = window_ms / 1000
+        # 键 -> (执行任务, 完成时间；未完成时为None)
+        self._calls: Dict[Hashable, Tuple[asyncio.Task, Any]] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is not None:
+            task, finished_at = call
+            if finished_at is None:
+                record_singleflight(self.name, "shared")
+                return await asyncio.shield(task)
+            if time.monotonic() - finished_at < self.window:
+                record_singleflight(self.name, "window")
+                return task.result()
+            del self._calls[key]
+
+        record_singleflight(self.name, "leader")
+        task = asyncio.ensure_future(func())
+        self._calls[key] = (task, None)
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key, (None,))[0] is not task:
+            return  # 已被 forget() 或更新的调用替换
+        if task.cancelled() or task.exception() is not None or self.window <= 0:
+            del self._calls[key]
+            return
+        self._calls[key] = (task, time.monotonic())
+        asyncio.get_running_loop().call_later(self.window, self._expire, key, task)
+
+    def _expire(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key, (None,))[0] is task:
+            del self._calls[key]
+
+    def forget(self, key: Hashable):
+        """数据已变更：之后的调用不再复用进行中或刚完成的结果"""
+        self._calls.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._calls)
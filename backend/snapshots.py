@@ -0,0 +1,387 @@
+"""
+全体用户达标统计快照 - 夜间批量任务，按用户分批聚合 daily_records 和 users.plan，物化到 stats_snapshots 集合。
+
+每批用户用一个聚合管道（按 ANALYTICS_READ_PREFERENCE 读取）关联计划、每日记录和成就汇总，
+按 (日期, 第几副, 时长区间) 分组返回直方图；直方图可以逐批累加，百分位数在全部批次完成后计算。
+计划开始日期之后、牙套总副数之内没有记录的天按0小时计；没有计划或不在计划内的记录归入第0副。
+
+快照文档:
+    day:<日期>                        当天全体用户的时长分布、百分位数和达标率（按副细分）
+    set:<结束日期>:<天数>:<第几副>     统计窗口内佩戴第N副牙套的用户天统计和当前连续达标天数分布
+    summary:<结束日期>:<天数>          统计窗口整体统计和连续达标天数分布
+
+任务进度（已处理到的用户和累计的直方图）每批保存在 stats_snapshot_jobs，中断后再次运行会从断点继续；
+每批之间按 SNAPSHOT_DUTY_CYCLE 休眠，避免占满数据库影响计时请求。
+
+用法:
+    python snapshots.py run                          统计截至昨天的最近7天
+    python snapshots.py run --date 2024-06-30 --days 30
+    python snapshots.py run --restart                丢弃未完成的进度重新统计
+    python snapshots.py status                       查看最近的任务
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ReplaceOne
+
+from config import SNAPSHOT_CHUNK_SIZE, SNAPSHOT_DUTY_CYCLE
+from database import (
+    get_analytics_db, get_stats_snapshots_collection, get_snapshot_jobs_collection, close_client
+)
+from models import PlanModel
+from schema import user_expression, day_range_query, date_string_expression
+
+MAX_SNAPSHOT_DAYS = 31
+BIN_SECONDS = 900  # 时长直方图区间：15分钟
+BIN_COUNT = 24 * 3600 // BIN_SECONDS + 1  # 最后一个区间为恰好24小时
+PERCENTILES = (10, 25, 50, 75, 90)
+# (最小值, 最大值, 名称)，最大值为 None 表示不限
+STREAK_BUCKETS = ((0, 0, "0"), (1, 2, "1-2"), (3, 6, "3-6"), (7, 13, "7-13"), (14, 29, "14-29"), (30, None, "30+"))
+DEFAULT_PLAN = PlanModel()
+
+def _plan_field(name: str) -> dict:
+    return {"$ifNull": [f"$plan.{name}", getattr(DEFAULT_PLAN, name)]}
+
+def set_number_expression(date_expr) -> dict:
+    """记录日期对应第几副牙套；没有开始日期、早于开始日期或超过总副数时为0"""
+    return {"$let": {
+        "vars": {"offset": {"$floor": {"$divide": [
+            {"$subtract": [
+                {"$dateFromString": {"dateString": date_expr, "format": "%Y-%m-%d", "onError": None}},
+                {"$dateFromString": {"dateString": "$plan.start_date", "format": "%Y-%m-%d",
+                                     "onError": None, "onNull": None}}
+            ]},
+            86400000
+        ]}}},
+        "in": {"$let": {
+            "vars": {"number": {"$add": [{"$floor": {"$divide": ["$$offset", _plan_field("days_per_set")]}}, 1]}},
+            "in": {"$cond": [
+                {"$and": [
+                    {"$ne": [{"$type": "$$offset"}, "null"]},
+                    {"$gte": ["$$offset", 0]},
+                    {"$lte": ["$$number", _plan_field("total_sets")]}
+                ]},
+                "$$number",
+                0
+            ]}
+        }}
+    }}
+
+def streak_bucket_expression(field: str) -> dict:
+    branches = []
+    for low, high, name in STREAK_BUCKETS:
+        condition = {"$gte": [field, low]} if high is None else {"$and": [{"$gte": [field, low]}, {"$lte": [field, high]}]}
+        branches.append({"case": condition, "then": name})
+    return {"$switch": {"branches": branches, "default": STREAK_BUCKETS[0][2]}}
+
+def chunk_pipeline(last_id, chunk_size: int, start_date: str, end_date: str) -> List[dict]:
+    """一批用户的聚合管道：关联每日记录和成就汇总，输出直方图单元、计划和连续天数分布"""
+    match = {"_id": {"$gt": last_id}} if last_id is not None else {}
+    return [
+        {"$match": match},
+        {"$sort": {"_id": 1}},
+        {"$limit": chunk_size},
+        {"$project": {"plan": 1, "uid": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": "daily_records",
+            "let": {"uid": "$uid", "oid": "$_id"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": user_expression("$user_id", "$$uid", "$$oid"),
+                    **day_range_query(start_date, end_date),
+                }},
+                # 日期统一为字符串形式，之后的分组与存储格式无关
+                {"$project": {"_id": 0, "date": date_string_expression(), "total_seconds": 1, "completed": 1}},
+            ],
+            "as": "records",
+        }},
+        {"$lookup": {
+            "from": "achievement_summaries",
+            "localField": "uid",
+            "foreignField": "_id",
+            "as": "summary",
+        }},
+        {"$facet": {
+            "cells": [
+                {"$unwind": "$records"},
+                {"$group": {
+                    "_id": {
+                        "date": "$records.date",
+                        "set": set_number_expression("$records.date"),
+                        "bin": {"$min": [BIN_COUNT - 1, {"$floor": {"$divide": [
+                            {"$ifNull": ["$records.total_seconds", 0]}, BIN_SECONDS
+                        ]}}]},
+                    },
+                    "records": {"$sum": 1},
+                    "completed": {"$sum": {"$cond": ["$records.completed", 1, 0]}},
+                    "seconds": {"$sum": {"$ifNull": ["$records.total_seconds", 0]}},
+                }},
+            ],
+            "streaks": [
+                {"$group": {
+                    "_id": {
+                        "set": _plan_field("current_set"),
+                        "bucket": streak_bucket_expression(
+                            {"$ifNull": [{"$arrayElemAt": ["$summary.current_streak", 0]}, 0]}
+                        ),
+                    },
+                    "users": {"$sum": 1},
+                }},
+            ],
+            "plans": [
+                {"$project": {
+                    "start_date": "$plan.start_date",
+                    "days_per_set": _plan_field("days_per_set"),
+                    "total_sets": _plan_field("total_sets"),
+                }},
+            ],
+        }},
+    ]
+
+def _empty_cell() -> dict:
+    return {"users": 0, "records": 0, "completed": 0, "seconds": 0, "bins": [0] * BIN_COUNT}
+
+def plan_days(plan: dict, dates: List[str]) -> List[Tuple[str, int]]:
+    """计划内的 (日期, 第几副)，没有开始日期时为空"""
+    try:
+        start = datetime.strptime(plan.get("start_date") or "", "%Y-%m-%d")
+    except ValueError:
+        return []
+    days_per_set = plan["days_per_set"]
+    result = []
+    for date in dates:
+        offset = (datetime.strptime(date, "%Y-%m-%d") - start).days
+        number = offset // days_per_set + 1
+        if offset >= 0 and number <= plan["total_sets"]:
+            result.append((date, number))
+    return result
+
+class SnapshotAccumulator:
+    """逐批累加的直方图：(日期, 第几副) -> 单元，(当前第几副, 连续天数区间) -> 用户数"""
+
+    def __init__(self, dates: List[str], state: Optional[dict] = None):
+        self.dates = dates
+        self.cells: Dict[Tuple[str, int], dict] = {}
+        self.streaks: Dict[Tuple[int, str], int] = {}
+        self.users = 0
+        if state:
+            self.users = state["users"]
+            self.cells = {(c["date"], c["set"]): c["cell"] for c in state["cells"]}
+            self.streaks = {(s["set"], s["bucket"]): s["users"] for s in state["streaks"]}
+
+    def state(self) -> dict:
+        return {
+            "users": self.users,
+            "cells": [{"date": date, "set": number, "cell": cell} for (date, number), cell in self.cells.items()],
+            "streaks": [{"set": number, "bucket": bucket, "users": users}
+                        for (number, bucket), users in self.streaks.items()],
+        }
+
+    def add_chunk(self, result: dict):
+        self.users += len(result["plans"])
+        recorded: Dict[Tuple[str, int], int] = {}
+        for row in result["cells"]:
+            key = (row["_id"]["date"], int(row["_id"]["set"]))
+            cell = self.cells.setdefault(key, _empty_cell())
+            cell["records"] += row["records"]
+            cell["completed"] += row["completed"]
+            cell["seconds"] += row["seconds"]
+            cell["bins"][int(row["_id"]["bin"])] += row["records"]
+            recorded[key] = recorded.get(key, 0) + row["records"]
+
+        # 计划内的每一天都计入用户数，没有记录的天计入0小时区间；计划外的记录只按记录计数
+        expected: Dict[Tuple[str, int], int] = {}
+        for plan in result["plans"]:
+            for key in plan_days(plan, self.dates):
+                expected[key] = expected.get(key, 0) + 1
+        for key in set(recorded) | set(expected):
+            cell = self.cells.setdefault(key, _empty_cell())
+            users = expected.get(key, 0) if key[1] else recorded.get(key, 0)
+            cell["users"] += users
+            cell["bins"][0] += max(0, users - recorded.get(key, 0))
+
+        for row in result["streaks"]:
+            key = (int(row["_id"]["set"]), row["_id"]["bucket"])
+            self.streaks[key] = self.streaks.get(key, 0) + row["users"]
+
+def merge_cells(cells: List[dict]) -> dict:
+    merged = _empty_cell()
+    for cell in cells:
+        for field in ("users", "records", "completed", "seconds"):
+            merged[field] += cell[field]
+        merged["bins"] = [a + b for a, b in zip(merged["bins"], cell["bins"])]
+    return merged
+
+def percentile_hours(bins: List[int], total: int, percentile: float) -> float:
+    """按直方图估算百分位数（取区间中点，第一个区间多为没有记录的天，按0计）"""
+    threshold = total * percentile / 100
+    cumulative = 0
+    for index, count in enumerate(bins):
+        cumulative += count
+        if count and cumulative >= threshold:
+            return round(min(24.0, (index + 0.5) * BIN_SECONDS / 3600), 2) if index else 0.0
+    return 0.0
+
+def cell_stats(cell: dict) -> dict:
+    """单元 -> 快照中的统计字段"""
+    users = cell["users"]
+    per_hour = 3600 // BIN_SECONDS
+    distribution = [sum(cell["bins"][h * per_hour:(h + 1) * per_hour]) for h in range(24)]
+    distribution[-1] += sum(cell["bins"][24 * per_hour:])
+    return {
+        "user_days": users,
+        "recorded_days": cell["records"],
+        "completed_days": cell["completed"],
+        "completion_rate": round(cell["completed"] / users * 100, 1) if users else 0.0,
+        "avg_hours": round(cell["seconds"] / 3600 / users, 2) if users else 0.0,
+        "percentiles": {f"p{p}": percentile_hours(cell["bins"], users, p) for p in PERCENTILES},
+        "distribution": distribution,  # 0-23 小时区间的用户天数（24小时计入最后一个区间）
+    }
+
+def streak_stats(streaks: Dict[Tuple[int, str], int], number: Optional[int] = None) -> dict:
+    return {
+        name: sum(users for (set_number, bucket), users in streaks.items()
+                  if bucket == name and (number is None or set_number == number))
+        for _, _, name in STREAK_BUCKETS
+    }
+
+def build_snapshots(accumulator: SnapshotAccumulator, end_date: str, days: int, created_at: datetime) -> List[dict]:
+    """累加结果 -> 快照文档"""
+    window = {"window_start": accumulator.dates[0], "window_end": end_date, "window_days": days,
+              "created_at": created_at}
+    docs = []
+    for date in accumulator.dates:
+        cells = {number: cell for (d, number), cell in accumulator.cells.items() if d == date}
+        docs.append({
+            "_id": f"day:{date}", "kind": "day", "date": date,
+            **cell_stats(merge_cells(list(cells.values()))),
+            "sets": [{"set_number": number, **cell_stats(cell)} for number, cell in sorted(cells.items())],
+            **window,
+        })
+
+    numbers = sorted({number for _, number in accumulator.cells} | {number for number, _ in accumulator.streaks})
+    for number in numbers:
+        cells = [cell for (_, n), cell in accumulator.cells.items() if n == number]
+        docs.append({
+            "_id": f"set:{end_date}:{days}:{number}", "kind": "set", "date": end_date, "set_number": number,
+            **cell_stats(merge_cells(cells)),
+            "streak_buckets": streak_stats(accumulator.streaks, number),  # 当前佩戴这一副的用户
+            **window,
+        })
+
+    docs.append({
+        "_id": f"summary:{end_date}:{days}", "kind": "summary", "date": end_date,
+        "users": accumulator.users,
+        **cell_stats(merge_cells(list(accumulator.cells.values()))),
+        "streak_buckets": streak_stats(accumulator.streaks),
+        **window,
+    })
+    return docs
+
+async def run_job(end_date: str, days: int, chunk_size: int, duty_cycle: float, restart: bool = False) -> dict:
+    """运行（或继续）一次快照任务，返回任务文档"""
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    dates = [(end - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days - 1, -1, -1)]
+    job_id = f"{end_date}:{days}"
+    jobs = get_snapshot_jobs_collection()
+
+    job = None if restart else await jobs.find_one({"_id": job_id})
+    if job and job["status"] == "running":
+        print(f"从断点继续: 已处理 {job['state']['users']} 个用户")
+    else:
+        job = {"_id": job_id, "status": "running", "last_user_id": None, "chunks": 0,
+               "state": None, "started_at": datetime.now()}
+        await jobs.replace_one({"_id": job_id}, {**job, "updated_at": datetime.now()}, upsert=True)
+
+    accumulator = SnapshotAccumulator(dates, job["state"])
+    users = get_analytics_db()["users"]
+    last_id = job["last_user_id"]
+    chunks = job["chunks"]
+    while True:
+        started = time.perf_counter()
+        pipeline = chunk_pipeline(last_id, chunk_size, dates[0], end_date)
+        results = await users.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+        result = results[0] if results else {"cells": [], "streaks": [], "plans": []}
+        if not result["plans"]:
+            break
+
+        accumulator.add_chunk(result)
+        last_id = result["plans"][-1]["_id"]
+        chunks += 1
+        # 进度和累计直方图一起保存，中断后从这里继续
+        await jobs.update_one({"_id": job_id}, {"$set": {
+            "last_user_id": last_id, "chunks": chunks, "state": accumulator.state(), "updated_at": datetime.now()
+        }})
+
+        elapsed = time.perf_counter() - started
+        print(f"批次 {chunks}: 累计 {accumulator.users} 个用户, 用时 {elapsed:.2f} 秒")
+        if duty_cycle < 1:
+            await asyncio.sleep(elapsed * (1 - duty_cycle) / duty_cycle)
+
+    created_at = datetime.now()
+    docs = build_snapshots(accumulator, end_date, days, created_at)
+    await get_stats_snapshots_collection().bulk_write(
+        [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False
+    )
+    job.update(status="done", chunks=chunks, users=accumulator.users, snapshots=len(docs), finished_at=created_at)
+    await jobs.update_one({"_id": job_id}, {
+        "$set": {"status": "done", "users": accumulator.users, "snapshots": len(docs),
+                 "finished_at": created_at, "updated_at": created_at},
+        "$unset": {"state": ""}
+    })
+    return job
+
+async def _run_command(args):
+    if args.days < 1 or args.days > MAX_SNAPSHOT_DAYS:
+        print(f"统计天数应在 1 到 {MAX_SNAPSHOT_DAYS} 之间")
+        return
+    end_date = args.date or (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    started = time.perf_counter()
+    job = await run_job(end_date, args.days, args.chunk_size, args.duty_cycle, args.restart)
+    print(f"完成: {job['users']} 个用户, {job['chunks']} 批, 写入 {job['snapshots']} 个快照, "
+          f"用时 {time.perf_counter() - started:.1f} 秒")
+
+async def _status():
+    async for job in get_snapshot_jobs_collection().find({}, {"state": 0}).sort("updated_at", -1).limit(10):
+        print(f"{job['_id']}: {job['status']}, {job.get('chunks', 0)} 批, "
+              f"{job.get('users', '-')} 个用户, 更新于 {job['updated_at']:%Y-%m-%d %H:%M:%S}")
+
+async def _run(args):
+    try:
+        if args.command == "run":
+            await _run_command(args)
+        else:
+            await _status()
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="全体用户达标统计快照")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="运行或继续快照任务")
+    run_parser.add_argument("--date", default=None, help="统计窗口结束日期 YYYY-MM-DD，默认昨天")
+    run_parser.add_argument("--days", type=int, default=7, help=f"统计窗口天数（最多{MAX_SNAPSHOT_DAYS}）")
+    run_parser.add_argument("--chunk-size", type=int, default=SNAPSHOT_CHUNK_SIZE, help="每批处理的用户数")
+    run_parser.add_argument("--duty-cycle", type=float, default=SNAPSHOT_DUTY_CYCLE,
+                            help="工作时间占比，0.5 表示每批之后休眠与处理相同的时间，1 为不休眠")
+    run_parser.add_argument("--restart", action="store_true", help="丢弃未完成的进度重新统计")
+
+    subparsers.add_parser("status", help="查看最近的任务")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if args.date:
+            try:
+                datetime.strptime(args.date, "%Y-%m-%d")
+            except ValueError:
+                parser.error("日期格式应为YYYY-MM-DD")
+        if not 0 < args.duty_cycle <= 1:
+            parser.error("--duty-cycle 应在 (0, 1] 之间")
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+超时会话清理 - 定期批量关闭所有用户超过 MAX_SESSION_HOURS 的未结束会话。
+
+默认随应用启动在进程内定期运行（SWEEPER_ENABLED），也可单独运行:
+    python sweeper.py          按 SWEEP_INTERVAL_SECONDS 循环清理
+    python sweeper.py --once   只清理一次并输出关闭数量
+"""
+import argparse
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from achievements import record_daily_update
+from config import SWEEP_INTERVAL_SECONDS, SWEEP_BATCH_SIZE
+from database import get_timer_sessions_collection, get_daily_records_collection, get_user_states_collection
+from live_state import session_closed_update, invalidate_live_state
+from push import hub
+from schema import user_match, day_match, from_storage
+from session_store import OPTIONAL_FIELDS, move_closed_sessions
+from routers.timer import (
+    MAX_SESSION_HOURS, MAX_SESSION_SECONDS, split_session_hours, add_hourly, daily_credit_pipeline
+)
+
+logger = logging.getLogger(__name__)
+
+async def _close_batch(sessions: List[dict]) -> List[dict]:
+    """批量关闭一批会话，返回实际由本次关闭的会话"""
+    collection = get_timer_sessions_collection()
+    sweep_id = ObjectId()
+
+    operations = []
+    for session in sessions:
+        start_time = session["start_time"]
+        if start_time.tzinfo is not None:
+            start_time = start_time.replace(tzinfo=None)
+        closed_fields = {
+            "end_time": start_time + timedelta(hours=MAX_SESSION_HOURS),
+            "duration": MAX_SESSION_SECONDS,
+            "auto_closed": True,  # 标记为自动关闭
+        }
+        # 关闭后的字段同时写回内存中的会话，供分桶模式移入桶
+        session.update(closed_fields)
+        operations.append(UpdateOne(
+            {"_id": session["_id"], "end_time": None},
+            {"$set": {**closed_fields, "closed_by": sweep_id}}
+        ))
+
+    result = await collection.bulk_write(operations, ordered=False)
+    if result.modified_count == len(sessions):
+        return sessions
+
+    # 部分会话已被并发的停止请求结束，只处理本次关闭的
+    closed_ids = set(await collection.distinct(
+        "_id", {"_id": {"$in": [s["_id"] for s in sessions]}, "closed_by": sweep_id}
+    ))
+    return [s for s in sessions if s["_id"] in closed_ids]
+
+async def _credit_closed_sessions(sessions: List[dict]):
+    """把关闭的会话按 (用户, 日期) 汇总计入每日记录，并更新成就汇总和实时状态"""
+    credited: Dict[Tuple[str, str], int] = defaultdict(int)
+    hourly: Dict[Tuple[str, str], List[int]] = {}
+    next_day_hourly: Dict[Tuple[str, str], List[int]] = {}
+    for session in sessions:
+        key = (session["user_id"], session["date"])
+        credited[key] += MAX_SESSION_SECONDS
+        end_time = session["start_time"] + timedelta(hours=MAX_SESSION_HOURS)
+        same_day, next_day = split_session_hours(session["start_time"], end_time)
+        hourly[key] = add_hourly(hourly.get(key, [0] * 24), same_day)
+        if next_day is not None:
+            next_day_hourly[key] = add_hourly(next_day_hourly.get(key, [0] * 24), next_day)
+
+    daily_records_collection = get_daily_records_collection()
+    previous_records = {}
+    async for record in daily_records_collection.find(
+        {"$or": [{"user_id": user_match(user_id), "date": day_match(date)} for user_id, date in credited]},
+        {"_id": 0, "user_id": 1, "date": 1, "total_seconds": 1, "completed": 1}
+    ):
+        from_storage(record)
+        previous_records[(record["user_id"], record["date"])] = record
+
+    await daily_records_collection.bulk_write([
+        UpdateOne(
+            {"user_id": user_match(user_id), "date": day_match(date)},
+            daily_credit_pipeline(
+                user_id, date, seconds,
+                hourly=hourly.get((user_id, date)), next_day_hourly=next_day_hourly.get((user_id, date))
+            ),
+            upsert=True
+        )
+        for (user_id, date), seconds in credited.items()
+    ], ordered=False)
+
+    # 完成状态不变，只增量更新成就汇总
+    for (user_id, date), seconds in credited.items():
+        previous = previous_records.get((user_id, date))
+        completed = bool(previous and previous.get("completed", False))
+        await record_daily_update(user_id, date, previous, completed, seconds)
+
+    await get_user_states_collection().bulk_write([
+        UpdateOne(
+            {"_id": session["user_id"]},
+            session_closed_update(
+                session["_id"],
+                session["date"],
+                previous_records.get((session["user_id"], session["date"]), {}).get("total_seconds", 0)
+                + credited[(session["user_id"], session["date"])]
+            )
+        )
+        for session in sessions
+    ], ordered=False)
+
+    for session in sessions:
+        invalidate_live_state(session["user_id"])
+        await hub.publish(session["user_id"], {
+            "type": "delta",
+            "event": "auto_closed",
+            "session_id": str(session["_id"]),
+            "is_wearing": False,
+            "server_time": datetime.now()
+        })
+
+async def sweep_expired_sessions(batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """关闭所有超时会话，返回关闭数量"""
+    cutoff_time = datetime.now() - timedelta(hours=MAX_SESSION_HOURS)
+    collection = get_timer_sessions_collection()
+    closed = 0
+
+    while True:
+        # 使用未结束会话的部分索引按开始时间扫描
+        sessions = await collection.find(
+            {"end_time": None, "start_time": {"$lt": cutoff_time}},
+            # 分桶模式下关闭后直接移入桶，需带上离线同步和停止幂等去重用的字段
+            {"user_id": 1, "start_time": 1, "date": 1, **{field: 1 for field in OPTIONAL_FIELDS}}
+        ).sort("start_time", 1).limit(batch_size).to_list(length=None)
+        if not sessions:
+            break
+        sessions = [from_storage(s) for s in sessions]
+
+        closed_sessions = await _close_batch(sessions)
+        if closed_sessions:
+            await _credit_closed_sessions(closed_sessions)
+            await move_closed_sessions(closed_sessions)
+        closed += len(closed_sessions)
+
+        if len(sessions) < batch_size:
+            break
+
+    return closed
+
+async def run_sweeper(interval: float = SWEEP_INTERVAL_SECONDS, batch_size: int = SWEEP_BATCH_SIZE):
+    """按固定间隔循环清理（作为后台任务运行）"""
+    while True:
+        try:
+            closed = await sweep_expired_sessions(batch_size)
+            if closed:
+                logger.info("自动关闭超时会话 %d 个", closed)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("超时会话清理失败")
+        await asyncio.sleep(interval)
+
+async def _run(args):
+    # 启动推送代理，使多进程部署中的在线客户端也能收到自动关闭通知
+    await hub.start()
+    try:
+        if args.once:
+            closed = await sweep_expired_sessions(args.batch_size)
+            print(f"自动关闭超时会话 {closed} 个")
+        else:
+            await run_sweeper(args.interval, args.batch_size)
+    finally:
+        await hub.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="超时会话清理")
+    parser.add_argument("--once", action="store_true", help="只清理一次")
+    parser.add_argument("--interval", type=float, default=SWEEP_INTERVAL_SECONDS, help="清理间隔（秒）")
+    parser.add_argument("--batch-size", type=int, default=SWEEP_BATCH_SIZE, help="每批处理的会话数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+测试用的内存集合 - 只实现计时和计划接口用到的查询、更新管道和表达式。
+每个操作开始时先让出一次事件循环，使并发请求在数据库操作处交错；操作本身是原子的，与单文档写入一致。
+"""
+import asyncio
+import copy
+import math
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.results import UpdateResult
+
+_MISSING = object()
+
+def _get(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return _MISSING
+        doc = doc[key]
+    return doc
+
+def _matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for op, arg in condition.items():
+            present = value is not _MISSING
+            if op == "$in" and not (present and value in arg):
+                return False
+            if op == "$ne" and present and value == arg:
+                return False
+            if op == "$exists" and present != arg:
+                return False
+            if op in ("$gt", "$gte", "$lt", "$lte"):
+                if not present or value is None or type(value) is not type(arg):
+                    return False
+                if not {"$gt": value > arg, "$gte": value >= arg, "$lt": value < arg, "$lte": value <= arg}[op]:
+                    return False
+        return True
+    if condition is None:
+        return value is _MISSING or value is None
+    return value is not _MISSING and value == condition
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == "$expr":
+            if not evaluate(condition, doc):
+                return False
+        elif not _matches_condition(_get(doc, key), condition):
+            return False
+    return True
+
+def evaluate(expr, doc: dict, variables: dict = None):
+    """聚合表达式求值（计时接口更新管道中用到的运算符）"""
+    variables = variables or {}
+    if isinstance(expr, str) and expr.startswith("$$"):
+        return variables[expr[2:]]
+    if isinstance(expr, str) and expr.startswith("$"):
+        value = _get(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict) or len(expr) != 1 or not next(iter(expr)).startswith("$"):
+        return expr
+    op, arg = next(iter(expr.items()))
+    if op == "$literal":
+        return arg
+    if op == "$map":
+        items = evaluate(arg["input"], doc, variables)
+        return [evaluate(arg["in"], doc, {**variables, arg["as"]: item}) for item in items]
+    args = evaluate(arg, doc, variables)
+    if op == "$add":
+        return sum(args)
+    if op == "$subtract":
+        difference = args[0] - args[1]
+        return difference.total_seconds() * 1000 if isinstance(args[0], datetime) else difference
+    if op == "$divide":
+        return args[0] / args[1]
+    if op == "$floor":
+        return math.floor(args)
+    if op == "$toInt":
+        return int(args)
+    if op == "$ifNull":
+        return args[1] if args[0] is None else args[0]
+    if op == "$gte":
+        return args[0] >= args[1]
+    if op == "$lt":
+        return args[0] < args[1]
+    if op == "$range":
+        return list(range(*args))
+    if op == "$arrayElemAt":
+        return args[0][args[1]] if args[0] is not None and args[1] < len(args[0]) else None
+    if op == "$cond":
+        return args[1] if args[0] else args[2]
+    raise NotImplementedError(op)
+
+def _project(doc: dict, projection: dict = None) -> dict:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if projection.get("_id", 1) == 0 and len(projection) == 1:
+        doc.pop("_id", None)
+        return doc
+    result = {}
+    for path, included in projection.items():
+        value = _get(doc, path)
+        if included and path != "_id" and value is not _MISSING:
+            _set(result, path, value)
+    if projection.get("_id", 1):
+        result["_id"] = doc["_id"]
+    return result
+
+def _set(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for key in parents:
+        doc = doc.setdefault(key, {})
+    doc[last] = value
+
+def _apply_update(doc: dict, update) -> dict:
+    doc = copy.deepcopy(doc)
+    if isinstance(update, list):
+        for stage in update:
+            (name, fields), = stage.items()
+            assert name == "$set", name
+            evaluated = {k: evaluate(v, doc) for k, v in fields.items()}
+            for key, value in evaluated.items():
+                _set(doc, key, value)
+        return doc
+    for key, value in update.get("$set", {}).items():
+        _set(doc, key, value)
+    for key, value in update.get("$inc", {}).items():
+        current = _get(doc, key)
+        _set(doc, key, (0 if current is _MISSING else current) + value)
+    return doc
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: d.get(key), reverse=direction == -1)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def limit(self, count):
+        if count:
+            self._docs = self._docs[:count]
+        return self
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(0)
+        return list(self._docs)
+
+    def __aiter__(self):
+        async def iterate():
+            for doc in self._docs:
+                yield doc
+        return iterate()
+
+class FakeCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self.docs = {}
+        self.calls = []
+
+    def _find(self, query):
+        return [doc for doc in self.docs.values() if matches(doc, query)]
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([_project(d, projection) for d in self._find(query or {})])
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        await asyncio.sleep(0)
+        found = self._find(query or {})
+        if sort:
+            key, direction = sort[0]
+            found.sort(key=lambda d: d.get(key), reverse=direction == -1)
+        return _project(found[0], projection) if found else None
+
+    async def insert_one(self, doc):
+        await asyncio.sleep(0)
+        doc.setdefault("_id", ObjectId())
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    async def update_one(self, query, update):
+        await asyncio.sleep(0)
+        found = self._find(query)[:1]
+        for doc in found:
+            self.docs[doc["_id"]] = _apply_update(doc, update)
+        return UpdateResult({"n": len(found), "nModified": len(found)}, True)
+
+    async def delete_one(self, query):
+        await asyncio.sleep(0)
+        for doc in self._find(query)[:1]:
+            del self.docs[doc["_id"]]
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=ReturnDocument.BEFORE,
+                                  projection=None):
+        await asyncio.sleep(0)
+        self.calls.append(("find_one_and_update", query))
+        found = self._find(query)
+        if found:
+            before = found[0]
+        elif upsert:
+            before = None
+        else:
+            return None
+        seed = before or {"_id": ObjectId(), **{
+            k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)
+        }}
+        after = _apply_update(seed, update)
+        self.docs[after["_id"]] = after
+        result = after if return_document == ReturnDocument.AFTER else before
+        return _project(result, projection) if result is not None else None
@@ -0,0 +1,79 @@
+"""切换下一副牙套：在数据库中原子递增，并发请求和其他进程过期的缓存都不会重复或回退"""
+import asyncio
+
+import httpx
+import pytest
+from bson import ObjectId
+from fastapi import FastAPI
+
+import dependencies
+import routers.plan as plan_router
+from dependencies import get_user_id
+from fake_mongo import FakeCollection
+
+USER_ID = str(ObjectId())
+TOTAL_SETS = 5
+
+@pytest.fixture
+def env(monkeypatch):
+    users = FakeCollection("users")
+    users.docs[ObjectId(USER_ID)] = {
+        "_id": ObjectId(USER_ID), "plan": {"current_set": 1, "total_sets": TOTAL_SETS}
+    }
+    versions = []
+
+    async def load_live_state(user_id, today):
+        return {}
+
+    async def bump_data_version(user_id):
+        versions.append(user_id)
+
+    monkeypatch.setattr(plan_router, "get_users_collection", lambda: users)
+    monkeypatch.setattr(plan_router, "load_live_state", load_live_state)
+    monkeypatch.setattr(plan_router, "bump_data_version", bump_data_version)
+
+    app = FastAPI()
+    app.include_router(plan_router.router)
+    app.dependency_overrides[get_user_id] = lambda: USER_ID
+    return app, users, versions
+
+async def post_next_set(app, count: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*[client.post("/plan/next-set") for _ in range(count)])
+
+def stored_set(users: FakeCollection) -> int:
+    return users.docs[ObjectId(USER_ID)]["plan"]["current_set"]
+
+def test_concurrent_next_set_stops_at_last_set(env):
+    app, users, versions = env
+
+    responses = asyncio.run(post_next_set(app, 10))
+
+    succeeded = sorted(r.json()["current_set"] for r in responses if r.status_code == 200)
+    assert succeeded == list(range(2, TOTAL_SETS + 1))
+    assert all(r.status_code == 400 for r in responses if r.status_code != 200)
+    assert stored_set(users) == TOTAL_SETS
+    assert len(versions) == TOTAL_SETS - 1
+
+def test_next_set_ignores_stale_user_cache(env):
+    app, users, versions = env
+    # 本进程缓存的还是第1副，其他进程已经把计划改到第3副
+    dependencies._user_cache.set(
+        USER_ID, {"_id": ObjectId(USER_ID), "plan": {"current_set": 1, "total_sets": TOTAL_SETS}}
+    )
+    users.docs[ObjectId(USER_ID)]["plan"]["current_set"] = 3
+
+    (response,) = asyncio.run(post_next_set(app, 1))
+
+    assert response.json()["current_set"] == 4
+    assert stored_set(users) == 4
+
+def test_next_set_unknown_user(env):
+    app, users, versions = env
+    users.docs.clear()
+
+    (response,) = asyncio.run(post_next_set(app, 1))
+
+    assert response.status_code == 404
+    assert versions == []
@@ -0,0 +1,63 @@
+"""读偏好分流：统计和导出按 ANALYTICS_READ_PREFERENCE 读取，计时读写和需要读到自己写入的路径始终使用主节点"""
+import pytest
+from pymongo.read_preferences import ReadPreference
+
+import achievements
+import database
+import live_state
+import response_cache
+import routers.timer
+import sweeper
+
+# 副本集连接串：只创建客户端、不发起请求，不需要实际的副本集
+REPLICA_SET_URL = "mongodb://db1.test:27017,db2.test:27017,db3.test:27017/?replicaSet=rs0&connect=false"
+
+@pytest.fixture
+def configure(monkeypatch):
+    def apply(mode: str, max_staleness: int = 90):
+        monkeypatch.setattr(database, "MONGODB_URL", REPLICA_SET_URL)
+        monkeypatch.setattr(database, "ANALYTICS_READ_PREFERENCE", mode)
+        monkeypatch.setattr(database, "ANALYTICS_MAX_STALENESS_SECONDS", max_staleness)
+        monkeypatch.setattr(database, "_client", None)
+    yield apply
+    database.close_client()
+    database._client = None
+
+PRIMARY_COLLECTIONS = [
+    database.get_users_collection,
+    database.get_timer_sessions_collection,
+    database.get_session_buckets_collection,
+    database.get_daily_records_collection,
+    database.get_achievement_summaries_collection,
+    database.get_user_states_collection,
+]
+
+@pytest.mark.parametrize("mode", ["secondary", "secondaryPreferred", "nearest", "primaryPreferred"])
+def test_analytics_reads_use_configured_preference(configure, mode):
+    configure(mode, max_staleness=120)
+    preference = database.get_analytics_daily_records_collection().read_preference
+    assert preference.name == database.READ_PREFERENCE_MODES[mode].name
+    assert preference.max_staleness == 120
+    assert database.get_analytics_db().read_preference == preference
+    assert database.reads_may_lag()
+
+def test_analytics_primary_mode(configure):
+    configure("primary")
+    assert database.get_analytics_daily_records_collection().read_preference == ReadPreference.PRIMARY
+    assert not database.reads_may_lag()
+
+def test_invalid_mode_is_rejected(configure):
+    configure("secondaryOnly")
+    with pytest.raises(ValueError):
+        database.get_analytics_db()
+
+@pytest.mark.parametrize("get_collection", PRIMARY_COLLECTIONS, ids=lambda f: f.__name__)
+def test_write_paths_stay_on_primary(configure, get_collection):
+    configure("secondary")
+    assert get_collection().read_preference == ReadPreference.PRIMARY
+    assert database.get_db().read_preference == ReadPreference.PRIMARY
+
+@pytest.mark.parametrize("module", [routers.timer, live_state, sweeper, achievements, response_cache])
+def test_read_your_writes_modules_do_not_use_analytics_reads(module):
+    # 计时、实时状态、成就汇总和数据版本号需要读到刚写入的数据，不能从从节点读取
+    assert not [name for name in vars(module) if name.startswith("get_analytics")]
@@ -0,0 +1,138 @@
+"""并发停止同一计时会话：只有一个请求生效，每日记录只累加一次"""
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from bson import ObjectId
+from fastapi import FastAPI
+
+import routers.timer as timer
+from dependencies import get_fresh_plan, get_user_id
+from fake_mongo import FakeCollection
+
+USER_ID = str(ObjectId())
+TARGET_HOURS = 2.0
+CONCURRENT_STOPS = 20
+
+@pytest.fixture
+def env(monkeypatch):
+    sessions = FakeCollection("timer_sessions")
+    records = FakeCollection("daily_records")
+    daily_updates = []
+    closed = []
+
+    async def record_daily_update(user_id, date, previous, completed, seconds):
+        daily_updates.append((date, previous, completed, seconds))
+
+    async def record_session_closed(user_id, session_id, date, total):
+        closed.append((session_id, date, total))
+
+    monkeypatch.setattr(timer, "get_timer_sessions_collection", lambda: sessions)
+    monkeypatch.setattr(timer, "get_daily_records_collection", lambda: records)
+    monkeypatch.setattr(timer, "record_daily_update", record_daily_update)
+    monkeypatch.setattr(timer, "record_session_closed", record_session_closed)
+
+    app = FastAPI()
+    app.include_router(timer.router)
+    app.dependency_overrides[get_user_id] = lambda: USER_ID
+    app.dependency_overrides[get_fresh_plan] = lambda: {"target_hours": TARGET_HOURS}
+    return app, sessions, records, daily_updates, closed
+
+def open_session(sessions: FakeCollection, started_ago: timedelta) -> ObjectId:
+    now = datetime.now()
+    # 不跨零点，会话时长全部计入当天
+    start_time = max(now - started_ago, now.replace(hour=0, minute=0, second=0, microsecond=0))
+    session_id = ObjectId()
+    sessions.docs[session_id] = {
+        "_id": session_id, "user_id": USER_ID, "start_time": start_time,
+        "end_time": None, "duration": None, "date": start_time.strftime("%Y-%m-%d")
+    }
+    return session_id
+
+async def stop_concurrently(app, session_id, headers=None):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*[
+            client.post("/timer/stop", json={"session_id": str(session_id)}, headers=headers or {})
+            for _ in range(CONCURRENT_STOPS)
+        ])
+
+def test_concurrent_stops_credit_once(env):
+    app, sessions, records, daily_updates, closed = env
+    session_id = open_session(sessions, timedelta(hours=1))
+
+    responses = asyncio.run(stop_concurrently(app, session_id))
+
+    succeeded = [r for r in responses if r.status_code == 200]
+    assert len(succeeded) == 1
+    assert all(r.status_code == 400 for r in responses if r.status_code != 200)
+
+    session = sessions.docs[session_id]
+    duration = succeeded[0].json()["duration"]
+    assert session["end_time"] is not None and session["duration"] == duration
+
+    (record,) = records.docs.values()
+    assert record["date"] == session["date"]
+    assert record["total_seconds"] == duration
+    assert record["completed"] is (duration >= TARGET_HOURS * 3600)
+    assert sum(record["hourly_seconds"]) == duration
+    assert len(daily_updates) == 1 and len(closed) == 1
+
+def test_concurrent_retries_with_idempotency_key(env):
+    app, sessions, records, daily_updates, closed = env
+    session_id = open_session(sessions, timedelta(minutes=30))
+    date = sessions.docs[session_id]["date"]
+    # 当天已有接近目标的记录，本次停止后达标
+    existing = int(TARGET_HOURS * 3600) - 60
+    records.docs["existing"] = {"_id": "existing", "user_id": USER_ID, "date": date,
+                                "total_seconds": existing, "completed": False}
+
+    responses = asyncio.run(stop_concurrently(app, session_id, {"Idempotency-Key": "stop-1"}))
+
+    assert all(r.status_code == 200 for r in responses)
+    bodies = [r.json() for r in responses]
+    duration = sessions.docs[session_id]["duration"]
+    assert {(b["duration"], b["today_total"], b["completed"]) for b in bodies} == {
+        (duration, existing + duration, existing + duration >= TARGET_HOURS * 3600)
+    }
+
+    record = records.docs["existing"]
+    assert len(records.docs) == 1
+    assert record["total_seconds"] == existing + duration
+    assert record["completed"] is True
+    assert len(daily_updates) == 1 and len(closed) == 1
+
+def test_stop_across_midnight_keeps_overflow_on_start_date(env, monkeypatch):
+    app, sessions, records, daily_updates, closed = env
+    now = datetime(2024, 3, 2, 1, 30)
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(timer, "datetime", FixedDatetime)
+    session_id = ObjectId()
+    sessions.docs[session_id] = {
+        "_id": session_id, "user_id": USER_ID, "start_time": datetime(2024, 3, 1, 22, 0),
+        "end_time": None, "duration": None, "date": "2024-03-01"
+    }
+
+    async def stop():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/timer/stop", json={"session_id": str(session_id)})
+
+    response = asyncio.run(stop())
+    assert response.status_code == 200
+    assert response.json()["duration"] == 3.5 * 3600
+
+    # 次日部分记在开始当天的记录上，不创建时长为0的次日记录
+    (record,) = records.docs.values()
+    assert record["date"] == "2024-03-01"
+    assert record["total_seconds"] == 3.5 * 3600
+    assert record["completed"] is True
+    assert record["hourly_seconds"] == [0] * 22 + [3600, 3600]
+    assert record["next_day_hourly_seconds"] == [3600, 1800] + [0] * 22
+    assert [update[0] for update in daily_updates] == ["2024-03-01"]
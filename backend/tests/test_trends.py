@@ -0,0 +1,66 @@
+"""趋势分析的范围截至昨天：今天还没有每日记录时不能按0小时计"""
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import trends
+from fake_mongo import FakeCollection
+from schema import user_key, day_key
+
+TODAY = datetime(2024, 5, 20)
+HISTORY_DAYS = 59
+HOURS_PER_DAY = 22.5
+PLAN = {"target_hours": 22.0}
+
+def history(user_id: str, days: int = HISTORY_DAYS) -> list:
+    """今天之前每天佩戴 HOURS_PER_DAY 小时，今天还没有停止过计时（没有记录）"""
+    return [
+        {"user_id": user_id, "date": (TODAY - timedelta(days=i)).strftime("%Y-%m-%d"),
+         "total_seconds": int(HOURS_PER_DAY * 3600)}
+        for i in range(days, 0, -1)
+    ]
+
+def records_collection(monkeypatch, records: list) -> FakeCollection:
+    collection = FakeCollection("daily_records")
+    for record in records:
+        _id = ObjectId()
+        collection.docs[_id] = {**record, "_id": _id,
+                                "user_id": user_key(record["user_id"]), "date": day_key(record["date"])}
+    monkeypatch.setattr(trends, "get_analytics_daily_records_collection", lambda: collection)
+    return collection
+
+def test_today_without_record_is_not_counted():
+    trend = trends.analyze_records(history(str(ObjectId())), PLAN, TODAY)
+
+    assert trend.end_date == "2024-05-19"
+    assert trend.observed_days == HISTORY_DAYS
+    assert trend.avg_hours == HOURS_PER_DAY
+    assert trend.rolling_avg_hours[-1] == HOURS_PER_DAY
+    assert trend.completion_rate == 100.0
+    assert trend.trend_hours_per_week == 0
+    assert trend.risk == 0
+    assert trends.trend_suggestions(trend) == []
+
+def test_load_trend_ignores_partial_today(monkeypatch):
+    user_id = str(ObjectId())
+    # 今天已停止过一次计时，但这一天还没有结束
+    today_record = {"user_id": user_id, "date": TODAY.strftime("%Y-%m-%d"), "total_seconds": 3600}
+    records_collection(monkeypatch, history(user_id) + [today_record])
+
+    trend = asyncio.run(trends.load_trend(user_id, PLAN, TODAY))
+
+    assert trend.observed_days == HISTORY_DAYS
+    assert trend.rolling_avg_hours[-1] == HOURS_PER_DAY
+    assert trend.completion_rate == 100.0
+
+def test_score_users_window_ends_yesterday(monkeypatch):
+    users = [{"_id": ObjectId(), "plan": PLAN} for _ in range(3)]
+    records_collection(monkeypatch, [r for u in users for r in history(str(u["_id"]))])
+
+    scores, _ = asyncio.run(trends.score_users(users, trends.TREND_WINDOW_DAYS, TODAY))
+
+    assert list(scores["observed_days"]) == [HISTORY_DAYS] * 3
+    assert list(scores["rolling"][:, -1]) == [HOURS_PER_DAY] * 3
+    assert list(scores["completion_rate"]) == [1.0] * 3
+    assert list(scores["risk"]) == [0.0] * 3
@@ -0,0 +1,335 @@
+"""
+长期趋势分析 - 把每日佩戴时长装入 NumPy 数组，向量化计算滚动平均、星期分布、趋势斜率和每副牙套的达标率。
+
+单个用户和批量评分共用同一组按矩阵（用户 x 天）计算的函数：单个用户就是只有一行的矩阵。
+分析范围为截至昨天的最近 TREND_WINDOW_DAYS 天，当前这副牙套开始得更早时扩展到整副牙套。
+今天还没有结束（第一次停止计时前也没有每日记录），不参与统计，否则会被当作0小时。
+
+用法:
+    python trends.py score                  为全部用户评分并输出吞吐（夜间任务）
+    python trends.py score --save           同时写入 user_trends 集合
+    python trends.py score --user-id ID     只评分指定用户并输出明细
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import get_analytics_daily_records_collection, get_users_collection, get_user_trends_collection, close_client
+from models import PlanModel, TrendStats, SetCompliance
+from schema import user_match, users_match, day_range_query, from_storage
+
+TREND_WINDOW_DAYS = 90
+ROLLING_DAYS = 7
+MAX_TREND_DAYS = 3660
+SCORE_CHUNK_SIZE = 2000
+WEEKDAY_NAMES = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
+# 1970-01-01 是周四，按天数计算星期几（周一为0）
+EPOCH_WEEKDAY = 3
+
+def current_set_start(plan: dict) -> Optional[datetime]:
+    """当前这副牙套的开始日期（计划没有开始日期时为None）"""
+    if not plan.get("start_date"):
+        return None
+    try:
+        first = datetime.strptime(plan["start_date"], "%Y-%m-%d")
+    except ValueError:
+        return None
+    days_per_set = plan.get("days_per_set") or PlanModel().days_per_set
+    return first + timedelta(days=(plan.get("current_set", 1) - 1) * days_per_set)
+
+def analysis_end(today: datetime) -> datetime:
+    """分析范围的结束日期：昨天（今天还没有结束）"""
+    return today - timedelta(days=1)
+
+def analysis_start(plan: dict, today: datetime) -> datetime:
+    """分析范围的开始日期：截至昨天的最近 TREND_WINDOW_DAYS 天，或更早开始的当前这副牙套"""
+    end = analysis_end(today)
+    start = end - timedelta(days=TREND_WINDOW_DAYS - 1)
+    set_start = current_set_start(plan)
+    if set_start is not None and set_start < start:
+        start = max(set_start, end - timedelta(days=MAX_TREND_DAYS - 1))
+    return start
+
+def day_numbers(dates) -> np.ndarray:
+    """YYYY-MM-DD 字符串数组转换为自1970-01-01起的天数"""
+    return np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+
+def fill_matrix(rows: np.ndarray, day_index: np.ndarray, seconds: np.ndarray,
+                users: int, days: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    把 (行, 天, 秒数) 三元组填入 用户 x 天 的小时矩阵。
+    返回 (小时矩阵, 有效天掩码)：每个用户从第一条记录开始算起，之前的天不参与统计，之后没有记录的天按0小时计。
+    """
+    hours = np.zeros((users, days))
+    inside = (day_index >= 0) & (day_index < days)
+    rows, day_index, seconds = rows[inside], day_index[inside], seconds[inside]
+    hours[rows, day_index] = seconds / 3600
+
+    first = np.full(users, days)
+    np.minimum.at(first, rows, day_index)
+    mask = np.arange(days)[None, :] >= first[:, None]
+    return hours, mask
+
+def score_matrix(hours: np.ndarray, mask: np.ndarray, targets: np.ndarray, first_day: int) -> Dict[str, np.ndarray]:
+    """按行向量化计算趋势指标；first_day 为第一列对应的天数（用于确定星期几）"""
+    users, days = hours.shape
+    weights = mask.astype(float)
+    worn = hours * weights
+    observed = weights.sum(axis=1)
+    safe_observed = np.maximum(observed, 1)
+
+    avg_hours = worn.sum(axis=1) / safe_observed
+    completed = ((hours >= targets[:, None]) & mask).sum(axis=1)
+    completion_rate = completed / safe_observed
+
+    # 最近 ROLLING_DAYS 天的滚动平均（按有效天数）
+    window = min(ROLLING_DAYS, days)
+    kernel_sum = np.cumsum(np.pad(worn, ((0, 0), (1, 0))), axis=1)
+    kernel_count = np.cumsum(np.pad(weights, ((0, 0), (1, 0))), axis=1)
+    rolling = (kernel_sum[:, window:] - kernel_sum[:, :-window]) / np.maximum(
+        kernel_count[:, window:] - kernel_count[:, :-window], 1
+    )
+
+    # 最小二乘斜率（小时/天）
+    x = np.arange(days, dtype=float)
+    sx = weights @ x
+    sxx = weights @ (x * x)
+    sy = worn.sum(axis=1)
+    sxy = worn @ x
+    denominator = observed * sxx - sx * sx
+    slope = np.where(denominator > 0, (observed * sxy - sx * sy) / np.where(denominator > 0, denominator, 1), 0.0)
+
+    # 星期分布：周一..周日的平均小时数
+    weekday = (first_day + np.arange(days) + EPOCH_WEEKDAY) % 7
+    one_hot = np.eye(7)[weekday]
+    weekday_count = weights @ one_hot
+    weekday_profile = np.where(weekday_count > 0, (worn @ one_hot) / np.maximum(weekday_count, 1), np.nan)
+
+    # 风险分数 0~1：近期平均低于目标、下降趋势和整体达标率低都会提高风险
+    recent = rolling[:, -1]
+    shortfall = np.clip((targets - recent) / targets * 2, 0, 1)
+    decline = np.clip(-slope * 7 / 2, 0, 1)
+    risk = 0.5 * shortfall + 0.3 * decline + 0.2 * (1 - completion_rate)
+    risk = np.where(observed > 0, risk, np.nan)
+
+    return {
+        "observed_days": observed.astype(int),
+        "avg_hours": avg_hours,
+        "completion_rate": completion_rate,
+        "rolling": rolling,
+        "slope": slope,
+        "weekday_profile": weekday_profile,
+        "risk": risk,
+    }
+
+def set_compliance(hours: np.ndarray, mask: np.ndarray, target: float, start: datetime,
+                   plan: dict) -> List[SetCompliance]:
+    """范围内每副牙套的平均时长和达标率（单个用户）"""
+    if not plan.get("start_date"):
+        return []
+    try:
+        first = datetime.strptime(plan["start_date"], "%Y-%m-%d")
+    except ValueError:
+        return []
+    days_per_set = plan.get("days_per_set") or PlanModel().days_per_set
+    offset = (start - first).days
+    set_numbers = (offset + np.arange(hours.size)) // days_per_set + 1
+    valid = mask & (set_numbers >= 1)
+    if not valid.any():
+        return []
+
+    numbers = set_numbers[valid]
+    base = numbers.min()
+    counts = np.bincount(numbers - base)
+    sums = np.bincount(numbers - base, weights=hours[valid])
+    completed = np.bincount(numbers - base, weights=(hours[valid] >= target).astype(float))
+    return [
+        SetCompliance(
+            set_number=int(base + i),
+            days=int(counts[i]),
+            avg_hours=round(float(sums[i] / counts[i]), 1),
+            completion_rate=round(float(completed[i] / counts[i] * 100), 1)
+        )
+        for i in range(len(counts)) if counts[i]
+    ]
+
+def analyze_records(records: List[dict], plan: dict, today: datetime) -> TrendStats:
+    """根据一个用户的每日记录计算趋势（today 当天及之后的记录不参与统计）"""
+    target = plan.get("target_hours", 22.0)
+    start = analysis_start(plan, today)
+    end = analysis_end(today)
+    days = (end - start).days + 1
+    first_day = int(day_numbers([start.strftime("%Y-%m-%d")])[0])
+
+    dates = [r["date"] for r in records]
+    hours, mask = fill_matrix(
+        np.zeros(len(records), dtype=np.int64),
+        day_numbers(dates) - first_day if dates else np.zeros(0, dtype=np.int64),
+        np.array([r.get("total_seconds", 0) for r in records], dtype=float),
+        1, days
+    )
+    scores = score_matrix(hours, mask, np.array([target]), first_day)
+    rolling = scores["rolling"][0]
+    observed = int(scores["observed_days"][0])
+    rolling_days = min(observed, len(rolling))
+
+    return TrendStats(
+        start_date=start.strftime("%Y-%m-%d"),
+        end_date=end.strftime("%Y-%m-%d"),
+        days=days,
+        observed_days=observed,
+        target_hours=target,
+        avg_hours=round(float(scores["avg_hours"][0]), 1),
+        completion_rate=round(float(scores["completion_rate"][0] * 100), 1),
+        rolling_avg_hours=[round(float(v), 1) for v in rolling[len(rolling) - rolling_days:]],
+        trend_hours_per_week=round(float(scores["slope"][0] * 7), 2),
+        weekday_avg_hours=[None if np.isnan(v) else round(float(v), 1) for v in scores["weekday_profile"][0]],
+        sets=set_compliance(hours[0], mask[0], target, start, plan),
+        risk=None if np.isnan(scores["risk"][0]) else round(float(scores["risk"][0]), 2)
+    )
+
+def trend_suggestions(trend: TrendStats) -> List[str]:
+    """根据长期趋势生成建议"""
+    suggestions = []
+    if trend.observed_days < ROLLING_DAYS:
+        return suggestions
+    target = trend.target_hours
+
+    recent = trend.rolling_avg_hours[-1] if trend.rolling_avg_hours else trend.avg_hours
+    if trend.trend_hours_per_week <= -0.5:
+        suggestions.append(f"最近佩戴时间呈下降趋势（每周约少{-trend.trend_hours_per_week:.1f}小时），注意调整")
+    elif trend.trend_hours_per_week >= 0.5 and recent < target:
+        suggestions.append("佩戴时间在稳步提升，继续保持！")
+
+    if recent < target:
+        suggestions.append(f"近{ROLLING_DAYS}天平均每天{recent:.1f}小时，距离目标还差{target - recent:.1f}小时")
+
+    profile = [(hours, i) for i, hours in enumerate(trend.weekday_avg_hours) if hours is not None]
+    if len(profile) == 7:
+        weakest, weekday = min(profile)
+        average = sum(h for h, _ in profile) / 7
+        if weakest < target * 0.9 and weakest < average - 1:
+            suggestions.append(f"{WEEKDAY_NAMES[weekday]}的平均佩戴时间最短（{weakest:.1f}小时），可以提前安排")
+
+    if trend.sets:
+        current = trend.sets[-1]
+        if current.days >= ROLLING_DAYS and current.completion_rate < 70:
+            suggestions.append(f"第{current.set_number}副牙套目前达标率{current.completion_rate:.0f}%，换下一副前多戴一些效果更好")
+        elif len(trend.sets) >= 2 and current.completion_rate >= trend.sets[-2].completion_rate + 15:
+            suggestions.append(f"第{current.set_number}副牙套的达标率比上一副明显提高，做得很好！")
+    return suggestions
+
+async def load_trend(user_id: str, plan: dict, today: Optional[datetime] = None) -> TrendStats:
+    """读取用户分析范围内的每日记录并计算趋势"""
+    today = today or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = analysis_start(plan, today)
+    records = await get_analytics_daily_records_collection().find(
+        {"user_id": user_match(user_id),
+         **day_range_query(start.strftime("%Y-%m-%d"), analysis_end(today).strftime("%Y-%m-%d"))},
+        {"_id": 0, "date": 1, "total_seconds": 1}
+    ).to_list(length=None)
+    return analyze_records([from_storage(r) for r in records], plan, today)
+
+async def score_users(users: List[dict], days: int, today: datetime) -> Tuple[Dict[str, np.ndarray], float]:
+    """批量评分一组用户（按截至昨天的最近 days 天），返回 (指标数组, 计算耗时秒)"""
+    end = analysis_end(today)
+    start = end - timedelta(days=days - 1)
+    first_day = int(day_numbers([start.strftime("%Y-%m-%d")])[0])
+    row_of = {str(u["_id"]): i for i, u in enumerate(users)}
+    targets = np.array([(u.get("plan") or {}).get("target_hours", 22.0) for u in users], dtype=float)
+
+    records = await get_analytics_daily_records_collection().find(
+        {"user_id": users_match(list(row_of)),
+         **day_range_query(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))},
+        {"_id": 0, "user_id": 1, "date": 1, "total_seconds": 1}
+    ).batch_size(10000).to_list(length=None)
+    records = [from_storage(r) for r in records]
+
+    started = time.perf_counter()
+    hours, mask = fill_matrix(
+        np.fromiter((row_of[r["user_id"]] for r in records), dtype=np.int64, count=len(records)),
+        day_numbers([r["date"] for r in records]) - first_day if records else np.zeros(0, dtype=np.int64),
+        np.fromiter((r.get("total_seconds", 0) for r in records), dtype=float, count=len(records)),
+        len(users), days
+    )
+    scores = score_matrix(hours, mask, targets, first_day)
+    return scores, time.perf_counter() - started
+
+async def _score(args):
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if args.user_id:
+        user = await get_users_collection().find_one({"_id": ObjectId(args.user_id)})
+        if not user:
+            print("用户不存在")
+            return
+        trend = await load_trend(args.user_id, user.get("plan", {}), today)
+        print(trend.model_dump_json(indent=2))
+        for suggestion in trend_suggestions(trend):
+            print(f"- {suggestion}")
+        return
+
+    started = time.perf_counter()
+    compute_seconds = 0.0
+    scored = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        users = await get_users_collection().find(query, {"plan.target_hours": 1}).sort("_id", 1).limit(
+            args.chunk_size
+        ).to_list(length=None)
+        if not users:
+            break
+        last_id = users[-1]["_id"]
+        scores, seconds = await score_users(users, args.days, today)
+        compute_seconds += seconds
+        scored += len(users)
+
+        if args.save:
+            await get_user_trends_collection().bulk_write([
+                UpdateOne({"_id": str(user["_id"])}, {"$set": {
+                    "date": today.strftime("%Y-%m-%d"),
+                    "days": args.days,
+                    "observed_days": int(scores["observed_days"][i]),
+                    "avg_hours": round(float(scores["avg_hours"][i]), 2),
+                    "completion_rate": round(float(scores["completion_rate"][i]), 4),
+                    "rolling_avg_hours": round(float(scores["rolling"][i, -1]), 2),
+                    "trend_hours_per_week": round(float(scores["slope"][i] * 7), 3),
+                    "risk": None if np.isnan(scores["risk"][i]) else round(float(scores["risk"][i]), 3),
+                    "updated_at": datetime.now()
+                }}, upsert=True)
+                for i, user in enumerate(users)
+            ], ordered=False)
+
+    elapsed = time.perf_counter() - started
+    if scored:
+        print(f"评分 {scored} 个用户, 总用时 {elapsed:.1f} 秒 ({scored / elapsed:.0f} 用户/秒), "
+              f"其中计算 {compute_seconds:.2f} 秒 ({scored / max(compute_seconds, 1e-9):.0f} 用户/秒)")
+    else:
+        print("没有用户")
+
+async def _run(args):
+    try:
+        await _score(args)
+    finally:
+        close_client()
+
+def main():
+    parser = argparse.ArgumentParser(description="佩戴趋势分析")
+    parser.add_argument("command", choices=["score"])
+    parser.add_argument("--days", type=int, default=TREND_WINDOW_DAYS, help="批量评分的天数")
+    parser.add_argument("--chunk-size", type=int, default=SCORE_CHUNK_SIZE, help="每批评分的用户数")
+    parser.add_argument("--user-id", default=None, help="只分析指定用户并输出明细")
+    parser.add_argument("--save", action="store_true", help="把评分写入 user_trends 集合")
+    args = parser.parse_args()
+    if args.user_id and not ObjectId.is_valid(args.user_id):
+        parser.error("无效的用户ID")
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+微信接口客户端 - 登录时调用 jscode2session 换取 openid。
+
+整个应用共用一个连接池化的 httpx.AsyncClient（保持长连接，避免每次登录重新建立 TCP+TLS），
+并设置严格的连接/读取超时、并发上限和熔断器：微信接口连续失败达到阈值后短时间内直接拒绝，
+不再占用工作协程等待超时。
+"""
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+
+from config import (
+    WECHAT_APPID, WECHAT_SECRET, WECHAT_API_URL,
+    WECHAT_CONNECT_TIMEOUT, WECHAT_READ_TIMEOUT,
+    WECHAT_MAX_CONNECTIONS, WECHAT_MAX_CONCURRENCY,
+    WECHAT_BREAKER_THRESHOLD, WECHAT_BREAKER_RESET_SECONDS,
+)
+
+# 微信返回"系统繁忙"，视为上游故障计入熔断
+SYSTEM_BUSY_ERRCODE = -1
+
+class WeChatUnavailable(Exception):
+    """微信接口不可用（超时、网络错误、5xx 或熔断打开）"""
+
+class CircuitBreaker:
+    """连续失败计数熔断器：打开后经过 reset_seconds 进入半开状态，只放行一个探测请求"""
+
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        """请求结束但没有得出上游是否恢复（被取消、本地排队超时等），允许下一个请求重新探测"""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+class WeChatClient:
+    """应用生命周期内共享的 jscode2session 客户端"""
+
+    def __init__(self, base_url: str = WECHAT_API_URL):
+        self.base_url = base_url.rstrip("/")
+        self.breaker = CircuitBreaker(WECHAT_BREAKER_THRESHOLD, WECHAT_BREAKER_RESET_SECONDS)
+        self._semaphore = asyncio.Semaphore(WECHAT_MAX_CONCURRENCY)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(WECHAT_READ_TIMEOUT, connect=WECHAT_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=WECHAT_MAX_CONNECTIONS,
+                    max_keepalive_connections=WECHAT_MAX_CONNECTIONS,
+                ),
+            )
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def code2session(self, code: str) -> dict:
+        """用登录凭证换取 openid/session_key，返回微信原始响应（可能带 errcode）"""
+        probing = self.breaker.state == "half_open"
+        if not self.breaker.allow():
+            raise WeChatUnavailable("微信接口熔断中")
+        try:
+            return await self._code2session(code)
+        finally:
+            # 半开状态的探测请求无论以何种方式结束（包括被取消）都要释放，否则熔断器一直拒绝
+            if probing:
+                self.breaker.release_probe()
+
+    async def _code2session(self, code: str) -> dict:
+        if self._client is None:
+            await self.start()
+
+        params = {
+            "appid": WECHAT_APPID,
+            "secret": WECHAT_SECRET,
+            "js_code": code,
+            "grant_type": "authorization_code"
+        }
+        try:
+            # 等待并发名额的时间也计入连接超时，避免排队请求无限堆积
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=WECHAT_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            # 本地排队超时不代表微信接口故障，不计入熔断
+            raise WeChatUnavailable("微信接口并发已满")
+        try:
+            response = await self._client.get("/sns/jscode2session", params=params)
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            self.breaker.record_failure()
+            raise WeChatUnavailable(f"微信接口调用失败: {e!r}") from e
+        finally:
+            self._semaphore.release()
+
+        if data.get("errcode") == SYSTEM_BUSY_ERRCODE:
+            self.breaker.record_failure()
+            raise WeChatUnavailable("微信接口系统繁忙")
+        self.breaker.record_success()
+        return data
+
+wechat_client = WeChatClient()
@@ -19,7 +19,8 @@ Page({
   },
 
   timer: null,
-  syncTimer: null,  // 定期同步定时器
+  syncTimer: null,  // 定期同步定时器（推送连接不可用时使用）
+  socketTask: null, // 状态推送连接
 
   onLoad() {
     this.checkLoginAndLoadStatus()
@@ -33,11 +34,14 @@ Page({
 
   onHide() {
     this.stopDisplayTimer()
+    this.stopSyncTimer()
+    this.disconnectPush()
   },
 
   onUnload() {
     this.stopDisplayTimer()
     this.stopSyncTimer()
+    this.disconnectPush()
   },
 
   // 检查登录状态并加载数据
@@ -82,40 +86,136 @@ Page({
   // 加载计时状态（从服务器）
   async loadTimerStatus() {
     try {
-      const status = await api.timer.getStatus()
+      // 先同步离线期间记录的事件
+      await this.flushOfflineEvents()
       
-      // 计算服务器时间与本地时间的偏移
-      const serverTime = new Date(status.server_time)
-      const localTime = new Date()
-      const offset = serverTime.getTime() - localTime.getTime()
+      const status = await api.timer.getStatus()
+      this.applyStatus(status)
       
+      // 通过推送通道接收后续状态变化
+      this.connectPush()
+    } catch (err) {
+      console.error('加载状态失败:', err)
+      this.handleOfflineMode()
+    }
+  },
+
+  // 应用服务器返回的完整状态
+  applyStatus(status) {
+    // 计算服务器时间与本地时间的偏移
+    const serverTime = new Date(status.server_time)
+    const localTime = new Date()
+    const offset = serverTime.getTime() - localTime.getTime()
+    
+    this.setData({
+      isWearing: status.is_wearing,
+      sessionId: status.session_id,
+      startTime: status.start_time ? new Date(status.start_time) : null,
+      serverTimeOffset: offset,
+      todayTotal: status.today_total,
+      targetSeconds: status.target_seconds,
+      statusText: status.is_wearing ? '佩戴中，点击停止' : '点击开始佩戴',
+      offline: false,
+      lastSyncTime: new Date()
+    })
+    
+    // 保存到本地缓存（仅作为显示备份）
+    this.saveLocalCache()
+    
+    this.updateDisplay()
+    
+    if (status.is_wearing) {
+      this.startDisplayTimer()
+    } else {
+      this.stopDisplayTimer()
+      this.stopSyncTimer()
+    }
+  },
+
+  // 连接状态推送通道（连接断开时退回定期同步）
+  connectPush() {
+    if (this.socketTask) return
+    
+    const task = api.timer.connect()
+    this.socketTask = task
+    
+    task.onOpen(() => {
+      this.stopSyncTimer()
+    })
+    task.onMessage((res) => {
+      this.handlePushMessage(JSON.parse(res.data))
+    })
+    task.onClose(() => {
+      if (this.socketTask !== task) return
+      this.socketTask = null
+      if (this.data.isWearing) {
+        this.startSyncTimer()
+      }
+    })
+  },
+
+  // 断开状态推送通道
+  disconnectPush() {
+    const task = this.socketTask
+    if (task) {
+      this.socketTask = null
+      task.close({})
+    }
+  },
+
+  // 处理推送消息：snapshot 完整状态，delta 状态变化，tick 校时
+  handlePushMessage(message) {
+    if (message.type === 'snapshot') {
+      this.applyStatus(message)
+      return
+    }
+    
+    const offset = new Date(message.server_time).getTime() - Date.now()
+    
+    if (message.type === 'tick') {
       this.setData({
-        isWearing: status.is_wearing,
-        sessionId: status.session_id,
-        startTime: status.start_time ? new Date(status.start_time) : null,
         serverTimeOffset: offset,
-        todayTotal: status.today_total,
-        targetSeconds: status.target_seconds,
-        statusText: status.is_wearing ? '佩戴中，点击停止' : '点击开始佩戴',
-        offline: false,
         lastSyncTime: new Date()
       })
-      
-      // 保存到本地缓存（仅作为显示备份）
-      this.saveLocalCache()
-      
-      this.updateDisplay()
-      
-      if (status.is_wearing) {
-        this.startDisplayTimer()
-        this.startSyncTimer()  // 计时中定期同步
-      } else {
-        this.stopSyncTimer()
+      return
+    }
+    
+    if (message.event === 'synced') {
+      // 其他设备同步了离线事件，重新加载完整状态
+      this.loadTimerStatus()
+      return
+    }
+    
+    if (message.event === 'started') {
+      this.setData({
+        isWearing: true,
+        sessionId: message.session_id,
+        startTime: new Date(message.start_time),
+        serverTimeOffset: offset,
+        statusText: '佩戴中，点击停止'
+      })
+      this.startDisplayTimer()
+    } else {
+      const data = {
+        isWearing: false,
+        sessionId: null,
+        startTime: null,
+        serverTimeOffset: offset,
+        statusText: '点击开始佩戴'
+      }
+      if (message.date === this.getTodayDate() && message.today_total !== undefined) {
+        data.todayTotal = message.today_total
+      }
+      this.setData(data)
+      this.stopDisplayTimer()
+      this.stopSyncTimer()
+      if (message.event === 'auto_closed') {
+        this.loadTimerStatus()
       }
-    } catch (err) {
-      console.error('加载状态失败:', err)
-      this.handleOfflineMode()
     }
+    
+    this.updateDisplay()
+    this.saveLocalCache()
   },
 
   // 处理离线模式
@@ -159,13 +259,9 @@ Page({
   async onToggleTimer() {
     if (this.data.loading) return
     
-    // 离线模式下禁止操作
+    // 离线模式下记录事件，恢复连接后批量同步
     if (this.data.offline) {
-      wx.showModal({
-        title: '无法操作',
-        content: '当前处于离线模式，请检查网络连接后重试',
-        showCancel: false
-      })
+      this.toggleOffline()
       // 尝试重新连接
       this.loadTimerStatus()
       return
@@ -203,7 +299,9 @@ Page({
       })
       
       this.startDisplayTimer()
-      this.startSyncTimer()
+      if (!this.socketTask) {
+        this.startSyncTimer()
+      }
       this.saveLocalCache()
       
       wx.showToast({
@@ -301,6 +399,68 @@ Page({
     }
   },
 
+  // 离线切换佩戴状态（本地计时，事件排队等待同步）
+  toggleOffline() {
+    const now = new Date()
+    
+    if (this.data.isWearing) {
+      let todayTotal = this.data.todayTotal
+      if (this.data.startTime) {
+        todayTotal += Math.max(0, Math.floor((now - this.data.startTime) / 1000))
+      }
+      this.queueOfflineEvent('stop', now)
+      this.stopDisplayTimer()
+      this.setData({
+        isWearing: false,
+        sessionId: null,
+        startTime: null,
+        todayTotal: todayTotal,
+        statusText: '已停止（离线，待同步）'
+      })
+    } else {
+      this.queueOfflineEvent('start', now)
+      this.setData({
+        isWearing: true,
+        startTime: now,
+        serverTimeOffset: 0,
+        statusText: '佩戴中（离线，待同步）'
+      })
+      this.startDisplayTimer()
+    }
+    
+    this.updateDisplay()
+    this.saveLocalCache()
+  },
+
+  // 记录离线事件
+  queueOfflineEvent(type, time) {
+    const events = wx.getStorageSync('pending_timer_events') || []
+    events.push({
+      client_id: `${time.getTime()}-${Math.random().toString(36).slice(2, 10)}`,
+      type: type,
+      time: time.toISOString()
+    })
+    wx.setStorageSync('pending_timer_events', events)
+  },
+
+  // 批量上传离线事件（重复上传由服务器按 client_id 去重）
+  async flushOfflineEvents() {
+    const events = wx.getStorageSync('pending_timer_events') || []
+    if (!events.length) return
+    
+    const result = await api.timer.sync(events)
+    wx.removeStorageSync('pending_timer_events')
+    
+    const rejected = result.results.filter(r => r.status === 'rejected')
+    if (rejected.length) {
+      console.warn('部分离线记录未能同步:', rejected)
+      wx.showToast({
+        title: `${rejected.length}条离线记录未能同步`,
+        icon: 'none'
+      })
+    }
+  },
+
   // 启动显示更新定时器
   startDisplayTimer() {
     this.stopDisplayTimer()
@@ -1,6 +1,7 @@
 // API配置
 const BASE_URL = 'http://localhost:8001/api'  // 开发环境
 // const BASE_URL = 'https://你的域名/api'  // 生产环境
+const WS_URL = BASE_URL.replace(/^http/, 'ws')
 
 // 获取存储的token
 function getToken() {
@@ -17,10 +18,18 @@ function clearToken() {
   wx.removeStorageSync('token')
 }
 
+// GET响应缓存：url -> { etag, data }，服务器返回304时直接使用缓存数据
+const etagCache = {}
+
 // 封装请求
-function request(url, method = 'GET', data = null) {
+function request(url, method = 'GET', data = null, header = {}) {
   return new Promise((resolve, reject) => {
     const token = getToken()
+    const cacheKey = method === 'GET' ? `${token}|${url}|${JSON.stringify(data)}` : null
+    const cached = cacheKey && etagCache[cacheKey]
+    if (cached) {
+      header = { 'If-None-Match': cached.etag, ...header }
+    }
     
     wx.request({
       url: BASE_URL + url,
@@ -28,11 +37,18 @@ function request(url, method = 'GET', data = null) {
       data: data,
       header: {
         'Content-Type': 'application/json',
-        'Authorization': token ? `Bearer ${token}` : ''
+        'Authorization': token ? `Bearer ${token}` : '',
+        ...header
       },
       success: (res) => {
         if (res.statusCode === 200) {
+          const etag = res.header && (res.header.ETag || res.header.Etag || res.header.etag)
+          if (cacheKey && etag) {
+            etagCache[cacheKey] = { etag, data: res.data }
+          }
           resolve(res.data)
+        } else if (res.statusCode === 304 && cached) {
+          resolve(cached.data)
         } else if (res.statusCode === 401) {
           // Token过期，清除并提示重新登录
           clearToken()
@@ -61,7 +77,10 @@ function login(code) {
 const timer = {
   getStatus: () => request('/timer/status'),
   start: () => request('/timer/start', 'POST', {}),  // 不传时间，由服务器生成
-  stop: (sessionId) => request('/timer/stop', 'POST', { session_id: sessionId })  // 不传时间
+  // 不传时间；同一会话的重复停止按幂等键返回同一结果
+  stop: (sessionId) => request('/timer/stop', 'POST', { session_id: sessionId }, { 'Idempotency-Key': `stop-${sessionId}` }),
+  sync: (events) => request('/timer/sync', 'POST', { events }),  // 批量同步离线事件
+  connect: () => wx.connectSocket({ url: `${WS_URL}/timer/ws?token=${getToken()}` })  // 状态推送
 }
 
 // 计划相关API
@@ -82,7 +101,14 @@ const stats = {
     if (params.length) url += '?' + params.join('&')
     return request(url)
   },
-  achievements: () => request('/stats/achievements')
+  achievements: () => request('/stats/achievements'),
+  hourly: (days = 28) => request(`/stats/hourly?days=${days}`),
+  range: (granularity = 'day', startDate, endDate) => {
+    let url = `/stats/range?granularity=${granularity}`
+    if (startDate) url += `&start_date=${startDate}`
+    if (endDate) url += `&end_date=${endDate}`
+    return request(url)
+  }
 }
 
 module.exports = {